@@ -0,0 +1,237 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Callable, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+# importing telechat changes into the repository, the benchmark changes into a scratch directory right after
+import chatbot_pool
+import loader
+import speech
+import telechat
+import translation
+import upstream
+from metrics import Histogram, registry as metrics
+from fakes import FakeBot, FakeChatBot, FakeContext, FakeSttBackend, FakeTranslator, Latency, audio_transport
+
+import httpx
+from hugchat import hugchat
+from telegram import Chat, Message, Update, User, Voice
+
+ACCOUNT = 'bench@example.invalid'
+DEFAULT_MIX = 'prompt=70,private=10,bottalk=5,voice_prompt=10,voice_summary=5'
+VOICE_BYTES = 32 * 1024
+# audit events of file system access, sqlite does its own file I/O and stat calls aren't audited, so these are lower bounds
+FILE_EVENTS = ('open', 'os.listdir', 'os.scandir', 'os.mkdir', 'os.rename', 'os.replace', 'os.remove', 'os.rmdir', 'os.truncate', 'sqlite3.connect')
+
+
+class FileAccessCounter:
+    """Counts file system access of all threads through audit hooks while it is enabled."""
+
+    def __init__(self):
+        self.enabled = False
+        self.counts: dict[str, int] = {}
+        self._lock = threading.Lock()
+        sys.addaudithook(self._hook)
+
+    def _hook(self, event: str, args: tuple) -> None:
+        if self.enabled and event in FILE_EVENTS:
+            with self._lock:
+                self.counts[event] = self.counts.get(event, 0) + 1
+
+
+class Simulation:
+    """Sends synthetic updates of "users" simulated users to the real handlers, each user waits for an answer before sending the next message."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.bot = FakeBot(Latency(args.telegram_latency, rng=self.rng))
+        self.latencies: dict[str, Histogram] = {}
+        self.failures: dict[str, int] = {}
+        self.ids = iter(range(1, 10**9))
+        self.mix = self._parse_mix(args.mix)
+        self.handlers: dict[str, Callable] = {
+            'prompt': telechat.prompt,
+            'private': telechat.private,
+            'bottalk': telechat.bottalk,
+            'voice_prompt': telechat.voice_prompt,
+            'voice_summary': telechat.voice_summary,
+            'translate': telechat.translate,
+        }
+
+    @staticmethod
+    def _parse_mix(mix: str) -> dict[str, float]:
+        weights = {}
+        for entry in mix.split(','):
+            name, _, weight = entry.partition('=')
+            weights[name.strip()] = float(weight or 1)
+        return weights
+
+    def update(self, user_id: int, text: Optional[str] = None, voice: bool = False) -> Update:
+        user = User(id=user_id, first_name=f'user {user_id}', is_bot=False, username=f'user{user_id}')
+        chat = Chat(id=user_id, type=Chat.PRIVATE)
+        voice_message = Voice(file_id=f'voice{next(self.ids)}', file_unique_id=f'unique{self.rng.randrange(self.args.distinct_voices)}', duration=5, mime_type='audio/ogg', file_size=VOICE_BYTES) if voice else None
+        message = Message(message_id=next(self.ids), date=datetime.now(timezone.utc), chat=chat, from_user=user, text=text, voice=voice_message)
+        return Update(update_id=next(self.ids), message=message)
+
+    def request(self, user_id: int, action: str) -> tuple[Update, FakeContext]:
+        if action == 'prompt':
+            return self.update(user_id, f'message {next(self.ids)} of user {user_id}'), FakeContext(self.bot)
+        if action == 'private':
+            return self.update(user_id, '/private tell me something'), FakeContext(self.bot, ['tell', 'me', 'something'])
+        if action == 'bottalk':
+            return self.update(user_id, '/bottalk 2 talk to each other'), FakeContext(self.bot, ['2', 'talk', 'to', 'each', 'other'])
+        if action in ('voice_prompt', 'voice_summary'):
+            return self.update(user_id, voice=True), FakeContext(self.bot)
+        if action == 'translate':
+            return self.update(user_id, '/translate DE'), FakeContext(self.bot, ['DE'])
+        raise ValueError(f'unknown action {action}')
+
+    async def send(self, user_id: int, action: str) -> None:
+        update, context = self.request(user_id, action)
+        start = time.monotonic()
+        try:
+            await self.handlers[action](update, context)
+        except Exception as e:
+            self.failures[action] = self.failures.get(action, 0) + 1
+            print(f'{action} of user {user_id} failed: {e!r}')
+        finally:
+            self.latencies.setdefault(action, Histogram()).observe(time.monotonic() - start)
+
+    async def user(self, user_id: int) -> None:
+        # spread the first messages of the users a bit like real traffic
+        await asyncio.sleep(self.rng.uniform(0, self.args.think_time))
+        if self.rng.random() < self.args.translate_fraction:
+            await self.send(user_id, 'translate')
+        actions, weights = list(self.mix), list(self.mix.values())
+        for _ in range(self.args.messages):
+            await self.send(user_id, self.rng.choices(actions, weights)[0])
+            if self.args.think_time:
+                await asyncio.sleep(self.rng.expovariate(1 / self.args.think_time))
+
+    async def run(self) -> float:
+        start = time.monotonic()
+        await asyncio.gather(*(self.user(user_id) for user_id in range(1, self.args.users + 1)))
+        return time.monotonic() - start
+
+
+def prepare(args: argparse.Namespace, directory: str) -> None:
+    """Writes the config and access lists of the simulated users and replaces the upstream clients with fakes."""
+    os.chdir(directory)
+    config = {
+        'telegram_api_token': 'bench',
+        'deepl_api_token': 'bench',
+        'stt_backend': 'fake',
+        'stream_responses': not args.no_stream,
+        'stream_edit_interval': args.edit_interval,
+        'chatbot_pool_size': args.pool_size,
+        'max_concurrent_requests': args.max_concurrent,
+        'retry_base_delay': args.retry_delay,
+    }
+    with open(loader.CONFIG_FILE, 'w', encoding='utf-8') as f:
+        json.dump(config, f, indent=4)
+    with open(loader.ALLOWED_USERS_FILE, 'w', encoding='utf-8') as f:
+        json.dump([str(user_id) for user_id in range(1, args.users + 1)], f)
+    with open(loader.ADMINS_FILE, 'w', encoding='utf-8') as f:
+        json.dump([], f)
+
+    rng = random.Random(args.seed + 1)
+    FakeChatBot.chat_latency = Latency(args.hugchat_latency, failure_rate=args.hugchat_failure_rate, rng=rng)
+    FakeChatBot.conversation_latency = Latency(args.hugchat_latency / 10, failure_rate=args.hugchat_failure_rate, rng=rng)
+    FakeTranslator.latency = Latency(args.deepl_latency, failure_rate=args.deepl_failure_rate, rng=rng)
+    FakeSttBackend.latency = Latency(args.stt_latency, failure_rate=args.stt_failure_rate, rng=rng)
+    hugchat.ChatBot = FakeChatBot
+    chatbot_pool.load_cookies = lambda cookie_dir: {ACCOUNT: {}}
+    translation.Translator = FakeTranslator
+    speech.register_backend('fake', lambda config: FakeSttBackend())
+    loader.transcriber()._client = httpx.AsyncClient(transport=audio_transport(VOICE_BYTES))
+
+
+def report(simulation: Simulation, elapsed: float, file_access: FileAccessCounter) -> str:
+    requests = sum(histogram.count for histogram in simulation.latencies.values())
+    lines = [f'{simulation.args.users} users, {requests} requests in {elapsed:.2f}s: {requests / elapsed:.1f} requests/s', '']
+    lines.append('request latency (count p50/p95/p99 max, failures):')
+    for action, histogram in sorted(simulation.latencies.items()):
+        quantiles = '/'.join(f'{histogram.quantile(q):.3f}' for q in (0.5, 0.95, 0.99))
+        lines.append(f'  {action}: {histogram.count} {quantiles} {histogram.max:.3f}s, {simulation.failures.get(action, 0)} failed')
+    lines.append('')
+    lines.append(f'file system access ({sum(file_access.counts.values())} total, {sum(file_access.counts.values()) / max(1, requests):.1f} per request):')
+    lines.extend(f'  {event}: {count}' for event, count in sorted(file_access.counts.items()))
+    lines.append('')
+    lines.append(f'telegram api calls: {sum(simulation.bot.calls.values())}')
+    lines.extend(f'  {method}: {count}' for method, count in sorted(simulation.bot.calls.items()))
+    lines.append('')
+    lines.append(metrics.render_text())
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drives the telechat handlers with simulated users against fake Telegram, HuggingChat, DeepL and speech to text services.')
+    parser.add_argument('--users', type=int, default=20, help='number of simulated users')
+    parser.add_argument('--messages', type=int, default=10, help='messages per user')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'weights of the request types, default: {DEFAULT_MIX}')
+    parser.add_argument('--translate-fraction', type=float, default=0.2, help='fraction of users that turn on translation first')
+    parser.add_argument('--think-time', type=float, default=0.5, help='mean seconds a user waits between messages')
+    parser.add_argument('--distinct-voices', type=int, default=50, help='number of different voice messages, fewer means more transcript cache hits')
+    parser.add_argument('--hugchat-latency', type=float, default=1.0, help='median seconds of a HuggingChat answer')
+    parser.add_argument('--hugchat-failure-rate', type=float, default=0.05)
+    parser.add_argument('--deepl-latency', type=float, default=0.2)
+    parser.add_argument('--deepl-failure-rate', type=float, default=0.01)
+    parser.add_argument('--stt-latency', type=float, default=0.5)
+    parser.add_argument('--stt-failure-rate', type=float, default=0.01)
+    parser.add_argument('--telegram-latency', type=float, default=0.05)
+    parser.add_argument('--no-stream', action='store_true', help='send answers at once instead of streaming them')
+    parser.add_argument('--edit-interval', type=float, default=0.2, help='seconds between edits of streamed answers')
+    parser.add_argument('--pool-size', type=int, default=3)
+    parser.add_argument('--max-concurrent', type=int, default=8)
+    parser.add_argument('--retry-delay', type=float, default=0.1, help='base delay of retries in seconds')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--prometheus', action='store_true', help='print the metrics in the prometheus text format as well')
+    parser.add_argument('--keep', action='store_true', help="don't delete the scratch directory with the logs and user store")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='telechat-bench-')
+    try:
+        prepare(args, directory)
+        telechat.register_gauges()
+        loader.chatbot_pool().warm()
+        simulation = Simulation(args)
+        simulation.handlers = {name: telechat.instrumented(handler) for name, handler in simulation.handlers.items()}
+        file_access = FileAccessCounter()
+
+        async def run() -> float:
+            file_access.enabled = True
+            try:
+                return await simulation.run()
+            finally:
+                file_access.enabled = False
+                await loader.close_transcriber()
+
+        elapsed = asyncio.run(run())
+        upstream.shutdown()
+        loader.close_chatbot_pool()
+        loader.flush_users()
+        loader.flush_logs()
+        print(report(simulation, elapsed, file_access))
+        if args.prometheus:
+            print(metrics.render_prometheus())
+    finally:
+        os.chdir(os.path.dirname(directory))
+        if args.keep:
+            print(f'scratch directory: {directory}')
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
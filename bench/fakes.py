@@ -0,0 +1,196 @@
+import asyncio
+import itertools
+import random
+import time
+from typing import AsyncIterator, Iterator, Optional, Union
+
+import httpx
+from hugchat.hugchat import Conversation
+
+from metrics import registry as metrics
+from speech import SttBackend
+
+
+class Latency:
+    """A latency distribution: log-normal around "median" seconds with the spread "sigma", failing with "failure_rate"."""
+
+    def __init__(self, median: float = 0.0, sigma: float = 0.5, failure_rate: float = 0.0, rng: Optional[random.Random] = None):
+        self.median = max(0.0, median)
+        self.sigma = max(0.0, sigma)
+        self.failure_rate = min(1.0, max(0.0, failure_rate))
+        self.rng = rng or random.Random()
+
+    def sample(self) -> float:
+        if not self.median:
+            return 0.0
+        return self.median * self.rng.lognormvariate(0, self.sigma) if self.sigma else self.median
+
+    def fails(self) -> bool:
+        return self.rng.random() < self.failure_rate
+
+
+# the names match the exceptions of the real libraries, so the retry policy treats them the same way
+class ModelOverloadedError(Exception):
+    pass
+
+
+class TooManyRequestsException(Exception):
+    pass
+
+
+class FakeChatBot:
+    """Stands in for hugchat.ChatBot, it blocks like the real one because it is called on the worker pool.
+
+    Set the class attributes before the first chatbot is created.
+    """
+
+    chat_latency = Latency()
+    conversation_latency = Latency()
+    answer_words = 60
+    _ids = itertools.count(1)
+
+    def __init__(self, cookies: Optional[dict] = None, **kwargs):
+        self.conversation_list: list[Conversation] = []
+        self.current_conversation = self.new_conversation()
+
+    def new_conversation(self) -> Conversation:
+        self._wait(self.conversation_latency)
+        conversation = Conversation(id=f'fake-{next(self._ids)}')
+        self.conversation_list.append(conversation)
+        return conversation
+
+    def get_conversation_from_id(self, conversation_id: str) -> Optional[Conversation]:
+        return next((conversation for conversation in self.conversation_list if conversation.id == conversation_id), None)
+
+    def change_conversation(self, conversation: Conversation) -> Conversation:
+        # like hugchat, this reads the id and only knows conversations of its list
+        local_conversation = self.get_conversation_from_id(conversation.id)
+        if local_conversation is None:
+            raise ValueError(f'invalid conversation id {conversation.id}')
+        self._wait(self.conversation_latency)
+        self.current_conversation = local_conversation
+        return local_conversation
+
+    def delete_conversation(self, conversation: Optional[Conversation] = None) -> None:
+        conversation = conversation or self.current_conversation
+        self._wait(self.conversation_latency)
+        self.conversation_list.remove(self.get_conversation_from_id(conversation.id))
+        if conversation is self.current_conversation:
+            self.current_conversation = None
+
+    def chat(self, text: str, temperature: float = 0.9, stream: bool = False, **kwargs) -> Union[str, Iterator[str]]:
+        words = [f'word{index}' for index in range(self.answer_words)]
+        if not stream:
+            self._wait(self.chat_latency)
+            return ' '.join(words)
+        return self._stream(words)
+
+    def _stream(self, words: list[str]) -> Iterator[str]:
+        latency = self.chat_latency.sample()
+        if self.chat_latency.fails():
+            time.sleep(latency)
+            raise ModelOverloadedError('fake model is overloaded')
+        for word in words:
+            time.sleep(latency / len(words))
+            yield word + ' '
+
+    @staticmethod
+    def _wait(latency: Latency) -> None:
+        time.sleep(latency.sample())
+        if latency.fails():
+            raise ModelOverloadedError('fake model is overloaded')
+
+
+class FakeTextResult:
+    def __init__(self, text: str, detected_source_lang: str):
+        self.text = text
+        self.detected_source_lang = detected_source_lang
+
+
+class FakeTranslator:
+    """Stands in for deepl.Translator."""
+
+    latency = Latency()
+
+    def __init__(self, auth_key: str = '', **kwargs):
+        self.requests = 0
+
+    def translate_text(self, text: Union[str, list[str]], *, target_lang: str, **kwargs) -> Union[FakeTextResult, list[FakeTextResult]]:
+        self.requests += 1
+        time.sleep(self.latency.sample())
+        if self.latency.fails():
+            raise TooManyRequestsException('fake deepl is rate limited')
+        if isinstance(text, str):
+            return FakeTextResult(f'[{target_lang}] {text}', 'DE')
+        return [FakeTextResult(f'[{target_lang}] {text}', 'DE') for text in text]
+
+
+class FakeSttBackend(SttBackend):
+    """Stands in for Deepgram, it reads the whole audio stream before answering."""
+
+    latency = Latency()
+
+    async def transcribe(self, chunks: AsyncIterator[bytes], mimetype: str) -> tuple[str, str]:
+        size = 0
+        async for chunk in chunks:
+            size += len(chunk)
+        await asyncio.sleep(self.latency.sample())
+        if self.latency.fails():
+            raise ConnectionError('fake speech to text backend is unreachable')
+        return f'fake transcript of {size} bytes of audio', 'EN-US'
+
+
+def audio_transport(size: int) -> httpx.MockTransport:
+    """Serves "size" bytes of silence for every voice message that is downloaded from the telegram file server."""
+    return httpx.MockTransport(lambda request: httpx.Response(200, content=bytes(size)))
+
+
+class FakeMessage:
+    def __init__(self, bot: 'FakeBot', chat_id: int, message_id: int):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+    async def edit_text(self, text: str, **kwargs) -> 'FakeMessage':
+        await self.bot.call('editMessageText')
+        return self
+
+
+class FakeFile:
+    def __init__(self, file_id: str):
+        self.file_id = file_id
+        self.file_path = f'https://files.invalid/{file_id}.ogg'
+
+
+class FakeBot:
+    """Stands in for telegram.Bot, counting and timing the api calls per method like TimedRequest does."""
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.calls: dict[str, int] = {}
+        self._message_ids = itertools.count(1_000_000)
+
+    async def call(self, method: str) -> None:
+        self.calls[method] = self.calls.get(method, 0) + 1
+        with metrics.timer('telegram_seconds', method=method):
+            await asyncio.sleep(self.latency.sample())
+
+    async def send_message(self, chat_id: int, text: str, **kwargs) -> FakeMessage:
+        await self.call('sendMessage')
+        return FakeMessage(self, chat_id, next(self._message_ids))
+
+    async def send_chat_action(self, chat_id: int, action: str, **kwargs) -> bool:
+        await self.call('sendChatAction')
+        return True
+
+    async def get_file(self, file_id: str, **kwargs) -> FakeFile:
+        await self.call('getFile')
+        return FakeFile(file_id)
+
+
+class FakeContext:
+    """Stands in for the CallbackContext of python-telegram-bot."""
+
+    def __init__(self, bot: FakeBot, args: Optional[list[str]] = None):
+        self.bot = bot
+        self.args = args or []
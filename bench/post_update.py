@@ -0,0 +1,55 @@
+import argparse
+import itertools
+import json
+import os
+import time
+
+import httpx
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.json')
+
+
+def canned_update(update_id: int, user_id: int, text: str) -> dict:
+    """Returns a private text message of the user as telegram sends it to a webhook."""
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'user {user_id}', 'username': f'user{user_id}'}
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private', 'first_name': user['first_name'], 'username': user['username']},
+            'from': user,
+            'text': text,
+            **({'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]} if text.startswith('/') else {}),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='POSTs canned updates to the webhook of a running bot, like telegram would.')
+    parser.add_argument('text', nargs='?', default='Hello, who are you?', help='text of the messages, commands like /private work as well')
+    parser.add_argument('--user-id', type=int, required=True, help='telegram user id of the sender, it has to be whitelisted')
+    parser.add_argument('--count', type=int, default=1, help='number of updates to send')
+    parser.add_argument('--secret', help='webhook secret, read from config.json by default')
+    parser.add_argument('--wrong-secret', action='store_true', help='send a wrong secret, the bot should answer with 403')
+    args = parser.parse_args()
+
+    config = {}
+    if os.path.exists(CONFIG_FILE):
+        with open(CONFIG_FILE, encoding='utf-8') as f:
+            config = json.load(f)
+    secret = args.secret or config.get('webhook_secret')
+    if not secret:
+        parser.error('the webhook secret is random if it is not set in config.json, pass it with --secret')
+    url = f"http://{config.get('webhook_listen') or '127.0.0.1'}:{config.get('webhook_port') or 8443}/{config.get('webhook_path') or 'telegram'}"
+    headers = {'X-Telegram-Bot-Api-Secret-Token': 'wrong' if args.wrong_secret else secret}
+    update_ids = itertools.count(int(time.time() * 1000))
+    with httpx.Client(timeout=30) as client:
+        for _ in range(args.count):
+            start = time.monotonic()
+            response = client.post(url, json=canned_update(next(update_ids), args.user_id, args.text), headers=headers)
+            print(f'{response.status_code} in {(time.monotonic() - start) * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
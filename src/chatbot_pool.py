@@ -0,0 +1,188 @@
+import os
+import threading
+from collections import deque
+from typing import Callable, Optional
+
+from hugchat import hugchat
+from hugchat.login import Login
+
+DEFAULT_POOL_SIZE = 3
+
+
+def load_cookies(cookie_dir: str) -> dict[str, dict]:
+    """Loads the cookies of all HuggingChat accounts in the cookie dir, keyed by the mail address of the account."""
+    accounts = {}
+    if not os.path.isdir(cookie_dir):
+        return accounts
+    for file in sorted(os.listdir(cookie_dir)):
+        if not file.endswith('.json'):
+            continue
+        mail = file.removesuffix('.json')
+        try:
+            accounts[mail] = Login(mail, '').loadCookiesFromDir(cookie_dir).get_dict()
+        except Exception as e:
+            print(f'could not load HuggingChat cookies of {mail}: {e}')
+    return accounts
+
+
+def conversation_of(chatbot: hugchat.ChatBot, conversation_id: str) -> hugchat.Conversation:
+    """Returns the conversation with the given id as hugchat expects it, e.g. for a conversation id that was persisted.
+
+    hugchat only changes to and deletes conversations in the conversation list of the chatbot, so unknown ids are added to it.
+    """
+    conversation = chatbot.get_conversation_from_id(conversation_id)
+    if conversation is None:
+        conversation = hugchat.Conversation(id=conversation_id)
+        chatbot.conversation_list.append(conversation)
+    return conversation
+
+
+class ChatbotPool:
+    """Creates hugchat chatbots and keeps some pre-warmed ones for requests that only need a chatbot once.
+
+    The cookies of all accounts in the cookie dir are loaded once and new chatbots are spread over the accounts in round robin order.
+    Up to "size" idle chatbots are kept ready, each with a fresh conversation.
+    Leased chatbots are given a fresh conversation in the background when they are released and then reused.
+    Fresh conversations of chatbots that are discarded unused, e.g. on close, are handed to "delete_conversation".
+    """
+
+    def __init__(self, cookie_dir: str, size: int = DEFAULT_POOL_SIZE, delete_conversation: Callable[[hugchat.ChatBot, hugchat.Conversation], None] = lambda chatbot, conversation: None):
+        self.cookie_dir = cookie_dir
+        self.size = max(0, size)
+        self.delete_conversation = delete_conversation
+        self._cookies: Optional[dict[str, dict]] = None
+        self._next_account = 0
+        self._accounts_of: dict[int, str] = {}
+        self._idle: deque[hugchat.ChatBot] = deque()
+        self._warming = 0
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def accounts(self) -> list[str]:
+        with self._lock:
+            return list(self._load_cookies())
+
+    def reload(self) -> None:
+        """Loads the cookies again, e.g. after a new account was logged in."""
+        with self._lock:
+            self._cookies = None
+
+    def create(self, account: Optional[str] = None, strict: bool = False) -> hugchat.ChatBot:
+        """Creates a new chatbot for the given account or the next account in line if the account is unknown.
+
+        If strict is set, a given account that is unknown raises a KeyError instead.
+        """
+        with self._lock:
+            cookies = self._load_cookies()
+            if not cookies:
+                raise RuntimeError(f'No HuggingChat cookies found in {self.cookie_dir}')
+            if account and strict and account not in cookies:
+                raise KeyError(f'No HuggingChat cookies found for {account}')
+            if account not in cookies:
+                accounts = list(cookies)
+                account = accounts[self._next_account % len(accounts)]
+                self._next_account += 1
+            account_cookies = cookies[account]
+        chatbot = hugchat.ChatBot(cookies=account_cookies)
+        with self._lock:
+            self._accounts_of[id(chatbot)] = account
+        return chatbot
+
+    def account_of(self, chatbot: hugchat.ChatBot) -> Optional[str]:
+        return self._accounts_of.get(id(chatbot))
+
+    def forget(self, chatbot: hugchat.ChatBot) -> None:
+        """Drops a chatbot that won't be used anymore."""
+        with self._lock:
+            self._accounts_of.pop(id(chatbot), None)
+
+    def lease(self) -> hugchat.ChatBot:
+        """Returns a chatbot with a fresh conversation, taken from the pre-warmed ones if possible."""
+        chatbot = self.take()
+        if chatbot is None:
+            chatbot = self.create()
+        return chatbot
+
+    def take(self) -> Optional[hugchat.ChatBot]:
+        """Returns a pre-warmed chatbot or None if there is none, without blocking."""
+        with self._lock:
+            chatbot = self._idle.popleft() if self._idle else None
+        # start refilling the pool right away instead of after a chatbot had to be created
+        self.warm()
+        return chatbot
+
+    def release(self, chatbot: hugchat.ChatBot) -> None:
+        """Hands a leased chatbot back. Its old conversation has to be deleted by whoever leased it."""
+        threading.Thread(target=self._recycle, args=(chatbot,), name='chatbot-pool', daemon=True).start()
+
+    def close(self) -> None:
+        """Discards the idle chatbots, e.g. on shutdown, chatbots created or released afterwards are discarded as well."""
+        with self._lock:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+        for chatbot in idle:
+            self._discard(chatbot, chatbot.current_conversation)
+
+    def warm(self) -> None:
+        """Creates chatbots in the background until there are "size" idle ones."""
+        with self._lock:
+            if self._closed:
+                return
+            missing = self.size - len(self._idle) - self._warming
+            self._warming += max(0, missing)
+        for _ in range(missing):
+            threading.Thread(target=self._add_new, name='chatbot-pool', daemon=True).start()
+
+    def _add_new(self) -> None:
+        chatbot = None
+        try:
+            chatbot = self.create()
+        except Exception as e:
+            print(f'could not create chatbot for the pool: {e}')
+        with self._lock:
+            self._warming -= 1
+            closed = self._closed
+            if chatbot is not None and not closed:
+                self._idle.append(chatbot)
+        if chatbot is not None and closed:
+            self._discard(chatbot, chatbot.current_conversation)
+
+    def _recycle(self, chatbot: hugchat.ChatBot) -> None:
+        with self._lock:
+            full = self._closed or len(self._idle) >= self.size
+        if full:
+            # the old conversation is deleted by whoever leased the chatbot
+            self._discard(chatbot)
+            return
+        conversation = None
+        try:
+            conversation = chatbot.new_conversation()
+            chatbot.change_conversation(conversation)
+        except Exception as e:
+            print(f'could not recycle chatbot: {e}')
+            self._discard(chatbot, conversation)
+            return
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                self._idle.append(chatbot)
+        if closed:
+            self._discard(chatbot, conversation)
+
+    def _discard(self, chatbot: hugchat.ChatBot, fresh_conversation: Optional[hugchat.Conversation] = None) -> None:
+        """Closes a chatbot that won't be used anymore, a fresh conversation the pool created for it is handed to delete_conversation."""
+        if fresh_conversation is not None:
+            try:
+                self.delete_conversation(chatbot, fresh_conversation)
+            except Exception as e:
+                print(f'could not queue conversation {fresh_conversation} for deletion: {e}')
+        self.forget(chatbot)
+        session = getattr(chatbot, 'session', None)
+        if session is not None:
+            session.close()
+
+    def _load_cookies(self) -> dict[str, dict]:
+        if self._cookies is None:
+            self._cookies = load_cookies(self.cookie_dir)
+        return self._cookies
@@ -0,0 +1,50 @@
+import asyncio
+import time
+from typing import Generic, Optional, TypeVar
+
+T = TypeVar('T')
+
+DEFAULT_MAX_WINDOW = 5000
+DEFAULT_MAX_ITEMS = 10
+
+
+class _Batch(Generic[T]):
+    def __init__(self):
+        self.items: list[T] = []
+        self.started = time.monotonic()
+
+
+class Coalescer(Generic[T]):
+    """Collects items of a user that arrive in quick succession, e.g. a thought sent as several short messages.
+
+    Every item restarts the window of its user. When the window passes without a new item,
+    the caller that added the last item gets the whole batch and all other callers get None.
+    A batch is handed out early once it has "max_items" items or is "max_wait" seconds old, so it can't be held back forever.
+    """
+
+    def __init__(self, max_items: int = DEFAULT_MAX_ITEMS, max_wait: float = DEFAULT_MAX_WINDOW / 1000 * 2):
+        self.max_items = max(1, max_items)
+        self.max_wait = max(0.0, max_wait)
+        self.coalesced = 0
+        self._batches: dict[int, _Batch[T]] = {}
+
+    async def add(self, user_id: int, item: T, window: float) -> Optional[list[T]]:
+        """Adds the item to the batch of the user and waits up to "window" seconds for more, see the class docs for what is returned."""
+        batch = self._batches.get(user_id)
+        if batch is None:
+            batch = self._batches[user_id] = _Batch()
+        batch.items.append(item)
+        count = len(batch.items)
+        if count < self.max_items:
+            await asyncio.sleep(min(window, max(0.0, batch.started + self.max_wait - time.monotonic())))
+        # a newer item took over the batch, or it was already handed out
+        if len(batch.items) != count or self._batches.get(user_id) is not batch:
+            return None
+        del self._batches[user_id]
+        self.coalesced += len(batch.items) - 1
+        return batch.items
+
+    def discard(self, user_id: int) -> int:
+        """Drops the batch of the user, so nobody gets it, and returns how many items it had."""
+        batch = self._batches.pop(user_id, None)
+        return len(batch.items) if batch else 0
@@ -0,0 +1,151 @@
+import json
+import os
+import threading
+import time
+from typing import Callable, Optional, Union
+
+from hugchat import hugchat
+
+from chatbot_pool import conversation_of
+
+BATCH_SIZE = 20
+RETRY_DELAY = 5.0
+MAX_RETRY_DELAY = 3600.0
+MAX_ATTEMPTS = 12
+
+
+class ConversationCollector:
+    """Deletes HuggingChat conversations in the background.
+
+    Handlers only add the id of a conversation that isn't needed anymore, together with the account it belongs to.
+    Adding only touches memory. The worker thread saves the pending conversations to a json file,
+    so they are still deleted after a restart, and it saves them again at exit (flush).
+    It deletes them in batches and retries failed deletions with exponential backoff,
+    giving up on a conversation after MAX_ATTEMPTS tries.
+    """
+
+    def __init__(self, path: str, chatbot_factory: Callable[[Optional[str]], hugchat.ChatBot]):
+        self.path = path
+        # creates a chatbot of the given account, or of any account for None
+        self.chatbot_factory = chatbot_factory
+        self.deleted = 0
+        self.failed = 0
+        # pending deletions with the keys conversation_id, account, attempts and next_try
+        self._pending: list[dict] = self._load()
+        self._chatbots: dict[Optional[str], hugchat.ChatBot] = {}
+        # whether the pending conversations changed since they were saved
+        self._dirty = False
+        self._directory_made = False
+        self._lock = threading.Lock()
+        # only one thread writes the file at a time
+        self._save_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, conversation_id: Union[str, hugchat.Conversation], account: Optional[str]) -> None:
+        """Queues a conversation to be deleted, only its id is kept so the pending conversations can be saved as json."""
+        if not conversation_id:
+            return
+        with self._lock:
+            self._pending.append({'conversation_id': str(conversation_id), 'account': account, 'attempts': 0, 'next_try': 0.0})
+            self._dirty = True
+        self.start()
+        self._wakeup.set()
+
+    def pending(self) -> list[dict]:
+        with self._lock:
+            return [dict(entry) for entry in self._pending]
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='conversation-gc', daemon=True)
+            self._thread.start()
+
+    def flush(self) -> None:
+        """Saves the pending conversations if they changed since they were last saved."""
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                pending = [dict(entry) for entry in self._pending]
+                self._dirty = False
+            try:
+                self._save(pending)
+            except Exception:
+                with self._lock:
+                    self._dirty = True
+                raise
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.flush()
+            except Exception as e:
+                # saved again with the next change
+                print(f'could not save the pending conversation deletions: {e!r}')
+            with self._lock:
+                now = time.time()
+                due = [entry for entry in self._pending if entry['next_try'] <= now][:BATCH_SIZE]
+                next_try = min((entry['next_try'] for entry in self._pending), default=None)
+            if not due:
+                self._wakeup.wait(None if next_try is None else max(0.0, next_try - time.time()))
+                self._wakeup.clear()
+                continue
+            for entry in due:
+                try:
+                    self._delete(entry)
+                except Exception as e:
+                    print(f'could not delete conversation {entry["conversation_id"]}: {e!r}')
+                    with self._lock:
+                        entry['next_try'] = time.time() + MAX_RETRY_DELAY
+
+    def _delete(self, entry: dict) -> None:
+        try:
+            chatbot = self._chatbot(entry['account'])
+            chatbot.delete_conversation(conversation_of(chatbot, entry['conversation_id']))
+        except Exception as e:
+            with self._lock:
+                entry['attempts'] += 1
+                if entry['attempts'] < MAX_ATTEMPTS:
+                    entry['next_try'] = time.time() + min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** (entry['attempts'] - 1))
+                    self._dirty = True
+                    return
+            print(f'giving up on deleting conversation {entry["conversation_id"]}: {e}')
+            self.failed += 1
+        else:
+            self.deleted += 1
+        with self._lock:
+            self._pending.remove(entry)
+            self._dirty = True
+
+    def _chatbot(self, account: Optional[str]) -> hugchat.ChatBot:
+        """Returns a chatbot of the given account, it is kept for all deletions of that account."""
+        chatbot = self._chatbots.get(account)
+        if chatbot is None:
+            chatbot = self.chatbot_factory(account)
+            self._chatbots[account] = chatbot
+            # a new chatbot starts with a blank conversation, which is never used here
+            try:
+                chatbot.delete_conversation(chatbot.current_conversation)
+            except Exception as e:
+                print(f'could not delete the blank conversation {chatbot.current_conversation}, trying again later: {e}')
+                self.add(chatbot.current_conversation, account)
+        return chatbot
+
+    def _load(self) -> list[dict]:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save(self, pending: list[dict]) -> None:
+        directory = os.path.dirname(self.path)
+        if directory and not self._directory_made:
+            os.makedirs(directory, exist_ok=True)
+            self._directory_made = True
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(pending, f, indent=4)
+        os.replace(temp_path, self.path)
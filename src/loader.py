@@ -1,16 +1,26 @@
+import atexit
 import os
 import json
-import pickle
 import threading
+import time
 from datetime import datetime
 from getpass import getpass
-from typing import Optional, Union
+from typing import Callable, Optional, Union
 
 from hugchat import hugchat
 from hugchat.login import Login
 from telegram import Update
 
-from user_data import UserData
+from chatbot_pool import ChatbotPool
+from conversation_gc import ConversationCollector
+from log_writer import LogWriter
+from retry import DEFAULT_BASE_DELAY as DEFAULT_RETRY_BASE_DELAY, DEFAULT_DEADLINE as DEFAULT_REQUEST_DEADLINE, DEFAULT_FAILURE_THRESHOLD as DEFAULT_CIRCUIT_FAILURE_THRESHOLD, DEFAULT_MAX_ATTEMPTS as DEFAULT_RETRY_MAX_ATTEMPTS, DEFAULT_MAX_DELAY as DEFAULT_RETRY_MAX_DELAY, DEFAULT_RESET_TIMEOUT as DEFAULT_CIRCUIT_RESET_TIMEOUT, CircuitBreaker, RetryPolicy
+from speech import BACKENDS as STT_BACKENDS, DEFAULT_MAX_BYTES as DEFAULT_MAX_VOICE_BYTES, DEFAULT_MAX_DURATION as DEFAULT_MAX_VOICE_DURATION, Transcriber
+from transcript_cache import DEFAULT_MAX_ENTRIES as DEFAULT_TRANSCRIPT_CACHE_SIZE, TranscriptCache
+from translation import DEFAULT_CACHE_SIZE as DEFAULT_TRANSLATION_CACHE_SIZE, SharedTranslator
+from user_cache import UserCache
+from user_data import UserData, UserState
+from user_store import UserStore
 
 CONFIG_FILE = 'config.json'
 ALLOWED_USERS_FILE = 'allowed_users.json'
@@ -19,18 +29,122 @@ ADMINS_FILE = 'admins.json'
 HUGCHAT_COOKIE_DIR = 'hugchat_cookies'
 USERS_DIR = 'users'
 LOG_DIR = 'logs'
+CACHE_DIR = 'cache'
+USER_STORE_FILE = os.path.join(USERS_DIR, 'users.sqlite')
+PENDING_DELETIONS_FILE = os.path.join(USERS_DIR, 'pending_deletions.json')
+TRANSCRIPT_CACHE_FILE = os.path.join(CACHE_DIR, 'transcripts.sqlite')
+
+ACCESS_CHECK_INTERVAL = 1.0
+DEFAULT_MAX_CACHED_USERS = 1000
+DEFAULT_USER_IDLE_TTL = 3600
+DEFAULT_CHATBOT_POOL_SIZE = 3
 
 lock = threading.Lock()
 # don't access this directly to get a user, use update_user_data instead!
-users: dict[int, UserData] = {}
+_users: Optional[UserCache] = None
+_chatbot_pool: Optional[ChatbotPool] = None
+_translator: Optional[SharedTranslator] = None
+_transcript_cache: Optional[TranscriptCache] = None
+_transcriber: Optional[Transcriber] = None
+_conversation_collector: Optional[ConversationCollector] = None
+_retry_policy: Optional[RetryPolicy] = None
+_circuit_breakers: dict[str, CircuitBreaker] = {}
+_config: Optional[dict] = None
+# tells whether a user has requests running or waiting, see keep_busy_users
+_user_busy: Callable[[int], bool] = lambda user_id: False
+# the shard of users this process handles in the sharded mode, None if it handles all users
+_shard: Optional[int] = None
+user_store = UserStore(USER_STORE_FILE)
+log_writer = LogWriter(LOG_DIR)
+atexit.register(log_writer.shutdown)
+
+
+class AccessList:
+    """In-memory copy of a json list of usernames and user ids like allowed_users.json or admins.json.
+
+    The file is only parsed again when its inode, mtime or size changes.
+    To keep membership checks free of file I/O, the file is stat'ed at most once per ACCESS_CHECK_INTERVAL seconds.
+    Changes made through add and remove are written to the file and applied to the cache right away.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._entries: list[str] = []
+        self._members: frozenset[str] = frozenset()
+        self._signature: Optional[tuple[int, int, int]] = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def __contains__(self, user: str) -> bool:
+        self._refresh()
+        return user in self._members
+
+    def entries(self) -> list[str]:
+        self._refresh()
+        return list(self._entries)
+
+    def add(self, user: str) -> bool:
+        with self._lock:
+            self._refresh(force=True)
+            if user in self._members:
+                return False
+            self._write(self._entries + [user])
+            return True
+
+    def remove(self, user: str) -> bool:
+        with self._lock:
+            self._refresh(force=True)
+            if user not in self._members:
+                return False
+            self._write([entry for entry in self._entries if entry != user])
+            return True
+
+    def _stat(self) -> Optional[tuple[int, int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _refresh(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self._checked < ACCESS_CHECK_INTERVAL:
+            return
+        self._checked = now
+        signature = self._stat()
+        if signature == self._signature:
+            return
+        entries = []
+        if signature is not None:
+            with lock, open(self.path, encoding='utf-8') as f:
+                entries = [str(entry) for entry in json.load(f)]
+        self._set(entries, signature)
+
+    def _write(self, entries: list[str]) -> None:
+        with lock, open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(entries, f, indent=4)
+        self._set(entries, self._stat())
+
+    def _set(self, entries: list[str], signature: Optional[tuple[int, int, int]]) -> None:
+        self._entries = entries
+        self._members = frozenset(entries)
+        self._signature = signature
+
+
+allowed_users = AccessList(ALLOWED_USERS_FILE)
+admins = AccessList(ADMINS_FILE)
+
+
+def _is_listed(update: Update, access_list: AccessList) -> bool:
+    user = update.effective_user
+    return bool(user) and ((user.username is not None and user.username in access_list) or str(user.id) in access_list)
 
 
 def admin(update: Update, warning: bool = True):
     # no user associated with update
     if not update.effective_user:
         return False
-    adminlist = load_admins()
-    allowed = update.effective_user.username in adminlist or str(update.effective_user.id) in adminlist
+    allowed = _is_listed(update, admins)
     if warning and not allowed:
         warning_text = f'not allowed user {update.effective_user.username or str(update.effective_user.id)} tried to do admin stuff'
         print(warning_text)
@@ -45,8 +159,7 @@ def auth(update: Update, warning: bool = True):
     # no user associated with update
     if not update.effective_user:
         return False
-    whitelist = load_allowed_users()
-    allowed = update.effective_user.username in whitelist or str(update.effective_user.id) in whitelist
+    allowed = _is_listed(update, allowed_users)
     if warning and not allowed:
         warning_text = f'not allowed user {update.effective_user.username or str(update.effective_user.id)} tried to use bot'
         print(warning_text)
@@ -61,119 +174,213 @@ def load_config() -> dict:
         return json.load(f)
 
 
+def cached_config() -> dict:
+    """Returns the config as it was read the first time, for settings that are needed on every request.
+
+    Changes to these settings take effect after a restart.
+    """
+    global _config
+    if _config is None:
+        _config = load_config()
+    return _config
+
+
 def load_allowed_users() -> list[str]:
-    if not os.path.exists(ALLOWED_USERS_FILE):
-        return []
-    with lock, open(ALLOWED_USERS_FILE, encoding='utf-8') as f:
-        return json.load(f)
+    return allowed_users.entries()
 
 
 def add_allowed_user(user: Union[int, str]) -> bool:
-    user = str(user)
-    allowed_users = load_allowed_users()
-    if user in allowed_users:
-        return False
-    allowed_users.append(user)
-    with lock, open(ALLOWED_USERS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(allowed_users, f, indent=4)
-        return True
+    return allowed_users.add(str(user))
 
 
 def remove_allowed_user(user: Union[int, str]) -> bool:
-    user = str(user)
-    allowed_users = load_allowed_users()
-    if user not in allowed_users:
-        return False
-    allowed_users.remove(user)
-    with lock, open(ALLOWED_USERS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(allowed_users, f, indent=4)
-        return True
+    return allowed_users.remove(str(user))
 
 
 def load_admins() -> list[str]:
-    if not os.path.exists(ADMINS_FILE):
-        return []
-    with lock, open(ADMINS_FILE, encoding='utf-8') as f:
-        return json.load(f)
+    return admins.entries()
+
+
+def migrate_user_pickles() -> int:
+    """Imports the user data pickle files of older versions into the user store, only does something the first time."""
+    return user_store.migrate_pickles(USERS_DIR)
+
+
+def shared_translator() -> Optional[SharedTranslator]:
+    """Returns the translator shared by all users or None if there is no DeepL api token in the config."""
+    global _translator
+    if _translator is None:
+        config = load_config()
+        if not config.get('deepl_api_token'):
+            return None
+        cache_size = config.get('translation_cache_size')
+        _translator = SharedTranslator(config['deepl_api_token'], DEFAULT_TRANSLATION_CACHE_SIZE if cache_size is None else int(cache_size))
+    return _translator
+
+
+def transcript_cache() -> TranscriptCache:
+    """Returns the cache of voice message transcripts, its size is read from the config when it is created."""
+    global _transcript_cache
+    if _transcript_cache is None:
+        size = load_config().get('transcript_cache_size')
+        _transcript_cache = TranscriptCache(TRANSCRIPT_CACHE_FILE, DEFAULT_TRANSCRIPT_CACHE_SIZE if size is None else int(size))
+    return _transcript_cache
+
+
+def transcriber() -> Optional[Transcriber]:
+    """Returns the speech to text transcriber or None if the configured backend can't be used (e.g. no api token).
+
+    The backend is chosen with "stt_backend" in the config, it is "deepgram" by default.
+    """
+    global _transcriber
+    if _transcriber is None:
+        config = load_config()
+        backend_name = config.get('stt_backend') or 'deepgram'
+        if backend_name not in STT_BACKENDS:
+            print(f'unknown speech to text backend: {backend_name}')
+            return None
+        backend = STT_BACKENDS[backend_name](config)
+        if backend is None:
+            return None
+        max_duration = int(config.get('max_voice_duration') or DEFAULT_MAX_VOICE_DURATION)
+        max_bytes = int(config.get('max_voice_bytes') or DEFAULT_MAX_VOICE_BYTES)
+        _transcriber = Transcriber(backend, max_duration, max_bytes)
+    return _transcriber
+
+
+async def close_transcriber() -> None:
+    global _transcriber
+    if _transcriber is not None:
+        await _transcriber.close()
+        _transcriber = None
+
+
+def _new_user_data(state: UserState) -> UserData:
+    return UserData(state, new_chatbot, shared_translator, lambda chatbot: chatbot_pool().account_of(chatbot), delete_conversation_later)
 
 
 def load_user_data(user_id: int) -> Optional[UserData]:
-    path = ''
-    if not os.path.isdir(USERS_DIR):
+    fields = user_store.load(user_id)
+    if not fields:
         return None
-    for file in os.listdir(USERS_DIR):
-        maybe_path = os.path.join(USERS_DIR, file)
-        if os.path.isfile(maybe_path) and file.startswith(str(user_id)) and file.endswith('.pickle'):
-            path = maybe_path
-            break
-    if not path:
-        return None
-    with lock, open(path, 'rb') as f:
-        return pickle.load(f)
+    return _new_user_data(UserState(user_id, **fields))
 
 
 def save_user_data(user_id: int, user_data: UserData) -> None:
     if not user_data.filename:
         return
-    path = ''
-    if os.path.isdir(USERS_DIR):
-        for file in os.listdir(USERS_DIR):
-            maybe_path = os.path.join(USERS_DIR, file)
-            if os.path.isfile(maybe_path) and file.startswith(str(user_id)) and file.endswith('.pickle'):
-                path = maybe_path
-                break
-    path = path or os.path.join(USERS_DIR, f'{user_data.filename}.pickle')
-    with lock:
-        os.makedirs(USERS_DIR, exist_ok=True)
-        with open(path, 'wb') as f:
-            pickle.dump(user_data, f)
+    fields = user_data.sync_state().to_dict()
+    del fields['user_id']
+    user_store.save(user_id, fields)
 
 
-def new_chatbot() -> hugchat.ChatBot:
-    with lock:
-        cookies = hugchat_login()
-    chatbot = hugchat.ChatBot(cookies=cookies)
-    return chatbot
+def new_chatbot(account: Optional[str] = None) -> hugchat.ChatBot:
+    """Creates a chatbot for the given HuggingChat account, or for the next account in line if it's not given."""
+    return chatbot_pool().create(account)
+
+
+def chatbot_pool() -> ChatbotPool:
+    """Returns the pool of HuggingChat chatbots, its size is read from the config when it is created."""
+    global _chatbot_pool
+    if _chatbot_pool is None:
+        size = load_config().get('chatbot_pool_size')
+        _chatbot_pool = ChatbotPool(HUGCHAT_COOKIE_DIR, DEFAULT_CHATBOT_POOL_SIZE if size is None else int(size), delete_conversation_later)
+    return _chatbot_pool
+
 
+def close_chatbot_pool() -> None:
+    """Discards the idle chatbots of the pool and queues their blank conversations for deletion, e.g. on shutdown."""
+    if _chatbot_pool is not None:
+        _chatbot_pool.close()
 
-def hugchat_login() -> dict:
+
+def use_shard(shard: int) -> None:
+    """Makes this process a worker that only handles the users of the given shard.
+
+    Call it before anything is loaded. Files that are rewritten as a whole get a file per shard,
+    the user store and transcript cache are sqlite databases that can be shared between processes.
+    """
+    global _shard
+    _shard = shard
+
+
+def pending_deletions_file() -> str:
+    # the first shard keeps using the file of the unsharded mode
+    if not _shard:
+        return PENDING_DELETIONS_FILE
+    root, extension = os.path.splitext(PENDING_DELETIONS_FILE)
+    return f'{root}_{_shard}{extension}'
+
+
+def conversation_collector() -> ConversationCollector:
+    """Returns the collector that deletes HuggingChat conversations in the background."""
+    global _conversation_collector
+    if _conversation_collector is None:
+        _conversation_collector = ConversationCollector(pending_deletions_file(), lambda account: chatbot_pool().create(account, strict=True))
+        # conversations added since the collector last saved them
+        atexit.register(_conversation_collector.flush)
+    return _conversation_collector
+
+
+def delete_conversation_later(chatbot: hugchat.ChatBot, conversation: Union[hugchat.Conversation, str, None]) -> None:
+    """Queues a conversation of the chatbot to be deleted in the background, only its id is kept."""
+    if conversation is not None:
+        conversation_collector().add(str(conversation), chatbot_pool().account_of(chatbot))
+
+
+def retry_policy() -> RetryPolicy:
+    """Returns the retry policy of all upstream calls, it is read from the config when it is created."""
+    global _retry_policy
+    if _retry_policy is None:
+        config = load_config()
+        _retry_policy = RetryPolicy(
+            int(config.get('retry_max_attempts') or DEFAULT_RETRY_MAX_ATTEMPTS),
+            float(config.get('retry_base_delay') or DEFAULT_RETRY_BASE_DELAY),
+            float(config.get('retry_max_delay') or DEFAULT_RETRY_MAX_DELAY),
+            float(config.get('request_deadline') or DEFAULT_REQUEST_DEADLINE),
+        )
+    return _retry_policy
+
+
+def circuit_breaker(service: str) -> CircuitBreaker:
+    """Returns the circuit breaker of an upstream service, it is shared by all users."""
+    breaker = _circuit_breakers.get(service)
+    if breaker is None:
+        config = load_config()
+        breaker = _circuit_breakers.setdefault(service, CircuitBreaker(
+            service,
+            int(config.get('circuit_failure_threshold') or DEFAULT_CIRCUIT_FAILURE_THRESHOLD),
+            float(config.get('circuit_reset_timeout') or DEFAULT_CIRCUIT_RESET_TIMEOUT),
+        ))
+    return breaker
+
+
+def hugchat_login() -> list[str]:
+    """Makes sure there are HuggingChat cookies and returns the accounts they belong to.
+
+    If there are no cookie files yet, this asks for the login of an account on the command line.
+    All accounts with a cookie file are used in turns.
+    """
     os.makedirs(HUGCHAT_COOKIE_DIR, exist_ok=True)
-    cookie_files = os.listdir(HUGCHAT_COOKIE_DIR)
-    if cookie_files:
-        if len(cookie_files) == 1:
-            mail = cookie_files[0].removesuffix('.json')
-        else:
-            print('Multiple HuggingChat cookie files found:')
-            for i, file in enumerate(cookie_files):
-                print(f'{i}: {file}')
-            while True:
-                choice = input('Choose one by entering the number: ')
-                if choice.isdigit() and 0 <= int(choice) < len(cookie_files):
-                    mail = cookie_files[int(choice)].removesuffix('.json')
-                    break
-                else:
-                    print(f'Invalid choice ({choice}), try again')
-        sign = Login(mail, '')
-        cookies = sign.loadCookiesFromDir(HUGCHAT_COOKIE_DIR)
-    else:
+    if not chatbot_pool().accounts():
         print('No HuggingChat cookie files found, please login to HuggingChat')
         mail = input('Mail: ')
         pw = getpass()
         sign = Login(mail, pw)
-        cookies = sign.login()
+        sign.login()
         sign.saveCookiesToDir(HUGCHAT_COOKIE_DIR)
-    return cookies.get_dict()
+        chatbot_pool().reload()
+    return chatbot_pool().accounts()
 
 
 def update_user_data(update: Update) -> UserData:
     """Returns the user data for the given user id, essentially syncing it with the file system.
 
-    This automatically pickles and unpickles the user data.
-    Unpickling is only done if user is not in memory yet.
-    Pickling is always done unless "save" is False.
+    The user data is only loaded from the user store if the user is not in memory yet.
+    Saving is always done, but only fields that changed since the last save are written.
     If the user does not exist yet, a new one is created.
     """
-    global users
+    users = user_cache()
     user_id = 0
     filename = ''
     if update.effective_user:
@@ -182,27 +389,66 @@ def update_user_data(update: Update) -> UserData:
         last_name = update.effective_user.last_name or ''
         name = f'{first_name} {last_name}'.strip()
         filename = str(update.effective_user.id) + '_' + (update.effective_user.username or name)
-    if not user_id or user_id not in users:
-        users[user_id] = load_user_data(user_id) or UserData(new_chatbot(), filename)
-    save_user_data(user_id, users[user_id])
-    return users[user_id]
+    user_data = users.get(user_id) if user_id else None
+    if not user_data:
+        user_data = load_user_data(user_id) or _new_user_data(UserState(user_id, filename))
+        users.put(user_id, user_data)
+    save_user_data(user_id, user_data)
+    return user_data
+
+
+def user_cache() -> UserCache:
+    """Returns the in-memory user cache, its limits are read from the config when it is created."""
+    global _users
+    if _users is None:
+        config = load_config()
+        max_entries = int(config.get('max_cached_users') or DEFAULT_MAX_CACHED_USERS)
+        idle_ttl = float(config.get('user_idle_ttl') or DEFAULT_USER_IDLE_TTL)
+        _users = UserCache(max_entries, idle_ttl, _evict_user, lambda user_id: _user_busy(user_id))
+    return _users
+
+
+def keep_busy_users(busy: Callable[[int], bool]) -> None:
+    """Keeps users in memory while busy(user_id) is true, so their chatbot isn't closed while a request of theirs uses it."""
+    global _user_busy
+    _user_busy = busy
+
+
+def close_chatbot(chatbot: hugchat.ChatBot) -> None:
+    """Closes the HTTP session of a chatbot that is not used anymore."""
+    chatbot_pool().forget(chatbot)
+    session = getattr(chatbot, 'session', None)
+    if session is not None:
+        session.close()
+
+
+def _evict_user(user_id: int, user_data: UserData) -> None:
+    save_user_data(user_id, user_data)
+    user_store.forget(user_id)
+    if user_data.has_chatbot:
+        close_chatbot(user_data.chatbot)
+
+
+def flush_users() -> None:
+    """Saves and closes all users in memory, e.g. on shutdown."""
+    if _users is not None:
+        _users.clear()
 
 
 def __find_log_subdir(user_id: int) -> Optional[str]:
     """Returns the name of the subdirectory in the LOG_DIR directory that belongs to the user or None if not existent."""
-    if not os.path.exists(LOG_DIR):
-        return None
-    for subdir in os.listdir(LOG_DIR):
-        if os.path.isdir(os.path.join(LOG_DIR, subdir)) and subdir.startswith(str(user_id)):
-            return subdir
-    return None
+    return log_writer.find_subdir(user_id)
 
 
 def delete_log(user_id: int, conversation_id: str) -> bool:
-    """Deletes the log file of the given user id and conversation id and returns whether it was successful."""
+    """Deletes the log file of the given user id and conversation id and returns whether it was successful.
+
+    It waits for the log writer, so call it off the event loop.
+    """
     subdir = __find_log_subdir(user_id)
     if not subdir:
         return False
+    log_writer.close(subdir, f'{conversation_id}.log')
     with lock:
         path = os.path.join(LOG_DIR, subdir, f'{conversation_id}.log')
         if not os.path.isfile(path):
@@ -211,7 +457,51 @@ def delete_log(user_id: int, conversation_id: str) -> bool:
     return True
 
 
-def log(update: Update, *, filename: str = '', message: str = '', title: str = '', subdir: str = '') -> None:
+def flush_logs() -> None:
+    """Writes all queued log records and closes the log files."""
+    log_writer.shutdown()
+
+
+class LogContext:
+    """Everything log() needs to know about the user of an update.
+
+    It is resolved once per update by the handler and passed to every log call of that update,
+    so logging doesn't have to check permissions or load user data again.
+    The temperature and conversation id are read from the user data in memory when a message is logged.
+    """
+
+    def __init__(self, subdir: str = '', title: str = '', user_data: Optional[UserData] = None):
+        self.subdir = subdir
+        self.title = title
+        self.user_data = user_data
+
+    @property
+    def temperature(self) -> Optional[float]:
+        return self.user_data.temperature if self.user_data else None
+
+    @property
+    def conversation_id(self) -> Optional[str]:
+        return self.user_data.conversation_id if self.user_data else None
+
+
+def log_context(update: Optional[Update], user_data: Optional[UserData] = None) -> LogContext:
+    """Resolves the log context of an update without any file I/O.
+
+    If no user data is given, the user data is only taken if the user is already in memory.
+    """
+    if not update or not update.effective_user:
+        return LogContext(user_data=user_data)
+    user = update.effective_user
+    first_name = user.first_name or ''
+    last_name = user.last_name or ''
+    name = f'{first_name} {last_name}'.strip()
+    subdir = __find_log_subdir(user.id) or str(user.id) + '_' + (user.username or name)
+    log_writer.remember_subdir(user.id, subdir)
+    title = user.username or str(user.id) + (f' ({name})' if name else '')
+    return LogContext(subdir, title, user_data or user_cache().peek(user.id))
+
+
+def log(update: Optional[Update], *, ctx: Optional[LogContext] = None, filename: str = '', message: str = '', title: str = '', subdir: str = '') -> None:
     """Logs a message to a file in the LOGDIR directory.
 
     A subdirectory is created for each user.
@@ -220,31 +510,21 @@ def log(update: Update, *, filename: str = '', message: str = '', title: str = '
 
     If the subdir is the string 'None', no subdirectory is created.
 
-    The optional function parameters take precedence over information from the update object.
+    The optional function parameters take precedence over information from the log context and the update object.
+    Pass the log context of the update as "ctx" if it was already resolved, otherwise it is resolved here.
+    The message is only queued here, it is written to the file by the log writer thread.
     """
     timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    ctx = ctx or log_context(update)
     # find best filename, title and message in parameters
-    name = ''
-    temp = ''
-    user_data = None
-    if update and update.effective_user:
-        first_name = update.effective_user.first_name or ''
-        last_name = update.effective_user.last_name or ''
-        name = f'{first_name} {last_name}'.strip()
-        subdir = subdir or __find_log_subdir(update.effective_user.id) or str(update.effective_user.id) + '_' + (update.effective_user.username or name)
-        title = title or update.effective_user.username or str(update.effective_user.id) + (f' ({name})' if name else '')
-        if auth(update, warning=False):
-            user_data = update_user_data(update)
-            temp = f' (temp={user_data.temperature})'
+    subdir = subdir or ctx.subdir
+    title = title or ctx.title
+    temp = f' (temp={ctx.temperature})' if ctx.user_data else ''
     if update and update.message:
         message = message or update.message.text or ''
-    filename = filename or (user_data.chatbot.current_conversation if user_data else '') or 'unknown'
+    filename = filename or ctx.conversation_id or 'unknown'
 
     if subdir == 'None':
         subdir = ''
 
-    with lock:
-        os.makedirs(os.path.join(LOG_DIR, subdir), exist_ok=True)
-        with open(os.path.join(LOG_DIR, subdir, f'{filename}.log'), 'a', encoding='utf-8') as f:
-            f.write(f'{timestamp} ================ {title} ================{temp}\n')
-            f.write(f'{message}\n')
+    log_writer.write(subdir, f'{filename}.log', f'{timestamp} ================ {title} ================{temp}\n{message}\n')
@@ -0,0 +1,151 @@
+import os
+import queue
+import threading
+from collections import OrderedDict
+from typing import Any, Optional, TextIO
+
+DEFAULT_MAX_OPEN_FILES = 64
+MAX_BATCH_SIZE = 1000
+
+
+class LogWriter:
+    """Appends log records to files in the log directory from a background thread.
+
+    write() only puts the record on a queue. The writer thread takes records off the queue in batches,
+    appends all records of a batch to a file with a single write and keeps up to "max_open_files" files open,
+    closing the least recently used one when there are more.
+
+    It also caches which subdirectory of the log directory belongs to which user id,
+    so the log directory only has to be listed once.
+    """
+
+    def __init__(self, log_dir: str, max_open_files: int = DEFAULT_MAX_OPEN_FILES):
+        self.log_dir = log_dir
+        self.max_open_files = max(1, max_open_files)
+        self._queue: queue.Queue[tuple[Any, ...]] = queue.Queue()
+        self._files: OrderedDict[str, TextIO] = OrderedDict()
+        self._directories: set[str] = set()
+        self._subdirs: dict[int, str] = {}
+        self._subdirs_scanned = False
+        self._subdirs_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+
+    def find_subdir(self, user_id: int) -> Optional[str]:
+        """Returns the name of the subdirectory that belongs to the user or None if not existent."""
+        with self._subdirs_lock:
+            if not self._subdirs_scanned:
+                self._subdirs_scanned = True
+                if os.path.isdir(self.log_dir):
+                    for subdir in os.listdir(self.log_dir):
+                        prefix = subdir.split('_', 1)[0]
+                        if prefix.isdigit() and os.path.isdir(os.path.join(self.log_dir, subdir)):
+                            self._subdirs.setdefault(int(prefix), subdir)
+            return self._subdirs.get(user_id)
+
+    def remember_subdir(self, user_id: int, subdir: str) -> None:
+        with self._subdirs_lock:
+            self._subdirs.setdefault(user_id, subdir)
+
+    def write(self, subdir: str, filename: str, text: str) -> None:
+        """Queues the text to be appended to "<log dir>/<subdir>/<filename>"."""
+        self._start()
+        self._queue.put(('write', os.path.join(self.log_dir, subdir, filename), text))
+
+    def flush(self) -> None:
+        """Blocks until all queued records are written."""
+        self._request('flush')
+
+    def close(self, subdir: str, filename: str) -> None:
+        """Writes all queued records and closes the given file, e.g. before deleting it."""
+        self._request('close', os.path.join(self.log_dir, subdir, filename))
+
+    def shutdown(self) -> None:
+        """Writes all queued records, closes all files and stops the writer thread."""
+        self._request('stop')
+
+    def _request(self, command: str, *args: Any) -> None:
+        if not self._thread or not self._thread.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put((command, *args, done))
+        done.wait()
+
+    def _start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        with self._thread_lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            while len(batch) < MAX_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            pending: OrderedDict[str, list[str]] = OrderedDict()
+            for index, (command, *args) in enumerate(batch):
+                if command == 'write':
+                    path, text = args
+                    pending.setdefault(path, []).append(text)
+                    continue
+                # everything before a control command has to be written first
+                self._write_pending(pending)
+                done: threading.Event = args[-1]
+                if command == 'close':
+                    self._close(args[0])
+                elif command == 'stop':
+                    for path in list(self._files):
+                        self._close(path)
+                    running = False
+                    # records after the stop would reopen the closed files, but nobody may keep waiting for a request
+                    for later_command, *later_args in batch[index + 1:]:
+                        if later_command != 'write':
+                            later_args[-1].set()
+                    done.set()
+                    break
+                done.set()
+            self._write_pending(pending)
+
+    def _write_pending(self, pending: OrderedDict[str, list[str]]) -> None:
+        for path, texts in pending.items():
+            try:
+                f = self._open(path)
+                f.write(''.join(texts))
+                f.flush()
+            except OSError as e:
+                print(f'could not write log file {path}: {e}')
+        pending.clear()
+
+    def _open(self, path: str) -> TextIO:
+        f = self._files.get(path)
+        if f is not None:
+            self._files.move_to_end(path)
+            return f
+        directory = os.path.dirname(path)
+        if directory not in self._directories:
+            os.makedirs(directory, exist_ok=True)
+            self._directories.add(directory)
+        try:
+            f = open(path, 'a', encoding='utf-8')
+        except FileNotFoundError:
+            # the directory was removed behind our back
+            os.makedirs(directory, exist_ok=True)
+            f = open(path, 'a', encoding='utf-8')
+        self._files[path] = f
+        while len(self._files) > self.max_open_files:
+            _, oldest = self._files.popitem(last=False)
+            oldest.close()
+        return f
+
+    def _close(self, path: str) -> None:
+        f = self._files.pop(path, None)
+        if f is not None:
+            f.close()
+
@@ -0,0 +1,193 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterator, Optional
+
+# upper bounds of the histogram buckets in seconds, from a fast cache hit to a very slow chatbot answer
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+PREFIX = 'telechat_'
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def _labels(labels: dict[str, str]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Optional[tuple[str, str]] = None) -> str:
+    pairs = [*labels, extra] if extra else list(labels)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+
+class Histogram:
+    """Counts observations in fixed buckets, so it needs the same memory no matter how many values are observed.
+
+    Quantiles are estimated by interpolating inside the bucket they fall into.
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        # the last count is for values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        with self._lock:
+            if not self.count:
+                return 0.0
+            rank = q * self.count
+            seen = 0
+            for index, count in enumerate(self.counts):
+                if count and seen + count >= rank:
+                    lower = self.buckets[index - 1] if index else 0.0
+                    upper = self.buckets[index] if index < len(self.buckets) else self.max
+                    return min(self.max, lower + (upper - lower) * (rank - seen) / count)
+                seen += count
+            return self.max
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        """Returns the cumulative counts per upper bound, like prometheus expects them."""
+        with self._lock:
+            result = []
+            total = 0
+            for bound, count in zip([*map(str, self.buckets), '+Inf'], self.counts):
+                total += count
+                result.append((bound, total))
+            return result
+
+
+class Metrics:
+    """Histograms, counters and gauges of the bot, each identified by a name and labels.
+
+    Gauges are read from callbacks when the metrics are rendered, e.g. the length of a queue.
+    """
+
+    def __init__(self):
+        self._histograms: dict[str, dict[Labels, Histogram]] = {}
+        self._counters: dict[str, dict[Labels, float]] = {}
+        self._gauges: dict[str, dict[Labels, Callable[[], float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = _labels(labels)
+        with self._lock:
+            histogram = self._histograms.setdefault(name, {}).get(key)
+            if histogram is None:
+                histogram = self._histograms[name][key] = Histogram()
+        histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        """Observes how many seconds the block takes, also if it raises."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        key = _labels(labels)
+        with self._lock:
+            counters = self._counters.setdefault(name, {})
+            counters[key] = counters.get(key, 0) + value
+
+    def gauge(self, name: str, func: Callable[[], float], **labels: str) -> None:
+        with self._lock:
+            self._gauges.setdefault(name, {})[_labels(labels)] = func
+
+    def histograms(self) -> dict[str, dict[Labels, Histogram]]:
+        with self._lock:
+            return {name: dict(histograms) for name, histograms in self._histograms.items()}
+
+    def counters(self) -> dict[str, dict[Labels, float]]:
+        with self._lock:
+            return {name: dict(counters) for name, counters in self._counters.items()}
+
+    def gauges(self) -> dict[str, dict[Labels, float]]:
+        with self._lock:
+            gauges = {name: dict(funcs) for name, funcs in self._gauges.items()}
+        values = {}
+        for name, funcs in gauges.items():
+            values[name] = {}
+            for key, func in funcs.items():
+                try:
+                    values[name][key] = float(func())
+                except Exception as e:
+                    print(f'could not read gauge {name}: {e}')
+        return values
+
+    def render_prometheus(self) -> str:
+        """Returns all metrics in the prometheus text format."""
+        lines = []
+        for name, histograms in sorted(self.histograms().items()):
+            lines.append(f'# TYPE {PREFIX}{name} histogram')
+            for key, histogram in sorted(histograms.items()):
+                for bound, count in histogram.cumulative():
+                    lines.append(f'{PREFIX}{name}_bucket{_format_labels(key, ("le", bound))} {count}')
+                lines.append(f'{PREFIX}{name}_sum{_format_labels(key)} {histogram.sum}')
+                lines.append(f'{PREFIX}{name}_count{_format_labels(key)} {histogram.count}')
+        for metric_type, metrics in (('counter', self.counters()), ('gauge', self.gauges())):
+            for name, values in sorted(metrics.items()):
+                lines.append(f'# TYPE {PREFIX}{name} {metric_type}')
+                for key, value in sorted(values.items()):
+                    lines.append(f'{PREFIX}{name}{_format_labels(key)} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+    def render_text(self) -> str:
+        """Returns a short human readable summary of all metrics, with the p50/p95/p99 of the histograms."""
+        sections = []
+        for name, histograms in sorted(self.histograms().items()):
+            lines = [f'{name} (count p50/p95/p99):']
+            for key, histogram in sorted(histograms.items()):
+                label = ' '.join(value for _, value in key) or 'all'
+                quantiles = '/'.join(f'{histogram.quantile(q):.2f}' for q in (0.5, 0.95, 0.99))
+                lines.append(f'  {label}: {histogram.count} {quantiles}s')
+            sections.append('\n'.join(lines))
+        for name, values in sorted({**self.counters(), **self.gauges()}.items()):
+            lines = [f'{name}:']
+            for key, value in sorted(values.items()):
+                label = ' '.join(value for _, value in key) or 'all'
+                lines.append(f'  {label}: {value:g}')
+            sections.append('\n'.join(lines))
+        return '\n\n'.join(sections) or 'No metrics yet'
+
+
+registry = Metrics()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    """Serves the metrics in the prometheus text format at http://host:port/metrics from a background thread."""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
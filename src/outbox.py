@@ -0,0 +1,150 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from typing import Any, AsyncIterator, Callable, Coroutine, Optional, Union
+
+from telegram import Bot
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import registry as metrics
+
+# limits of the telegram bot api: about 30 messages per second overall, one per second per chat and 20 per minute per group
+DEFAULT_GLOBAL_RATE = 30.0
+DEFAULT_CHAT_RATE = 1.0
+DEFAULT_GROUP_RATE = 20 / 60
+DEFAULT_MAX_RETRIES = 3
+CHAT_BURST = 3
+# buckets of chats that didn't send anything for this long are dropped
+IDLE_BUCKET_TTL = 300.0
+# telegram shows the typing indicator for 5 seconds
+TYPING_INTERVAL = 4.5
+
+
+class TokenBucket:
+    """Lets "rate" requests per second through, with bursts of up to "capacity" requests.
+
+    Waiting requests are let through in the order they arrived.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> float:
+        """Waits for a token and returns how long that took."""
+        start = time.monotonic()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                elif self.tokens < 1:
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+                else:
+                    self.tokens -= 1
+                    return time.monotonic() - start
+
+    def pause(self, seconds: float) -> None:
+        """Lets nothing through for the given time, e.g. when telegram asked to retry after it."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    def idle(self, now: float) -> bool:
+        return not self._lock.locked() and now - self.updated > IDLE_BUCKET_TTL
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    # newer versions of python-telegram-bot give a timedelta instead of seconds
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+
+class Outbox(BaseRateLimiter[None]):
+    """Sends every request of the bot to telegram within the flood limits of the bot api.
+
+    Requests to a chat wait for the bucket of the chat (one per second for private chats, slower for groups)
+    and then for the global bucket, so different chats proceed in parallel while each chat is throttled.
+    Requests of one chat go out in the order they were made.
+    If telegram answers with RetryAfter anyway, the chat (or all chats, for requests without a chat) is paused
+    for the requested time and the request is sent again, up to "max_retries" times.
+
+    The limits of the bot api apply to the bot as a whole. If the bot runs in "shards" processes, each with its own outbox,
+    every outbox gets its share of the global and group rates. Private chats only ever get messages from the shard
+    of their user, so they keep the full chat rate.
+    """
+
+    def __init__(self, global_rate: float = DEFAULT_GLOBAL_RATE, chat_rate: float = DEFAULT_CHAT_RATE, group_rate: float = DEFAULT_GROUP_RATE, max_retries: int = DEFAULT_MAX_RETRIES, shards: int = 1):
+        shards = max(1, shards)
+        self.global_rate = global_rate / shards
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate / shards
+        self.max_retries = max(0, max_retries)
+        self._global = TokenBucket(self.global_rate, self.global_rate)
+        self._chats: dict[Union[int, str], TokenBucket] = {}
+        self._last_cleanup = time.monotonic()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._chats.clear()
+
+    def _bucket(self, chat_id: Union[int, str]) -> TokenBucket:
+        now = time.monotonic()
+        if now - self._last_cleanup > IDLE_BUCKET_TTL:
+            self._last_cleanup = now
+            for idle_chat_id in [chat for chat, bucket in self._chats.items() if bucket.idle(now)]:
+                del self._chats[idle_chat_id]
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # group and channel ids are negative or usernames
+            private = isinstance(chat_id, int) and chat_id > 0
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate if private else self.group_rate, CHAT_BURST)
+        return bucket
+
+    async def process_request(self, callback: Callable[..., Coroutine[Any, Any, Any]], args: Any, kwargs: dict[str, Any], endpoint: str, data: dict[str, Any], rate_limit_args: Optional[None]) -> Any:
+        chat_id = data.get('chat_id')
+        # only requests that send something to a chat are limited, not e.g. getUpdates or getFile
+        bucket = self._bucket(chat_id) if chat_id is not None else None
+        for attempt in range(self.max_retries + 1):
+            if bucket is not None:
+                waited = await bucket.acquire() + await self._global.acquire()
+                metrics.observe('telegram_wait_seconds', waited, method=endpoint)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                metrics.inc('telegram_retry_after_total', method=endpoint)
+                if attempt >= self.max_retries:
+                    raise
+                seconds = retry_after_seconds(e)
+                print(f'telegram asked to retry {endpoint} after {seconds:.0f}s')
+                (bucket or self._global).pause(seconds)
+                if bucket is None:
+                    await asyncio.sleep(seconds)
+
+
+async def _keep_typing(bot: Bot, chat_id: int) -> None:
+    while True:
+        await asyncio.sleep(TYPING_INTERVAL)
+        try:
+            await bot.send_chat_action(chat_id=chat_id, action='typing')
+        except Exception as e:
+            print(f'could not send typing to {chat_id}: {e}')
+
+
+@asynccontextmanager
+async def typing(bot: Bot, chat_id: int) -> AsyncIterator[None]:
+    """Keeps the typing indicator of the chat alive while the block runs, the first one is sent by the handler itself."""
+    task = asyncio.ensure_future(_keep_typing(bot, chat_id))
+    try:
+        yield
+    finally:
+        task.cancel()
@@ -0,0 +1,68 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, TypeVar
+
+T = TypeVar('T')
+
+# keeps references to background tasks so they aren't garbage collected before they are done
+_background: set[asyncio.Task] = set()
+
+
+class Pipeline:
+    """The stages of a single request, e.g. handling a voice message.
+
+    Stages are timed and can be awaited directly (stage) or started to run alongside other stages (start).
+    Cleanup that the user doesn't have to wait for is deferred to background tasks (defer).
+    When the request is done, finish() reports the timings of all stages, including the deferred ones once they are done.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.timings: dict[str, float] = {}
+        self._started = time.monotonic()
+        self._deferred: list[asyncio.Task] = []
+
+    async def stage(self, name: str, awaitable: Awaitable[T]) -> T:
+        start = time.monotonic()
+        try:
+            return await awaitable
+        finally:
+            self.timings[name] = time.monotonic() - start
+
+    def start(self, name: str, awaitable: Awaitable[T]) -> 'asyncio.Task[T]':
+        """Starts a stage in the background, await the returned task to get its result.
+
+        If the request ends early and the task is never awaited, its errors are dropped silently.
+        """
+        task = asyncio.ensure_future(self.stage(name, awaitable))
+        task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return task
+
+    def defer(self, name: str, awaitable: Awaitable[Any]) -> None:
+        """Runs a stage in the background without anyone waiting for it, errors are only printed."""
+        async def run():
+            try:
+                await self.stage(name, awaitable)
+            except Exception as e:
+                print(f'{self.name}: deferred stage {name} failed: {e}')
+        task = asyncio.ensure_future(run())
+        self._deferred.append(task)
+        _background.add(task)
+        task.add_done_callback(_background.discard)
+
+    def finish(self, report: Callable[['Pipeline'], None]) -> None:
+        """Calls report with this pipeline once all deferred stages are done."""
+        total = time.monotonic() - self._started
+
+        async def run():
+            if self._deferred:
+                await asyncio.gather(*self._deferred, return_exceptions=True)
+            self.timings['total'] = total
+            report(self)
+        task = asyncio.ensure_future(run())
+        _background.add(task)
+        task.add_done_callback(_background.discard)
+
+    def summary(self) -> str:
+        return ' '.join(f'{name}={seconds:.3f}s' for name, seconds in self.timings.items())
+
@@ -0,0 +1,174 @@
+import asyncio
+import random
+import threading
+import time
+from typing import Awaitable, Callable, Optional, TypeVar
+
+T = TypeVar('T')
+
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BASE_DELAY = 0.5
+DEFAULT_MAX_DELAY = 8.0
+DEFAULT_DEADLINE = 60.0
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30.0
+
+# http status codes that mean the upstream might answer if it is asked again later
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+# exceptions of the upstream libraries that mean the upstream is overloaded or unreachable, found by name so the libraries don't have to be imported here
+RETRYABLE_ERROR_NAMES = {'ModelOverloadedError', 'ChatError', 'TooManyRequestsException', 'ConnectionException', 'TransportError'}
+
+
+class RetryableError(Exception):
+    """Raised by calls to mark a failure as temporary, e.g. an empty response of the chatbot."""
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling an upstream that failed too often recently."""
+
+    def __init__(self, service: str, retry_in: float):
+        super().__init__(f'{service} is unavailable, trying again in {retry_in:.0f}s')
+        self.service = service
+        self.retry_in = retry_in
+
+
+def _status_code(error: BaseException) -> Optional[int]:
+    """Returns the http status code of an error of httpx, requests or deepl, if it has one."""
+    response = getattr(error, 'response', None)
+    status_code = getattr(response, 'status_code', None) or getattr(error, 'http_status_code', None)
+    return status_code if isinstance(status_code, int) else None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Returns whether a failed call is worth trying again, i.e. whether the error is temporary."""
+    if isinstance(error, RetryableError):
+        return True
+    status_code = _status_code(error)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES
+    if isinstance(error, (ConnectionError, TimeoutError, asyncio.TimeoutError)):
+        return True
+    # requests exceptions are OSErrors as well
+    if isinstance(error, OSError) and type(error).__module__.startswith(('requests', 'urllib3')):
+        return True
+    return any(cls.__name__ in RETRYABLE_ERROR_NAMES for cls in type(error).__mro__)
+
+
+class RetryPolicy:
+    """How often and how long a failed call is tried again.
+
+    Retryable errors are retried up to "max_attempts" times with exponential backoff and full jitter,
+    i.e. a random delay of up to base_delay * 2^n seconds, capped at "max_delay".
+    No new attempt is started after "deadline" seconds since the first one, attempts that are already running aren't cut short though.
+    """
+
+    def __init__(self, max_attempts: int = DEFAULT_MAX_ATTEMPTS, base_delay: float = DEFAULT_BASE_DELAY, max_delay: float = DEFAULT_MAX_DELAY, deadline: float = DEFAULT_DEADLINE):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = max(0.0, base_delay)
+        self.max_delay = max(0.0, max_delay)
+        self.deadline = max(0.0, deadline)
+
+    def delay(self, attempt: int) -> float:
+        """Returns how long to wait after the given failed attempt, counting from 1."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """Fails fast while an upstream service is down.
+
+    After "failure_threshold" retryable failures in a row the circuit opens and calls raise CircuitOpen right away.
+    After "reset_timeout" seconds it is half open and lets a single probe call through:
+    if the probe succeeds the circuit closes again, otherwise it opens for another "reset_timeout" seconds.
+    """
+
+    def __init__(self, service: str, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD, reset_timeout: float = DEFAULT_RESET_TIMEOUT):
+        self.service = service
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = max(0.0, reset_timeout)
+        self.failures = 0
+        self.opened = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if self._probing or time.monotonic() - self._opened_at < self.reset_timeout:
+                return 'open'
+            return 'half-open'
+
+    def acquire(self) -> bool:
+        """Raises CircuitOpen if calls aren't let through right now, returns whether the call is the probe of a half open circuit."""
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            retry_in = self._opened_at + self.reset_timeout - time.monotonic()
+            if retry_in > 0 or self._probing:
+                raise CircuitOpen(self.service, max(0.0, retry_in))
+            self._probing = True
+            return True
+
+    def success(self, probe: bool = False) -> None:
+        with self._lock:
+            self.failures = 0
+            if probe or not self._probing:
+                self._opened_at = None
+                self._probing = False
+
+    def failure(self, probe: bool = False) -> None:
+        with self._lock:
+            self.failures += 1
+            if probe:
+                self._probing = False
+                self._opened_at = time.monotonic()
+            elif self._opened_at is None and self.failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self.opened += 1
+                print(f'{self.service} failed {self.failures} times in a row, not calling it for {self.reset_timeout:.0f}s')
+
+    def release(self, probe: bool) -> None:
+        """Ends a probe that neither succeeded nor failed because of the upstream, e.g. a fatal error caused by the request."""
+        if probe:
+            with self._lock:
+                self._probing = False
+
+
+async def call(func: Callable[[], Awaitable[T]], policy: RetryPolicy, breaker: Optional[CircuitBreaker] = None, on_retry: Optional[Callable[[Exception], None]] = None) -> T:
+    """Awaits func() until it succeeds, retrying retryable errors according to the policy.
+
+    Fatal errors and the last retryable error are raised, CircuitOpen is raised while the breaker is open.
+    on_retry is called with the error before every retry.
+    """
+    deadline = time.monotonic() + policy.deadline
+    attempt = 0
+    while True:
+        attempt += 1
+        probe = breaker.acquire() if breaker else False
+        try:
+            result = await func()
+        except Exception as e:
+            if not is_retryable(e):
+                if breaker:
+                    breaker.release(probe)
+                raise
+            if breaker:
+                breaker.failure(probe)
+            delay = policy.delay(attempt)
+            if attempt >= policy.max_attempts or time.monotonic() + delay >= deadline:
+                raise
+            print(f'attempt {attempt} of {breaker.service if breaker else "call"} failed, trying again in {delay:.1f}s: {e}')
+            if on_retry:
+                on_retry(e)
+            await asyncio.sleep(delay)
+        except BaseException:
+            # e.g. cancelled, which says nothing about the upstream
+            if breaker:
+                breaker.release(probe)
+            raise
+        else:
+            if breaker:
+                breaker.success(probe)
+            return result
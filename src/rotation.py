@@ -0,0 +1,45 @@
+from typing import Optional
+
+from user_data import UserData
+
+DEFAULT_SUMMARY_CHARS = 1000
+# the seed of a new conversation counts as a turn, so fewer turns would rotate after every message
+MIN_ROTATE_TURNS = 2
+# the same goes for a context that isn't much larger than the summary it starts with
+MIN_ROTATE_CHARS_FACTOR = 4
+SUMMARY_TEMPERATURE = 0.2
+
+
+def due(user_data: UserData) -> Optional[str]:
+    """Returns why the conversation of the user should be rotated now ('turns' or 'context'), or None if it shouldn't."""
+    if user_data.rotate_turns and user_data.turns >= user_data.rotate_turns:
+        return 'turns'
+    if user_data.rotate_chars and user_data.context_chars >= user_data.rotate_chars:
+        return 'context'
+    return None
+
+
+def describe(turns: int, chars: int) -> str:
+    """Describes rotation thresholds for the user, e.g. "20 turns or about 20000 characters"."""
+    limits = [f'{turns} turns' if turns else '', f'about {chars} characters' if chars else '']
+    return ' or '.join(limit for limit in limits if limit) or 'off'
+
+
+def summary_prompt(max_chars: int) -> str:
+    return (f'Summarize our conversation so far in at most {max_chars} characters. '
+            'Keep names, facts, decisions and open questions and leave out greetings. Answer only with the summary.')
+
+
+def seed_prompt(summary: str) -> str:
+    return (f'This conversation continues an earlier one, here is a summary of it:\n\n{summary}\n\n'
+            'Keep it in mind for my next messages and answer this one only with "OK".')
+
+
+def shorten(summary: str, max_chars: int) -> str:
+    """Cuts the summary at the last sentence or word that fits, in case the chatbot ignored the limit."""
+    summary = summary.strip()
+    if len(summary) <= max_chars:
+        return summary
+    cut = summary[:max_chars]
+    end = max(cut.rfind('. '), cut.rfind('\n'))
+    return cut[:end + 1].strip() if end > max_chars // 2 else cut.rsplit(' ', 1)[0]
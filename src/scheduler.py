@@ -0,0 +1,157 @@
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable, Optional
+
+DEFAULT_MAX_CONCURRENT = 8
+DEFAULT_MAX_QUEUED = 3
+
+
+class QueueFull(Exception):
+    """Raised when a user already has the maximum number of requests waiting."""
+
+    def __init__(self, queued: int):
+        super().__init__(f'{queued} requests are already queued')
+        self.queued = queued
+
+
+class RequestCancelled(Exception):
+    """Raised by submit when the request was cancelled before or while it ran."""
+
+
+class _Job:
+    def __init__(self, func: Callable[[], Awaitable[Any]], future: asyncio.Future, supersede: bool = False):
+        self.func = func
+        self.future = future
+        # only jobs that supersede others can be superseded themselves, e.g. a prompt but not /delete
+        self.supersede = supersede
+
+
+class Scheduler:
+    """Runs the requests of every user one after another and limits how many requests run at the same time.
+
+    Every user has a FIFO queue of requests, so requests of the same user never run concurrently.
+    At most "max_concurrent" requests run at once. When a slot gets free, the next request is taken from
+    the users in round robin order, so a user with many queued requests can't starve the others.
+    A user can have at most "max_queued" requests waiting, further requests are rejected with QueueFull.
+    Requests can be cancelled (cancel), a running request is cancelled right away so its slot goes to the next request.
+    A request submitted with supersede replaces the waiting requests of the same user that were submitted with supersede as well.
+    """
+
+    def __init__(self, max_concurrent: int = DEFAULT_MAX_CONCURRENT, max_queued: int = DEFAULT_MAX_QUEUED):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queued = max(0, max_queued)
+        self._queues: dict[int, deque[_Job]] = {}
+        # users that have queued requests and none running, in the order they get their turn
+        self._ready: deque[int] = deque()
+        self._running_users: set[int] = set()
+        self._tasks: dict[int, asyncio.Task] = {}
+        self.cancelled = 0
+
+    @property
+    def running(self) -> int:
+        return len(self._running_users)
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def busy(self, user_id: int) -> bool:
+        """Tells whether the user has a request running or waiting, safe to call from other threads."""
+        return user_id in self._running_users or bool(self._queues.get(user_id))
+
+    async def submit(self, user_id: int, func: Callable[[], Awaitable[Any]], on_queued: Optional[Callable[[int], Awaitable[Any]]] = None, *, supersede: bool = False) -> Any:
+        """Runs func when it's the user's turn and returns its result.
+
+        If the request can't start right away, on_queued is awaited with its position in line (1 is next), errors of it are only logged.
+        With supersede, the requests of the user that didn't start yet and were submitted with supersede are cancelled in favor of this one.
+        Raises RequestCancelled if the request is cancelled.
+        """
+        if supersede:
+            self._supersede(user_id)
+        queue = self._queues.setdefault(user_id, deque())
+        if len(queue) >= self.max_queued and (queue or user_id in self._running_users):
+            raise QueueFull(len(queue))
+        job = _Job(func, asyncio.get_running_loop().create_future(), supersede)
+        queue.append(job)
+        if user_id not in self._running_users and user_id not in self._ready:
+            self._ready.append(user_id)
+        self._dispatch()
+        if not job.future.done() and job in queue and on_queued:
+            try:
+                await on_queued(self._position(user_id, job))
+            except Exception as e:
+                # the request still runs, only the notice about it is lost
+                print(f'could not notify user {user_id} about their queued request: {e!r}')
+        return await job.future
+
+    def cancel(self, user_id: int) -> int:
+        """Cancels the queued requests of the user and the one that is running, returning how many were cancelled."""
+        cancelled = self._drop_queued(user_id, lambda job: True)
+        task = self._tasks.get(user_id)
+        if task and not task.done():
+            task.cancel()
+            cancelled += 1
+            self.cancelled += 1
+        return cancelled
+
+    def _supersede(self, user_id: int) -> int:
+        return self._drop_queued(user_id, lambda job: job.supersede)
+
+    def _drop_queued(self, user_id: int, predicate: Callable[[_Job], bool]) -> int:
+        queue = self._queues.get(user_id)
+        if not queue:
+            return 0
+        dropped = [job for job in queue if predicate(job)]
+        kept = deque(job for job in queue if not predicate(job))
+        for job in dropped:
+            if not job.future.done():
+                job.future.set_exception(RequestCancelled('cancelled before it started'))
+        if kept:
+            self._queues[user_id] = kept
+        else:
+            del self._queues[user_id]
+            if user_id in self._ready:
+                self._ready.remove(user_id)
+        self.cancelled += len(dropped)
+        return len(dropped)
+
+    def _position(self, user_id: int, job: _Job) -> int:
+        queue = self._queues[user_id]
+        if user_id in self._running_users:
+            return queue.index(job) + 1
+        return self._ready.index(user_id) + 1 + queue.index(job)
+
+    def _dispatch(self) -> None:
+        while self._ready and len(self._running_users) < self.max_concurrent:
+            user_id = self._ready.popleft()
+            queue = self._queues[user_id]
+            job = queue.popleft()
+            if job.future.cancelled():
+                self._requeue(user_id)
+                continue
+            self._running_users.add(user_id)
+            self._tasks[user_id] = asyncio.get_running_loop().create_task(self._run(user_id, job))
+
+    async def _run(self, user_id: int, job: _Job) -> None:
+        try:
+            result = await job.func()
+        except asyncio.CancelledError:
+            if not job.future.done():
+                job.future.set_exception(RequestCancelled('cancelled while it ran'))
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._running_users.discard(user_id)
+            self._tasks.pop(user_id, None)
+            self._requeue(user_id)
+            self._dispatch()
+
+    def _requeue(self, user_id: int) -> None:
+        if self._queues.get(user_id):
+            self._ready.append(user_id)
+        else:
+            self._queues.pop(user_id, None)
@@ -0,0 +1,66 @@
+import asyncio
+import multiprocessing
+from multiprocessing.context import SpawnProcess
+from typing import Any, Callable, Optional
+
+DEFAULT_SHARDS = 1
+STOP_TIMEOUT = 30.0
+
+
+def shard_of(user_id: Optional[int], shards: int) -> int:
+    """Returns the shard of a user, updates without a user go to the first shard.
+
+    Telegram user ids are integers, so the id modulo the number of shards is stable across processes and restarts,
+    unlike hash() of other types.
+    """
+    if user_id is None:
+        return 0
+    return user_id % shards
+
+
+class ShardRouter:
+    """Runs a worker process per shard and hands every update to the worker that owns its user.
+
+    Each worker gets its own bounded queue and the updates of a user always go to the same worker,
+    so they are handled in the order they arrived and only one process ever touches the state of a user.
+    target is called in the new process with the shard, the number of shards and the queue of the shard,
+    it gets None from the queue when it should stop. Workers that died are started again when they get their next update.
+    """
+
+    def __init__(self, shards: int, target: Callable[[int, int, Any], None], max_pending: int):
+        self.shards = max(1, shards)
+        self.target = target
+        # spawn instead of fork, the front process already has threads running
+        self._context = multiprocessing.get_context('spawn')
+        self._queues = [self._context.Queue(max(1, max_pending)) for _ in range(self.shards)]
+        self._processes: list[Optional[SpawnProcess]] = [None] * self.shards
+
+    def start(self) -> None:
+        for shard in range(self.shards):
+            self._start(shard)
+
+    def _start(self, shard: int) -> None:
+        process = self._context.Process(target=self.target, args=(shard, self.shards, self._queues[shard]), name=f'telechat-shard-{shard}')
+        process.start()
+        self._processes[shard] = process
+
+    async def route(self, user_id: Optional[int], update: dict) -> None:
+        """Hands the update to the worker of the user, waiting while its queue is full."""
+        shard = shard_of(user_id, self.shards)
+        process = self._processes[shard]
+        if process is not None and not process.is_alive():
+            print(f'worker of shard {shard} died with exit code {process.exitcode}, starting it again')
+            self._start(shard)
+        await asyncio.get_running_loop().run_in_executor(None, self._queues[shard].put, update)
+
+    def stop(self, timeout: float = STOP_TIMEOUT) -> None:
+        """Lets the workers finish the updates they already got and waits for them to exit."""
+        for queue in self._queues:
+            queue.put(None)
+        for shard, process in enumerate(self._processes):
+            if process is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                print(f'worker of shard {shard} did not stop in time, terminating it')
+                process.terminate()
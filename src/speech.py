@@ -0,0 +1,124 @@
+import hashlib
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Callable, Optional
+
+import httpx
+
+DEFAULT_MAX_DURATION = 600
+DEFAULT_MAX_BYTES = 20 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+
+
+class AudioTooLarge(Exception):
+    """Raised when a voice message is longer or bigger than the transcriber accepts."""
+
+
+class DownloadError(ConnectionError):
+    """Raised when a voice message can't be downloaded from the telegram file server.
+
+    The url of a telegram file contains the bot token, so unlike the errors of httpx the message never contains the url.
+    """
+
+    def __init__(self, message: str, http_status_code: Optional[int] = None):
+        super().__init__(message)
+        # the retry policy decides by the status code whether to try again
+        self.http_status_code = http_status_code
+
+
+class Transcription:
+    def __init__(self, transcript: str, language: str, content_hash: str):
+        self.transcript = transcript
+        self.language = language
+        self.content_hash = content_hash
+
+
+class SttBackend(ABC):
+    """Interface of speech to text backends.
+
+    A backend gets the audio as a stream of chunks while it is still being downloaded
+    and returns the transcript together with the detected language as a DeepL language code.
+    """
+
+    @abstractmethod
+    async def transcribe(self, chunks: AsyncIterator[bytes], mimetype: str) -> tuple[str, str]:
+        ...
+
+    async def close(self) -> None:
+        pass
+
+
+class DeepgramBackend(SttBackend):
+    """Transcribes audio with the prerecorded audio api of Deepgram, or any server speaking the same api at "url"."""
+
+    DEFAULT_URL = 'https://api.deepgram.com/v1/listen'
+
+    def __init__(self, api_token: str, url: Optional[str] = None):
+        self.url = url or self.DEFAULT_URL
+        self._client = httpx.AsyncClient(headers={'Authorization': f'Token {api_token}'}, timeout=TIMEOUT)
+
+    async def transcribe(self, chunks: AsyncIterator[bytes], mimetype: str) -> tuple[str, str]:
+        response = await self._client.post(self.url, params={'detect_language': 'true'}, headers={'Content-Type': mimetype}, content=chunks)
+        response.raise_for_status()
+        channel = response.json()['results']['channels'][0]
+        transcript = channel['alternatives'][0]['transcript']
+        detected_language = channel.get('detected_language') or 'en'
+        detected_language = 'EN-US' if detected_language == 'en' else detected_language.upper()
+        return transcript, detected_language
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+
+# backends that can be chosen with "stt_backend" in the config, each is created with the config
+BACKENDS: dict[str, Callable[[dict], Optional[SttBackend]]] = {
+    'deepgram': lambda config: DeepgramBackend(config['deepgram_api_token'], config.get('stt_url')) if config.get('deepgram_api_token') else None,
+}
+
+
+def register_backend(name: str, factory: Callable[[dict], Optional[SttBackend]]) -> None:
+    BACKENDS[name] = factory
+
+
+class Transcriber:
+    """Streams telegram voice messages from the telegram file server straight into a speech to text backend.
+
+    The audio is never held in memory as a whole, only chunk by chunk.
+    Voice messages longer than "max_duration" seconds or bigger than "max_bytes" are rejected with AudioTooLarge.
+    """
+
+    def __init__(self, backend: SttBackend, max_duration: int = DEFAULT_MAX_DURATION, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.backend = backend
+        self.max_duration = max_duration
+        self.max_bytes = max_bytes
+        self._client = httpx.AsyncClient(timeout=TIMEOUT)
+
+    async def transcribe_url(self, url: str, *, duration: Optional[int] = None, file_size: Optional[int] = None, mimetype: str = 'audio/ogg') -> Transcription:
+        if duration and duration > self.max_duration:
+            raise AudioTooLarge(f'voice message is {duration}s long, the maximum is {self.max_duration}s')
+        if file_size and file_size > self.max_bytes:
+            raise AudioTooLarge(f'voice message has {file_size} bytes, the maximum is {self.max_bytes} bytes')
+        content_hash = hashlib.sha256()
+
+        async def chunks() -> AsyncIterator[bytes]:
+            received = 0
+            try:
+                async with self._client.stream('GET', url) as response:
+                    if response.is_error:
+                        raise DownloadError(f'telegram file server answered {response.status_code}', response.status_code)
+                    async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                        received += len(chunk)
+                        if received > self.max_bytes:
+                            raise AudioTooLarge(f'voice message has more than {self.max_bytes} bytes')
+                        content_hash.update(chunk)
+                        yield chunk
+            except httpx.HTTPError as e:
+                # not chained, the traceback would show the url
+                raise DownloadError(f'could not download voice message: {type(e).__name__}') from None
+
+        transcript, language = await self.backend.transcribe(chunks(), mimetype)
+        return Transcription(transcript, language, content_hash.hexdigest())
+
+    async def close(self) -> None:
+        await self._client.aclose()
+        await self.backend.close()
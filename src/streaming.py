@@ -0,0 +1,68 @@
+import textwrap
+import time
+from typing import Optional
+
+from telegram import Bot, Message
+
+MESSAGE_CHUNK_SIZE = 3500
+DEFAULT_EDIT_INTERVAL = 1.5
+PLACEHOLDER = '...'
+
+
+def wrap_message(text: str) -> list[str]:
+    """Splits a text into parts that fit into a single telegram message."""
+    return textwrap.wrap(text, MESSAGE_CHUNK_SIZE, expand_tabs=False, replace_whitespace=False, break_long_words=False, break_on_hyphens=False)
+
+
+class StreamedReply:
+    """A reply that is sent as a placeholder and then progressively edited while the text is streamed in.
+
+    Edits are throttled to at most one per "edit_interval" seconds.
+    Once the text exceeds the chunk size, the reply rolls over to a new message.
+    The messages always end up with the same parts as sending the whole text at once would.
+    """
+
+    def __init__(self, bot: Bot, chat_id: int, reply_to_message_id: Optional[int], *, prefix: str = '', edit_interval: float = DEFAULT_EDIT_INTERVAL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.reply_to_message_id = reply_to_message_id
+        self.prefix = prefix
+        self.edit_interval = edit_interval
+        self.text = ''
+        self.messages: list[Message] = []
+        self.sent_parts: list[str] = []
+        self.last_flush = 0.0
+
+    async def start(self) -> None:
+        """Sends the placeholder message."""
+        if self.messages:
+            return
+        message = await self.bot.send_message(chat_id=self.chat_id, text=self.prefix + PLACEHOLDER, reply_to_message_id=self.reply_to_message_id)
+        self.messages.append(message)
+        self.sent_parts.append(self.prefix + PLACEHOLDER)
+        self.last_flush = time.monotonic()
+
+    async def update(self, text: str) -> None:
+        """Sets the text streamed so far and edits the messages if the last edit is long enough ago."""
+        self.text = text
+        if time.monotonic() - self.last_flush >= self.edit_interval:
+            await self.flush()
+
+    async def finish(self, text: Optional[str] = None) -> None:
+        """Sets the final text and makes sure it is completely sent."""
+        if text is not None:
+            self.text = text
+        await self.flush()
+
+    async def flush(self) -> None:
+        await self.start()
+        parts = wrap_message(self.prefix + self.text) or [self.prefix + PLACEHOLDER]
+        for part_index, part in enumerate(parts):
+            if part_index < len(self.messages):
+                if self.sent_parts[part_index] != part:
+                    await self.messages[part_index].edit_text(part)
+                    self.sent_parts[part_index] = part
+            else:
+                self.messages.append(await self.bot.send_message(chat_id=self.chat_id, text=part))
+                self.sent_parts.append(part)
+        self.last_flush = time.monotonic()
@@ -1,73 +1,383 @@
+import asyncio
+import functools
+import multiprocessing
 from html import escape
-import io
 import os
-import textwrap
+import secrets
+import signal
+import time
 from typing import Optional
 from uuid import uuid4
 
 import loader
+import rotation
+import streaming
+import upstream
+from speech import AudioTooLarge
+from coalescer import DEFAULT_MAX_WINDOW as DEFAULT_MAX_COALESCE_WINDOW, Coalescer
+from metrics import registry as metrics, serve as serve_metrics
+from outbox import DEFAULT_CHAT_RATE, DEFAULT_GLOBAL_RATE, DEFAULT_GROUP_RATE, DEFAULT_MAX_RETRIES as DEFAULT_TELEGRAM_MAX_RETRIES, Outbox, typing
+from pipeline import Pipeline
+from retry import CircuitOpen, RetryableError
+from scheduler import DEFAULT_MAX_QUEUED, QueueFull, RequestCancelled, Scheduler
+from sharding import DEFAULT_SHARDS, ShardRouter
 from loader import auth, admin
 
-from telegram import InlineQueryResultArticle, InputTextMessageContent, Update
-from telegram.ext import filters, MessageHandler, ApplicationBuilder, ContextTypes, CommandHandler, InlineQueryHandler
-from telegram.constants import ParseMode
+from telegram import InlineQueryResultArticle, InputTextMessageContent, Update, Voice
+from telegram.ext import filters, Application, BaseHandler, MessageHandler, ApplicationBuilder, ContextTypes, CommandHandler, InlineQueryHandler, TypeHandler
+from telegram.constants import ParseMode, UpdateType
+from telegram.request import HTTPXRequest
 from hugchat import hugchat
-from deepl import Translator, TextResult
-from deepgram import Deepgram
 
+from translation import SharedTranslator
 from user_data import UserData
 
 os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-MAX_RESPONSE_TRIES = 5
+GIBBERISH_MESSAGE = 'Only gibberish as response even after several tries.. The model is probably overloaded.. Sorry :( You can try again though'
+STOPPED_MARKER = '[stopped]'
 LANG_NAMES: str = '\n'.join(['BG - Bulgarian', 'CS - Czech', 'DA - Danish', 'DE - German', 'EL - Greek', 'EN-GB - English (British)', 'EN-US - English (American)', 'ES - Spanish', 'ET - Estonian', 'FI - Finnish', 'FR - French', 'HU - Hungarian', 'ID - Indonesian', 'IT - Italian', 'JA - Japanese', 'KO - Korean', 'LT - Lithuanian', 'LV - Latvian', 'NB - Norwegian (Bokmål)', 'NL - Dutch', 'PL - Polish', 'PT-BR - Portuguese (Brazilian)', 'PT-PT - Portuguese (all other Portuguese varieties)', 'RO - Romanian', 'RU - Russian', 'SK - Slovak', 'SL - Slovenian', 'SV - Swedish', 'TR - Turkish', 'UK - Ukrainian', 'ZH - Chinese (simplified)'])
+DEFAULT_MAX_PENDING_UPDATES = 100
+DEFAULT_WEBHOOK_PORT = 8443
+DEFAULT_WEBHOOK_PATH = 'telegram'
+# update types each kind of handler can handle, telegram isn't asked for any others
+# (command and message handlers take edited messages as well, so an edited message is answered again)
+HANDLER_UPDATE_TYPES = {
+    CommandHandler: [UpdateType.MESSAGE, UpdateType.EDITED_MESSAGE],
+    MessageHandler: [UpdateType.MESSAGE, UpdateType.EDITED_MESSAGE],
+    InlineQueryHandler: [UpdateType.INLINE_QUERY],
+}
 LANG_CODES = ['BG','CS','DA','DE','EL','EN-GB','EN-US','ES','ET','FI','FR','HU','ID','IT','JA','KO','LT','LV','NB','NL','PL','PT-BR','PT-PT','RO','RU','SK','SL','SV','TR','UK','ZH']
 
 
 
-def get_response(chatbot: hugchat.ChatBot, temperature: float, text: str) -> str:
-    # try to get a response from the chatbot
-    tries_remaining = MAX_RESPONSE_TRIES
+_scheduler: Optional[Scheduler] = None
+_coalescer: Optional[Coalescer[Update]] = None
+# user data that is being loaded for arriving updates and how many updates wait for it, keyed by user id
+_user_loads: dict[int, 'asyncio.Future[UserData]'] = {}
+_user_load_waiters: dict[int, int] = {}
+
+
+def get_scheduler() -> Scheduler:
+    """Returns the request scheduler, its limits are read from the config when it is created."""
+    global _scheduler
+    if _scheduler is None:
+        config = loader.load_config()
+        max_concurrent = int(config.get('max_concurrent_requests') or config.get('upstream_workers') or upstream.DEFAULT_WORKERS)
+        max_queued = config.get('max_queued_requests')
+        _scheduler = Scheduler(max_concurrent, DEFAULT_MAX_QUEUED if max_queued is None else int(max_queued))
+        loader.keep_busy_users(_scheduler.busy)
+    return _scheduler
+
+
+class TimedRequest(HTTPXRequest):
+    """Times every request to the telegram bot api per api method, e.g. sendMessage."""
+
+    async def do_request(self, url: str, *args, **kwargs):
+        with metrics.timer('telegram_seconds', method=url.rsplit('/', 1)[-1]):
+            return await super().do_request(url, *args, **kwargs)
+
+
+def instrumented(handler):
+    """Times the handler and counts the errors it raises."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        start = time.monotonic()
+        try:
+            return await handler(update, context)
+        except Exception:
+            metrics.inc('handler_errors_total', handler=handler.__name__)
+            raise
+        finally:
+            metrics.observe('handler_seconds', time.monotonic() - start, handler=handler.__name__)
+    return wrapper
+
+
+def register_gauges() -> None:
+    """Registers the queue lengths and cache statistics that are read when the metrics are shown."""
+    metrics.gauge('scheduler_running', lambda: get_scheduler().running)
+    metrics.gauge('scheduler_queued', lambda: get_scheduler().queued)
+    metrics.gauge('pending_conversation_deletions', lambda: len(loader.conversation_collector().pending()))
+    metrics.gauge('coalesced_messages', lambda: get_coalescer().coalesced)
+    caches = {
+        'users': (lambda: loader.user_cache().stats(), ('hits', 'misses', 'evictions')),
+        'translations': (lambda: translator.stats() if (translator := loader.shared_translator()) else {}, ('hits', 'misses')),
+        'transcripts': (lambda: loader.transcript_cache().stats(), ('file_hits', 'misses')),
+    }
+    for cache, (cache_stats, names) in caches.items():
+        for name in names:
+            metrics.gauge(f'cache_{name}', functools.partial(lambda cache_stats, name: cache_stats().get(name, 0), cache_stats, name), cache=cache)
+    for service in (upstream.HUGCHAT, upstream.DEEPL, upstream.SPEECH_TO_TEXT):
+        metrics.gauge('circuit_open', functools.partial(lambda service: loader.circuit_breaker(service).state != 'closed', service), service=service)
+
+
+def max_coalesce_window() -> int:
+    return int(loader.cached_config().get('max_coalesce_window') or DEFAULT_MAX_COALESCE_WINDOW)
+
+
+def get_coalescer() -> Coalescer[Update]:
+    """Returns the coalescer of text messages, a batch is held back at most twice the longest allowed window."""
+    global _coalescer
+    if _coalescer is None:
+        _coalescer = Coalescer(max_wait=max_coalesce_window() / 1000 * 2)
+    return _coalescer
+
+
+async def arriving_user_data(update: Update) -> UserData:
+    """Returns the user data for an update that just arrived, keeping the order in which the updates of a user arrived.
+
+    A cached user is returned right away. Otherwise all updates of the user wait for the same load and continue in the order they arrived,
+    so they can't overtake each other on the local pool.
+    """
+    user_id = update.effective_user.id
+    loading = _user_loads.get(user_id)
+    if loading is None:
+        user_data = loader.user_cache().peek(user_id)
+        if user_data is not None:
+            return user_data
+        loading = _user_loads[user_id] = asyncio.ensure_future(upstream.run_local(loader.update_user_data, update))
+    _user_load_waiters[user_id] = _user_load_waiters.get(user_id, 0) + 1
+    try:
+        # a cancelled update doesn't cancel the load for the others
+        return await asyncio.shield(loading)
+    finally:
+        # updates that arrive until the last waiting one went on wait as well, so they can't overtake it
+        _user_load_waiters[user_id] -= 1
+        if not _user_load_waiters[user_id]:
+            del _user_load_waiters[user_id]
+            del _user_loads[user_id]
+
+
+def coalesced(handler):
+    """Merges text messages that a user sends within their coalescing window into one prompt, which is answered in reply to the last message.
+
+    Apply it on top of scheduled, so only the merged prompt is queued. Messages reach the scheduler in the order they arrived.
+    """
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        # let the handler itself deal with updates it won't answer
+        if not update.effective_user or not update.effective_message or not update.effective_message.text or not auth(update, warning=False):
+            return await handler(update, context)
+        user_data = await arriving_user_data(update)
+        if not user_data.coalesce_window:
+            return await handler(update, context)
+        updates = await get_coalescer().add(update.effective_user.id, update, user_data.coalesce_window / 1000)
+        # a later message answers this one as well
+        if not updates:
+            return
+        if len(updates) == 1:
+            return await handler(update, context)
+        return await handler(update, context, text='\n'.join(queued.effective_message.text for queued in updates))
+    return wrapper
+
+
+def supersede_enabled() -> bool:
+    return bool(loader.cached_config().get('supersede_requests', True))
+
+
+def scheduled(handler=None, *, supersede: bool = False):
+    """Runs the handler through the request scheduler, so requests of a user are answered one after another.
+
+    With supersede, a new request replaces the requests of the user that are still waiting (if supersede_requests is enabled),
+    e.g. a corrected message replaces the one it corrects. Use it as @scheduled or @scheduled(supersede=True).
+    """
+    if handler is None:
+        return functools.partial(scheduled, supersede=supersede)
+
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, **kwargs):
+        # let the handler itself deal with updates it won't answer
+        if not update.effective_user or not update.effective_chat or not auth(update, warning=False):
+            return await handler(update, context, **kwargs)
+        chat_id = update.effective_chat.id
+        reply_to_message_id = update.effective_message.message_id if update.effective_message else None
+
+        async def on_queued(position: int):
+            await context.bot.send_message(chat_id=chat_id, text=f'Busy, your message is queued at position {position}', reply_to_message_id=reply_to_message_id)
+
+        async def run():
+            # answers can take much longer than the typing indicator lasts
+            async with typing(context.bot, chat_id):
+                return await handler(update, context, **kwargs)
+
+        try:
+            return await get_scheduler().submit(update.effective_user.id, run, on_queued, supersede=supersede and supersede_enabled())
+        except RequestCancelled:
+            # stopped with /stop or replaced by a newer message, the user knows
+            metrics.inc('cancelled_requests_total', handler=handler.__name__)
+        except QueueFull as e:
+            await context.bot.send_message(chat_id=chat_id, text=f'Busy, you already have {e.queued} messages waiting. Please try again once they are answered', reply_to_message_id=reply_to_message_id)
+        except CircuitOpen as e:
+            await context.bot.send_message(chat_id=chat_id, text=unavailable_message(e), reply_to_message_id=reply_to_message_id)
+    return wrapper
+
+
+class FallbackReply(str):
+    """A reply sent in place of an answer of the chatbot, e.g. because it is unavailable. It isn't part of the conversation."""
+
+
+async def get_response(chatbot: hugchat.ChatBot, temperature: float, text: str) -> str:
+    """Returns the response of the chatbot, retrying empty responses and temporary errors with backoff.
+
+    Raises CircuitOpen while HuggingChat is down.
+    """
+    async def attempt() -> str:
+        message = await upstream.chat(chatbot, text, temperature)
+        if not message:
+            raise RetryableError('empty response')
+        return message
+    try:
+        return await upstream.retrying(upstream.HUGCHAT, attempt)
+    except CircuitOpen:
+        raise
+    except Exception as e:
+        print(e)
+        return FallbackReply(GIBBERISH_MESSAGE)
+
+
+def unavailable_message(e: CircuitOpen) -> FallbackReply:
+    return FallbackReply(f'{e.service} is not reachable at the moment, so your message was not answered. Please try again in {int(e.retry_in) + 1} seconds')
+
+
+def streaming_enabled() -> bool:
+    return bool(loader.cached_config().get('stream_responses', True))
+
+
+async def stream_response(context: ContextTypes.DEFAULT_TYPE, chat_id: int, reply_to_message_id: Optional[int], chatbot: hugchat.ChatBot, temperature: float, text: str, *, prefix: str = '') -> str:
+    """Gets a response from the chatbot like get_response, but streams it into telegram while it is generated."""
+    edit_interval = float(loader.cached_config().get('stream_edit_interval') or streaming.DEFAULT_EDIT_INTERVAL)
+    reply = streaming.StreamedReply(context.bot, chat_id, reply_to_message_id, prefix=prefix, edit_interval=edit_interval)
+    await reply.start()
     message = ''
-    while not message and tries_remaining:
+
+    async def attempt() -> str:
+        nonlocal message
         try:
-            message = str(chatbot.chat(text, temperature=temperature))
+            async for token in upstream.stream_chat(chatbot, text, temperature):
+                message += token
+                await reply.update(message)
         except Exception as e:
-            print(e)
-            tries_remaining -= 1
-    if not message and not tries_remaining:
-        message = f'Only gibberish as response even after {MAX_RESPONSE_TRIES} tries.. The model is probably overloaded.. Sorry :( You can try again though'
+            # keep what was already streamed instead of starting over
+            if message:
+                print(e)
+                return message
+            raise
+        if not message:
+            raise RetryableError('empty response')
+        return message
+    try:
+        message = await upstream.retrying(upstream.HUGCHAT, attempt)
+    except asyncio.CancelledError:
+        # keep what was already streamed, so the user sees where it stopped
+        await reply.finish(f'{message} {STOPPED_MARKER}' if message else STOPPED_MARKER)
+        raise
+    except CircuitOpen as e:
+        message = unavailable_message(e)
+    except Exception as e:
+        print(e)
+        message = FallbackReply(GIBBERISH_MESSAGE)
+    await reply.finish(message)
     return message
 
 
-def reset_conversation(user_data: UserData, *, delete: bool) -> str:
-    old_conversation_id = user_data.chatbot.current_conversation
-    new_conversation_id = user_data.chatbot.new_conversation()
-    user_data.chatbot.change_conversation(new_conversation_id)
+async def reset_conversation(user_data: UserData, *, delete: bool) -> str:
+    chatbot = await upstream.chatbot(user_data)
+    old_conversation = chatbot.current_conversation
+    new_conversation = await upstream.new_conversation(chatbot)
+    await upstream.change_conversation(chatbot, new_conversation)
+    user_data.reset_turns()
     if delete:
-        user_data.chatbot.delete_conversation(old_conversation_id)
-    return old_conversation_id
+        loader.delete_conversation_later(chatbot, old_conversation)
+    return str(old_conversation)
+
 
+def rotation_summary_chars() -> int:
+    return int(loader.cached_config().get('rotation_summary_chars') or rotation.DEFAULT_SUMMARY_CHARS)
 
-def translate_text(text: str, target_lang: str, translator: Translator) -> tuple[str, str]:
-    response = translator.translate_text(text, target_lang=target_lang)
-    user_text = response.text if isinstance(response, TextResult) else response[0].text
-    detected_source_lang = response.detected_source_lang if isinstance(response, TextResult) else response[0].detected_source_lang
-    return user_text, detected_source_lang
 
+def count_turn(update: Update, user_data: UserData, text: str, answer: str) -> None:
+    """Counts a message and its answer towards the size of the conversation and rotates it once it is too large.
 
-def stt(audio: bytes) -> tuple[str, str]:
-    config = loader.load_config()
-    if not config.get('deepgram_api_token'):
+    The rotation runs after the answer was sent, as a request of its own in the scheduler.
+    Fallback replies aren't counted, the chatbot never saw them.
+    """
+    if isinstance(answer, FallbackReply):
+        return
+    user_data.record_turn(len(text) + len(answer))
+    reason = rotation.due(user_data)
+    if not reason or not update.effective_user:
+        return
+    user_id = update.effective_user.id
+
+    async def rotate_later():
+        try:
+            await get_scheduler().submit(user_id, lambda: rotate_conversation(update, reason))
+        except (QueueFull, RequestCancelled) as e:
+            # the next turn tries again
+            print(f'conversation of user {user_id} was not rotated: {e!r}')
+    pipeline = Pipeline('rotate_conversation')
+    pipeline.defer('rotate', rotate_later())
+    pipeline.finish(log_timings)
+
+
+async def rotate_conversation(update: Update, reason: str) -> None:
+    """Starts a new conversation for the user, seeded with a summary of the old one, which is deleted."""
+    user_data = await upstream.run_local(loader.update_user_data, update)
+    # the conversation was rotated or reset since this rotation was queued
+    if not rotation.due(user_data):
+        return
+    chatbot = await upstream.chatbot(user_data)
+    turns, context_chars = user_data.turns, user_data.context_chars
+    max_chars = rotation_summary_chars()
+    try:
+        summary = await upstream.retrying(upstream.HUGCHAT, lambda: upstream.chat(chatbot, rotation.summary_prompt(max_chars), rotation.SUMMARY_TEMPERATURE))
+        summary = rotation.shorten(summary, max_chars)
+    except CircuitOpen as e:
+        # keep the context, the next turn tries again
+        print(f'conversation of user {user_data.state.user_id} was not rotated: {e}')
+        return
+    except Exception as e:
+        print(f'could not summarize conversation {user_data.conversation_id}, rotating it without a summary: {e}')
+        summary = ''
+    old_conversation_id = await reset_conversation(user_data, delete=True)
+    if summary:
+        seed = rotation.seed_prompt(summary)
+        try:
+            answer = await upstream.retrying(upstream.HUGCHAT, lambda: upstream.chat(chatbot, seed, rotation.SUMMARY_TEMPERATURE))
+            user_data.record_turn(len(seed) + len(answer))
+        except Exception as e:
+            print(f'could not seed conversation {user_data.conversation_id} with the summary: {e}')
+    user_data.rotations += 1
+    await upstream.run_local(loader.update_user_data, update)
+    metrics.inc('conversation_rotations_total', reason=reason)
+    log_ctx = loader.log_context(update, user_data)
+    text = f'rotation {user_data.rotations} after {turns} turns and about {context_chars} characters ({reason}), from {old_conversation_id} to {user_data.conversation_id}'
+    loader.log(update, ctx=log_ctx, filename=old_conversation_id, title='conversation rotated', message=text)
+    loader.log(update, ctx=log_ctx, title='conversation rotated', message=text + (f'\n\nsummary:\n{summary}' if summary else ''))
+
+
+async def translate_text(text: str, target_lang: str, translator: SharedTranslator, source_lang: Optional[str] = None) -> tuple[str, str]:
+    return await upstream.retrying(upstream.DEEPL, lambda: upstream.run(translator.translate_text, text, target_lang, source_lang))
+
+
+async def transcribe_voice(context: ContextTypes.DEFAULT_TYPE, voice: Voice) -> tuple[str, str]:
+    """Returns the transcript and the spoken language of a voice message, taking them from the transcript cache if possible.
+
+    Raises AudioTooLarge if the voice message is too long to be transcribed.
+    """
+    cache = loader.transcript_cache()
+    cached = await upstream.run_local(cache.get_by_file, voice.file_unique_id)
+    if cached:
+        return cached
+    transcriber = loader.transcriber()
+    if not transcriber:
         return '', ''
-    dg = Deepgram(config['deepgram_api_token'])
-    source = {'buffer': audio, 'mimetype': 'audio/ogg'}
-    options = {'detect_language': True}
-    response = dg.transcription.sync_prerecorded(source, options) # type: ignore
-    transcript = response['results']['channels'][0]['alternatives'][0]['transcript'] # type: ignore
-    detected_language = response['results']['channels'][0]['detected_language'] # type: ignore
-    detected_language = 'EN-US' if detected_language == 'en' else detected_language.upper()
-    return transcript, detected_language
+    file = await context.bot.get_file(voice.file_id)
+    # the audio is streamed into the transcription, so it can only be hashed on the way and not be looked up by content first
+    transcription = await upstream.retrying(upstream.SPEECH_TO_TEXT, lambda: transcriber.transcribe_url(file.file_path, duration=voice.duration, file_size=voice.file_size, mimetype=voice.mime_type or 'audio/ogg'))
+    if transcription.transcript:
+        await upstream.run_local(cache.put, voice.file_unique_id, transcription.content_hash, transcription.transcript, transcription.language)
+    return transcription.transcript, transcription.language
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -77,7 +387,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
     text = "Hi I'm a Chatbot :) write anything"
     if auth(update):
-        user_data = loader.update_user_data(update)
+        user_data = await upstream.run_local(loader.update_user_data, update)
         text += f"\n\nYou are whitelisted! have fun :D"
         text += f"\n\nCurrent temperature is {str(user_data.temperature)}\nUpdate with: /temp [temperature]"
         text += f"\n\n*Admin mode* 🥳" if admin(update, warning=False) else ''
@@ -86,10 +396,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
 
 
-async def prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    loader.log(update)
+@coalesced
+@scheduled(supersede=True)
+async def prompt(update: Update, context: ContextTypes.DEFAULT_TYPE, text: Optional[str] = None):
+    """Answers a text message, or the merged text of several messages if it is given."""
+    log_ctx = loader.log_context(update)
     # user not whitelisted
     if not auth(update):
+        loader.log(update, ctx=log_ctx)
         return
     # no message
     if not update.effective_message or not update.effective_message.text:
@@ -98,22 +412,31 @@ async def prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.effective_chat or not update.effective_user:
         return
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
-    user_data = loader.update_user_data(update)
-    user_text = update.effective_message.text
+    user_data = await upstream.run_local(loader.update_user_data, update)
+    chatbot = await upstream.chatbot(user_data)
+    log_ctx.user_data = user_data
+    user_text = text or update.effective_message.text
+    loader.log(update, ctx=log_ctx, message=user_text)
     # translate to english
     if user_data.language and user_data.translator:
-        user_text, detected_source_lang = translate_text(user_text, target_lang='EN-US', translator=user_data.translator)
-        loader.log(update, title=f'translated from {detected_source_lang} to english', message=user_text)
+        user_text, detected_source_lang = await translate_text(user_text, target_lang='EN-US', translator=user_data.translator)
+        loader.log(update, ctx=log_ctx, title=f'translated from {detected_source_lang} to english', message=user_text)
+    # stream response from chatbot directly into telegram if it doesn't need to be translated back
+    if streaming_enabled() and not (user_data.language and user_data.translator):
+        message = await stream_response(context, update.effective_chat.id, update.effective_message.message_id, chatbot, user_data.temperature, user_text)
+        loader.log(update, ctx=log_ctx, title='hugchat', message=message)
+        count_turn(update, user_data, user_text, message)
+        return
     # get response from chatbot
-    message = get_response(user_data.chatbot, user_data.temperature, user_text)
+    message = await get_response(chatbot, user_data.temperature, user_text)
     # translate back to original language
-    loader.log(update, title='hugchat', message=message)
+    loader.log(update, ctx=log_ctx, title='hugchat', message=message)
+    count_turn(update, user_data, user_text, message)
     if user_data.language and user_data.translator:
-        message, _ = translate_text(message, target_lang=user_data.language, translator=user_data.translator)
-        loader.log(update, title=f'translated from english to {user_data.language}', message=message)
+        message, _ = await translate_text(message, target_lang=user_data.language, translator=user_data.translator, source_lang='EN-US')
+        loader.log(update, ctx=log_ctx, title=f'translated from english to {user_data.language}', message=message)
     # send response back to telegram
-    message_wrap = textwrap.wrap(message, 3500, expand_tabs=False, replace_whitespace=False, break_long_words=False, break_on_hyphens=False)
-    for part_index, part in enumerate(message_wrap):
+    for part_index, part in enumerate(streaming.wrap_message(message)):
         await context.bot.send_message(chat_id=update.effective_chat.id, text=part, reply_to_message_id=update.effective_message.message_id if part_index == 0 else None)
 
 
@@ -125,7 +448,7 @@ async def temp(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.effective_chat or not update.effective_user:
         return
     chat_id = update.effective_chat.id
-    user_data = loader.update_user_data(update)
+    user_data = await upstream.run_local(loader.update_user_data, update)
     # no temperature given, send current temperature
     if not context.args:
         await context.bot.send_message(chat_id=chat_id, text=f'Current temperature is {user_data.temperature}\n\nUpdate with: /temp [temperature]')
@@ -136,10 +459,73 @@ async def temp(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     # set temperature, send confirmation
     user_data.temperature = float(context.args[0])
-    loader.update_user_data(update)
+    await upstream.run_local(loader.update_user_data, update)
     await context.bot.send_message(chat_id=update.effective_chat.id, text=f'Temperature set to {user_data.temperature}')
 
 
+async def coalesce(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # user not whitelisted
+    if not auth(update):
+        return
+    # no chat or user associated with update
+    if not update.effective_chat or not update.effective_user:
+        return
+    chat_id = update.effective_chat.id
+    user_data = await upstream.run_local(loader.update_user_data, update)
+    max_window = max_coalesce_window()
+    # no window given, send current window
+    if not context.args:
+        current = f'{user_data.coalesce_window} ms' if user_data.coalesce_window else 'off'
+        await context.bot.send_message(chat_id=chat_id, text=f'Messages sent in quick succession are answered together: {current}\n\nUpdate with: /coalesce [milliseconds] or /coalesce off')
+        return
+    # invalid window, send error
+    window = 0 if context.args[0] == 'off' else int(context.args[0]) if context.args[0].isdigit() else -1
+    if not 0 <= window <= max_window:
+        await context.bot.send_message(chat_id=chat_id, text=f'Invalid window: {context.args[0]}, please specify up to {max_window} milliseconds or off')
+        return
+    # set window, send confirmation
+    user_data.coalesce_window = window
+    await upstream.run_local(loader.update_user_data, update)
+    if window:
+        await context.bot.send_message(chat_id=chat_id, text=f'Messages you send within {window} ms of each other are now answered together')
+    else:
+        await context.bot.send_message(chat_id=chat_id, text=f'Every message is answered on its own again')
+
+
+async def rotate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # user not whitelisted
+    if not auth(update):
+        return
+    # no chat or user associated with update
+    if not update.effective_chat or not update.effective_user:
+        return
+    chat_id = update.effective_chat.id
+    user_data = await upstream.run_local(loader.update_user_data, update)
+    min_chars = rotation_summary_chars() * rotation.MIN_ROTATE_CHARS_FACTOR
+    usage = f'Update with: /rotate [turns] [characters] (0 for no limit) or /rotate off'
+    # no thresholds given, send current thresholds
+    if not context.args:
+        text = f'Conversations are continued in a new one, which starts with a summary of the old one, after: {rotation.describe(user_data.rotate_turns, user_data.rotate_chars)}'
+        text += f'\n\nThe current conversation has {user_data.turns} turns and about {user_data.context_chars} characters, it was rotated {user_data.rotations} times so far'
+        await context.bot.send_message(chat_id=chat_id, text=f'{text}\n\n{usage}')
+        return
+    # invalid thresholds, send error
+    values = [0, 0] if context.args[0] == 'off' else [int(arg) if arg.isdigit() else -1 for arg in context.args[:2]]
+    turns, chars = values[0], values[1] if len(values) > 1 else 0
+    if not (turns == 0 or turns >= rotation.MIN_ROTATE_TURNS) or not (chars == 0 or chars >= min_chars):
+        await context.bot.send_message(chat_id=chat_id, text=f'Invalid thresholds: {" ".join(context.args)}, please specify at least {rotation.MIN_ROTATE_TURNS} turns and {min_chars} characters\n\n{usage}')
+        return
+    # set thresholds, send confirmation
+    user_data.rotate_turns = turns
+    user_data.rotate_chars = chars
+    await upstream.run_local(loader.update_user_data, update)
+    if turns or chars:
+        await context.bot.send_message(chat_id=chat_id, text=f'Conversations are now rotated after {rotation.describe(turns, chars)}')
+    else:
+        await context.bot.send_message(chat_id=chat_id, text=f'Conversations are only replaced with /new or /delete again')
+
+
+@scheduled
 async def chatbot_new(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # user not whitelisted
     if not auth(update):
@@ -148,12 +534,13 @@ async def chatbot_new(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.effective_chat or not update.effective_user:
         return
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
-    user_data = loader.update_user_data(update)
-    reset_conversation(user_data, delete=False)
-    loader.update_user_data(update)
+    user_data = await upstream.run_local(loader.update_user_data, update)
+    await reset_conversation(user_data, delete=False)
+    await upstream.run_local(loader.update_user_data, update)
     await context.bot.send_message(chat_id=update.effective_chat.id, text=f'New conversation was started, the old one is still on HuggingChat')
 
 
+@scheduled
 async def chatbot_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # user not whitelisted
     if not auth(update):
@@ -162,15 +549,16 @@ async def chatbot_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.effective_chat or not update.effective_user:
         return
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
-    user_data = loader.update_user_data(update)
-    old_conversation_id = reset_conversation(user_data, delete=True)
+    user_data = await upstream.run_local(loader.update_user_data, update)
+    old_conversation_id = await reset_conversation(user_data, delete=True)
     logs_deleted = False
     if context.args and context.args[0] == 'logs':
-        logs_deleted = loader.delete_log(update.effective_user.id, old_conversation_id)
-    loader.update_user_data(update)
+        logs_deleted = await upstream.run_local(loader.delete_log, update.effective_user.id, old_conversation_id)
+    await upstream.run_local(loader.update_user_data, update)
     await context.bot.send_message(chat_id=update.effective_chat.id, text=f'Conversation has been deleted and a new one has been started' + ('\nand the logs have been deleted' if logs_deleted else '\nbut the logs have been kept'))
 
 
+@scheduled
 async def private(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # user not whitelisted
     if not auth(update):
@@ -186,16 +574,23 @@ async def private(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not text:
         await context.bot.send_message(chat_id=update.effective_chat.id, text=f'Please specify a message like this: /private [message]', reply_to_message_id=update.effective_message.message_id)
         return
-    user_data = loader.update_user_data(update)
-    old_conversation_id = reset_conversation(user_data, delete=False)
-    message = get_response(user_data.chatbot, user_data.temperature, text)
-    temp_conversation_id = user_data.chatbot.current_conversation
-    user_data.chatbot.change_conversation(old_conversation_id)
-    user_data.chatbot.delete_conversation(temp_conversation_id)
-    for part_index, part in enumerate(textwrap.wrap(message, 3500, expand_tabs=False, replace_whitespace=False, break_long_words=False, break_on_hyphens=False)):
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=part, reply_to_message_id=update.effective_message.message_id if part_index == 0 else None)
-
-
+    user_data = await upstream.run_local(loader.update_user_data, update)
+    stream = streaming_enabled()
+    # a pooled chatbot already has a blank conversation, so the conversation of the user is never touched
+    chatbot = await upstream.lease_chatbot()
+    try:
+        if stream:
+            message = await stream_response(context, update.effective_chat.id, update.effective_message.message_id, chatbot, user_data.temperature, text)
+        else:
+            message = await get_response(chatbot, user_data.temperature, text)
+    finally:
+        upstream.release_chatbot(chatbot)
+    if not stream:
+        for part_index, part in enumerate(streaming.wrap_message(message)):
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=part, reply_to_message_id=update.effective_message.message_id if part_index == 0 else None)
+
+
+@scheduled
 async def bottalk(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # user not whitelisted
     if not auth(update):
@@ -220,25 +615,36 @@ async def bottalk(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_message(chat_id=update.effective_chat.id, text=f'Please specify a number of iterations between 1 and 10', reply_to_message_id=update.effective_message.message_id)
         return
 
-    chatbots: list[hugchat.ChatBot] = [loader.new_chatbot() for _ in range(2)]
+    # leased one after another, so the first one is released even if leasing the second one fails
+    first = await upstream.lease_chatbot()
+    try:
+        second = await upstream.lease_chatbot()
+        try:
+            await talk(update, context, (first, second), text, iterations)
+        finally:
+            upstream.release_chatbot(second)
+    finally:
+        upstream.release_chatbot(first)
+
+
+async def talk(update: Update, context: ContextTypes.DEFAULT_TYPE, chatbots: tuple[hugchat.ChatBot, hugchat.ChatBot], text: str, iterations: int):
+    """Lets the two chatbots answer each other for the given number of iterations, starting with the text."""
+    log_ctx = loader.log_context(update)
     logfile = f'bottalk_{chatbots[0].current_conversation}_{chatbots[1].current_conversation}'
-    loader.log(update, filename=logfile, message=text)
+    loader.log(update, ctx=log_ctx, filename=logfile, message=text)
 
     last_message_id = update.effective_message.message_id
     for i in range(iterations):
         chatbot = chatbots[i % 2]
         await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
-        text = get_response(chatbot, 0.9, text)
+        text = await get_response(chatbot, 0.9, text)
         botname = f'Bot {i % 2 + 1}'
         telegram_text = f'[{botname} | Iteration {i + 1}/{iterations}]\n\n' + text
-        loader.log(update, filename=logfile, message=text, title=botname)
-        for part_index, part in enumerate(textwrap.wrap(telegram_text, 3500, expand_tabs=False, replace_whitespace=False, break_long_words=False, break_on_hyphens=False)):
+        loader.log(update, ctx=log_ctx, filename=logfile, message=text, title=botname)
+        for part_index, part in enumerate(streaming.wrap_message(telegram_text)):
             message = await context.bot.send_message(chat_id=update.effective_chat.id, text=part, reply_to_message_id=last_message_id if part_index == 0 else None)
             last_message_id = message.message_id
 
-    for chatbot in chatbots:
-        chatbot.delete_conversation(chatbot.current_conversation)
-
 
 async def translate(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # user not whitelisted
@@ -254,23 +660,20 @@ async def translate(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_message(chat_id=update.effective_chat.id, text=f'Please specify a language like this: /translate [language]\n\npossible language codes:\n\n{LANG_NAMES}')
         return
     if context.args[0] == 'off':
-        user_data = loader.update_user_data(update)
+        user_data = await upstream.run_local(loader.update_user_data, update)
         user_data.language = None
-        loader.update_user_data(update)
+        await upstream.run_local(loader.update_user_data, update)
         await context.bot.send_message(chat_id=update.effective_chat.id, text=f'Translation disabled')
         return
     if not context.args[0].upper() in LANG_CODES:
         await context.bot.send_message(chat_id=update.effective_chat.id, text=f'Unrecognized language code: {context.args[0]}\n\npossible language codes:\n\n{LANG_NAMES}')
         return
-    user_data = loader.update_user_data(update)
+    user_data = await upstream.run_local(loader.update_user_data, update)
     if not user_data.translator:
-        config = loader.load_config()
-        if not config.get('deepl_api_token'):
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=f"This bot doesn't have a translator installed. Please ask the creator of the bot to add one.")
-            return
-        user_data.translator = Translator(config['deepl_api_token'])
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=f"This bot doesn't have a translator installed. Please ask the creator of the bot to add one.")
+        return
     user_data.language = context.args[0].upper()
-    loader.update_user_data(update)
+    await upstream.run_local(loader.update_user_data, update)
     await context.bot.send_message(chat_id=update.effective_chat.id, text=f'Language set to {user_data.language}. You can now write in your language and it will be translated to english before the Chatbot sees it. The answer from the bot will then be translated back to your language. You can disable this with /translate off')
 
 
@@ -324,6 +727,50 @@ async def whitelist_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(chat_id=update.effective_chat.id, text=f'Whitelisted users:\n\n{whitelist}')
 
 
+async def conversation_backlog(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # user not admin
+    if not admin(update):
+        return
+    # no chat associated with update
+    if not update.effective_chat:
+        return
+    collector = loader.conversation_collector()
+    pending = collector.pending()
+    text = f'Conversations waiting to be deleted: {len(pending)}'
+    text += f'\nDeleted: {collector.deleted}, given up: {collector.failed}'
+    retrying = [entry for entry in pending if entry['attempts']]
+    if retrying:
+        text += f'\n\nFailed before ({len(retrying)}):\n'
+        text += '\n'.join(f'{entry["conversation_id"]} ({entry["account"] or "unknown account"}, {entry["attempts"]} attempts)' for entry in retrying[:20])
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # user not admin
+    if not admin(update):
+        return
+    # no chat associated with update
+    if not update.effective_chat:
+        return
+    for part in streaming.wrap_message(metrics.render_text()):
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=part)
+
+
+async def stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # user not whitelisted
+    if not auth(update):
+        return
+    # no chat or user associated with update
+    if not update.effective_chat or not update.effective_user:
+        return
+    # not scheduled, it has to get past the requests it stops
+    user_id = update.effective_user.id
+    stopped = get_scheduler().cancel(user_id) + get_coalescer().discard(user_id)
+    text = f'Stopped {stopped} request(s)' if stopped else 'Nothing to stop'
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+
+
+@scheduled
 async def voice_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # user not whitelisted
     if not auth(update):
@@ -335,46 +782,58 @@ async def voice_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.effective_chat or not update.effective_user:
         return
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
+    pipeline = Pipeline('voice_summary')
+    # lease a chatbot while the voice message is transcribed
+    chatbot_task = pipeline.start('chatbot', upstream.lease_chatbot())
+    try:
+        # get transcript
+        try:
+            transcript, spoken_language = await pipeline.stage('transcribe', transcribe_voice(context, update.effective_message.voice))
+        except AudioTooLarge as e:
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=f'Voice message is too long to be transcribed ({e})')
+            return
+        if not transcript:
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=f'Could not transcribe voice message')
+            return
 
-    # get transcript
-    file = await context.bot.get_file(update.effective_message.voice.file_id)
-    with io.BytesIO() as audio:  # TODO i don't know if this is a good idea to just hold the whole file in memory
-        await file.download_to_memory(audio)
-        transcript, spoken_language = stt(audio.getvalue())
-    if not transcript:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=f'Could not transcribe voice message')
-        return
-
-    # translate transcript to english
-    config = loader.load_config()
-    if not config.get('deepl_api_token') and spoken_language != 'EN-US':
-        error_text = f"The detected language is \"{spoken_language}\" but this bot doesn't have a translator installed. Please ask the creator of the bot to add one."
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=error_text)
-        return
-    translator = Translator(config['deepl_api_token'])
-    transcript_translated = transcript if spoken_language == 'EN-US' else translate_text(transcript, 'EN-US', translator)[0]
-
-    # get summary from chatbot
-    chatbot = loader.new_chatbot()
-    text_for_bot = (f"The following text is an automatic transcript of a voice message, so it might not have the best quality."
-                    f" Please write a short summary of that text."
-                    f" Answer with just the summary, no introductory words or anything."
-                    f" Transcript:"
-                    f"\n\n{transcript_translated}")
-    message = get_response(chatbot, 0.9, text_for_bot)
-    chatbot.delete_conversation(chatbot.current_conversation)
-
-    # translate summary back to original language
-    message_translated = message if spoken_language == 'EN-US' else translate_text(message, spoken_language, translator)[0]
-
-    # send transcript and summary to telegram
-    final_message = f'Summary{" (translated)" if spoken_language != "EN-US" else ""}:'
-    final_message += f'\n{message_translated}'
-    final_message += f'\n\nTranscript (detected language: {spoken_language}):'
-    final_message += f'\n{transcript}'
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=final_message)
-
-
+        # translate transcript to english
+        translator = loader.shared_translator()
+        if not translator and spoken_language != 'EN-US':
+            error_text = f"The detected language is \"{spoken_language}\" but this bot doesn't have a translator installed. Please ask the creator of the bot to add one."
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=error_text)
+            return
+        transcript_translated = transcript if spoken_language == 'EN-US' else (await pipeline.stage('translate', translate_text(transcript, 'EN-US', translator, spoken_language)))[0]
+
+        # get summary from chatbot
+        chatbot = await chatbot_task
+        text_for_bot = (f"The following text is an automatic transcript of a voice message, so it might not have the best quality."
+                        f" Please write a short summary of that text."
+                        f" Answer with just the summary, no introductory words or anything."
+                        f" Transcript:"
+                        f"\n\n{transcript_translated}")
+        message = await pipeline.stage('hugchat', get_response(chatbot, 0.9, text_for_bot))
+
+        # translate summary back to original language
+        message_translated = message if spoken_language == 'EN-US' else (await pipeline.stage('translate_back', translate_text(message, spoken_language, translator, 'EN-US')))[0]
+
+        # send transcript and summary to telegram
+        final_message = f'Summary{" (translated)" if spoken_language != "EN-US" else ""}:'
+        final_message += f'\n{message_translated}'
+        final_message += f'\n\nTranscript (detected language: {spoken_language}):'
+        final_message += f'\n{transcript}'
+        await pipeline.stage('send', context.bot.send_message(chat_id=update.effective_chat.id, text=final_message))
+    finally:
+        # the user doesn't have to wait for the chatbot to be handed back
+        pipeline.defer('cleanup', discard_leased_chatbot(chatbot_task))
+        pipeline.finish(log_timings)
+
+
+async def load_user_chatbot(update: Update) -> tuple[UserData, hugchat.ChatBot]:
+    user_data = await upstream.run_local(loader.update_user_data, update)
+    return user_data, await upstream.chatbot(user_data)
+
+
+@scheduled(supersede=True)
 async def voice_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # user not whitelisted
     if not auth(update):
@@ -386,37 +845,60 @@ async def voice_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.effective_chat or not update.effective_user:
         return
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
-
-    # get transcript
-    file = await context.bot.get_file(update.effective_message.voice.file_id)
-    with io.BytesIO() as audio:  # TODO i don't know if this is a good idea to just hold the whole file in memory
-        await file.download_to_memory(audio)
-        transcript, spoken_language = stt(audio.getvalue())
-    if not transcript:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=f'Could not transcribe voice message')
-        return
-    loader.log(update, title='voice message transcript', message=transcript)
-
-    # translate transcript to english
-    config = loader.load_config()
-    if not config.get('deepl_api_token') and spoken_language != 'EN-US':
-        error_text = f"The detected language is \"{spoken_language}\" but this bot doesn't have a translator installed. Please ask the creator of the bot to add one."
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=error_text)
+    pipeline = Pipeline('voice_prompt')
+    # load the user and their chatbot while the voice message is transcribed
+    user_task = pipeline.start('chatbot', load_user_chatbot(update))
+    try:
+        # get transcript
+        try:
+            transcript, spoken_language = await pipeline.stage('transcribe', transcribe_voice(context, update.effective_message.voice))
+        except AudioTooLarge as e:
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=f'Voice message is too long to be transcribed ({e})')
+            return
+        if not transcript:
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=f'Could not transcribe voice message')
+            return
+        user_data, chatbot = await user_task
+        log_ctx = loader.log_context(update, user_data)
+        loader.log(update, ctx=log_ctx, title='voice message transcript', message=transcript)
+
+        # translate transcript to english
+        translator = loader.shared_translator()
+        if not translator and spoken_language != 'EN-US':
+            error_text = f"The detected language is \"{spoken_language}\" but this bot doesn't have a translator installed. Please ask the creator of the bot to add one."
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=error_text)
+            return
+        transcript_translated = transcript if spoken_language == 'EN-US' else (await pipeline.stage('translate', translate_text(transcript, 'EN-US', translator, spoken_language)))[0]
+
+        # get answer from chatbot and send it to telegram together with the transcript
+        final_message = f'Transcript (detected language: {spoken_language}):'
+        final_message += f'\n{transcript}'
+        final_message += f'\n\nAnswer from bot:\n'
+        if streaming_enabled():
+            message = await pipeline.stage('hugchat', stream_response(context, update.effective_chat.id, None, chatbot, user_data.temperature, transcript_translated, prefix=final_message))
+            loader.log(update, ctx=log_ctx, title='hugchat', message=message)
+            count_turn(update, user_data, transcript_translated, message)
+            return
+        message = await pipeline.stage('hugchat', get_response(chatbot, user_data.temperature, transcript_translated))
+        loader.log(update, ctx=log_ctx, title='hugchat', message=message)
+        count_turn(update, user_data, transcript_translated, message)
+        final_message += message
+        await pipeline.stage('send', context.bot.send_message(chat_id=update.effective_chat.id, text=final_message))
+    finally:
+        pipeline.finish(log_timings)
+
+
+async def discard_leased_chatbot(chatbot_task: 'asyncio.Task[hugchat.ChatBot]') -> None:
+    """Deletes the conversation of a leased chatbot and hands it back once it was leased."""
+    try:
+        chatbot = await chatbot_task
+    except Exception:
         return
-    translator = Translator(config['deepl_api_token'])
-    transcript_translated = transcript if spoken_language == 'EN-US' else translate_text(transcript, 'EN-US', translator)[0]
+    upstream.release_chatbot(chatbot)
 
-    # get answer from chatbot
-    user_data = loader.update_user_data(update)
-    message = get_response(user_data.chatbot, user_data.temperature, transcript_translated)
-    loader.log(update, title='hugchat', message=message)
 
-    # send transcript and summary to telegram
-    final_message = f'Transcript (detected language: {spoken_language}):'
-    final_message += f'\n{transcript}'
-    final_message += f'\n\nAnswer from bot:'
-    final_message += f'\n{message}'
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=final_message)
+def log_timings(pipeline: Pipeline) -> None:
+    loader.log(None, filename='timings', subdir='None', title=pipeline.name, message=pipeline.summary())
 
 
 
@@ -468,45 +950,191 @@ async def dev(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(chat_id=update.effective_chat.id, text="dev is fiddling around - can't respond right now")
 
 
+def allowed_update_types(handlers: list[BaseHandler]) -> list[str]:
+    """Returns the update types the handlers use, or all types if there is a handler of an unknown kind."""
+    update_types = set()
+    for handler in handlers:
+        handler_update_types = HANDLER_UPDATE_TYPES.get(type(handler))
+        if handler_update_types is None:
+            return Update.ALL_TYPES
+        update_types.update(handler_update_types)
+    return sorted(update_types)
+
+
+async def on_shutdown(app: Application):
+    await loader.close_transcriber()
+
+
+def create_handlers() -> list[BaseHandler]:
+    """Returns the handlers of the bot, in the order they are tried."""
+    return [
+        # MessageHandler(filters.TEXT, dev),
+
+        # InlineQueryHandler(inline_query),
+
+        CommandHandler('start', start),
+        CommandHandler('temp', temp),
+        CommandHandler('coalesce', coalesce),
+        CommandHandler('stop', stop),
+        CommandHandler('rotate', rotate),
+        CommandHandler('private', private),
+        CommandHandler('new', chatbot_new),
+        CommandHandler('delete', chatbot_delete),
+        CommandHandler('bottalk', bottalk),
+        CommandHandler('translate', translate),
+
+        CommandHandler('add', whitelist_add),
+        CommandHandler('remove', whitelist_remove),
+        CommandHandler('list', whitelist_list),
+        CommandHandler('gc', conversation_backlog),
+        CommandHandler('stats', stats),
+
+        MessageHandler(filters.VOICE & filters.FORWARDED, voice_summary),
+        MessageHandler(filters.VOICE, voice_prompt),
+        MessageHandler(filters.COMMAND, unknown),
+        MessageHandler(filters.TEXT, prompt),
+    ]
+
+
+def build_application(config: dict, *, updater: bool = True, shards: int = 1) -> Application:
+    """Builds the application with all handlers, without an updater it only handles updates that are put on its update queue.
+
+    In a worker of "shards" shard processes, the application only gets its share of the telegram flood limits.
+    """
+    # handlers await blocking upstream calls on the worker pool, so updates can be processed concurrently
+    # updates wait in a bounded queue, once it is full new updates are only taken when there is room again
+    update_queue = asyncio.Queue(maxsize=int(config.get('max_pending_updates') or DEFAULT_MAX_PENDING_UPDATES))
+    # everything that is sent to telegram goes through the outbox, which keeps to the flood limits
+    outbox = Outbox(
+        float(config.get('telegram_global_rate') or DEFAULT_GLOBAL_RATE),
+        float(config.get('telegram_chat_rate') or DEFAULT_CHAT_RATE),
+        float(config.get('telegram_group_rate') or DEFAULT_GROUP_RATE),
+        int(config.get('telegram_max_retries') or DEFAULT_TELEGRAM_MAX_RETRIES),
+        shards,
+    )
+    builder = ApplicationBuilder().token(config['telegram_api_token']).request(TimedRequest(connection_pool_size=256)).rate_limiter(outbox).update_queue(update_queue).concurrent_updates(True).post_shutdown(on_shutdown)
+    if not updater:
+        builder = builder.updater(None)
+    app = builder.build()
+    for handler in create_handlers():
+        # time every handler
+        handler.callback = instrumented(handler.callback)
+        app.add_handler(handler)
+    return app
+
+
+def serve_application_metrics(app: Application, config: dict, port_offset: int = 0) -> None:
+    register_gauges()
+    metrics.gauge('pending_updates', app.update_queue.qsize)
+    metrics_port = config.get('metrics_port')
+    if metrics_port:
+        port = int(metrics_port) + port_offset
+        serve_metrics(port, config.get('metrics_host') or '127.0.0.1')
+        print(f'serving metrics on port {port}')
+
+
+def run_application(app: Application, config: dict) -> None:
+    """Receives updates with a webhook or long polling until the process is stopped."""
+    allowed_updates = allowed_update_types(create_handlers())
+    if config.get('update_mode') == 'webhook':
+        listen = config.get('webhook_listen') or '127.0.0.1'
+        port = int(config.get('webhook_port') or DEFAULT_WEBHOOK_PORT)
+        url_path = config.get('webhook_path') or DEFAULT_WEBHOOK_PATH
+        # telegram sends the secret with every update, requests without it are rejected
+        secret_token = config.get('webhook_secret') or secrets.token_urlsafe(32)
+        print(f'starting webhook on {listen}:{port}/{url_path}..')
+        app.run_webhook(listen=listen, port=port, url_path=url_path, webhook_url=config.get('webhook_url'), secret_token=secret_token, allowed_updates=allowed_updates)
+    else:
+        print('starting polling..')
+        app.run_polling(allowed_updates=allowed_updates)
+
+
+def run_sharded(config: dict, shards: int) -> None:
+    """Receives updates in this process and hands them to a worker process per shard of the users."""
+    max_pending = int(config.get('max_pending_updates') or DEFAULT_MAX_PENDING_UPDATES)
+    router = ShardRouter(shards, run_worker, max_pending)
+
+    async def route(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await router.route(update.effective_user.id if update.effective_user else None, update.to_dict())
+
+    async def stop_workers(app: Application):
+        await asyncio.get_running_loop().run_in_executor(None, router.stop)
+
+    # updates are routed one after another, so the updates of a user reach their worker in order
+    front = ApplicationBuilder().token(config['telegram_api_token']).post_shutdown(stop_workers).build()
+    front.add_handler(TypeHandler(Update, route))
+    router.start()
+    print(f'handing updates to {shards} worker processes')
+    run_application(front, config)
+
+
+def run_worker(shard: int, shards: int, updates: 'multiprocessing.Queue') -> None:
+    """Handles the updates of the users in one shard, in a worker process started by run_sharded."""
+    # the front process stops the workers when it is interrupted
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loader.use_shard(shard)
+    loader.chatbot_pool().warm()
+    loader.conversation_collector().start()
+    config = loader.cached_config()
+    app = build_application(config, updater=False, shards=shards)
+    serve_application_metrics(app, config, port_offset=shard)
+    print(f'worker of shard {shard + 1}/{shards} started')
+    asyncio.run(process_updates(app, updates))
+    upstream.shutdown(wait=False)
+    loader.close_chatbot_pool()
+    loader.flush_users()
+    loader.flush_logs()
+
+
+async def process_updates(app: Application, updates: 'multiprocessing.Queue') -> None:
+    loop = asyncio.get_running_loop()
+    async with app:
+        await app.start()
+        try:
+            while (update := await loop.run_in_executor(None, updates.get)) is not None:
+                await app.update_queue.put(Update.de_json(update, app.bot))
+        finally:
+            await app.stop()
+    # post_shutdown is only called by run_polling and run_webhook
+    await on_shutdown(app)
+
+
 def main():
     # Ensure logged in to hugchat
-    loader.hugchat_login()
+    accounts = loader.hugchat_login()
+    print(f'using {len(accounts)} HuggingChat account(s)')
+
+    # import user data pickled by older versions
+    migrated = loader.migrate_user_pickles()
+    if migrated:
+        print(f'migrated {migrated} users to the user store')
 
     # Telegram
-    config = loader.load_config()
+    config = loader.cached_config()
     if not config['telegram_api_token']:
         print('No telegram api token found. Please create a telegram bot and add the token to config.json')
         return
-    app = ApplicationBuilder().token(config['telegram_api_token']).build()
-
-
-    # Telegram Handlers
-
-    # app.add_handler(MessageHandler(filters.TEXT, dev))
-
-    # app.add_handler(InlineQueryHandler(inline_query))
-
-    app.add_handler(CommandHandler('start', start))
-    app.add_handler(CommandHandler('temp', temp))
-    app.add_handler(CommandHandler('private', private))
-    app.add_handler(CommandHandler('new', chatbot_new))
-    app.add_handler(CommandHandler('delete', chatbot_delete))
-    app.add_handler(CommandHandler('bottalk', bottalk))
-    app.add_handler(CommandHandler('translate', translate))
-
-    app.add_handler(CommandHandler('add', whitelist_add))
-    app.add_handler(CommandHandler('remove', whitelist_remove))
-    app.add_handler(CommandHandler('list', whitelist_list))
+    if config.get('update_mode') == 'webhook' and not config.get('webhook_url'):
+        print('No webhook url found. Please add the public https url telegram should send the updates to as webhook_url to config.json')
+        return
+    shards = int(config.get('shards') or DEFAULT_SHARDS)
+    if shards > 1:
+        run_sharded(config, shards)
+        return
 
-    app.add_handler(MessageHandler(filters.VOICE & filters.FORWARDED, voice_summary))
-    app.add_handler(MessageHandler(filters.VOICE, voice_prompt))
-    app.add_handler(MessageHandler(filters.COMMAND, unknown))
-    app.add_handler(MessageHandler(filters.TEXT, prompt))
+    # warm up the chatbot pool
+    loader.chatbot_pool().warm()
+    # continue deleting conversations that were left over from the last run
+    loader.conversation_collector().start()
 
-    # Run
-    print('starting polling..')
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    app = build_application(config)
+    serve_application_metrics(app, config)
+    run_application(app, config)
+    upstream.shutdown(wait=False)
+    loader.close_chatbot_pool()
+    loader.flush_users()
+    loader.flush_logs()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
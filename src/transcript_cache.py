@@ -0,0 +1,68 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+DEFAULT_MAX_ENTRIES = 5000
+
+
+class TranscriptCache:
+    """Persistent cache of voice message transcripts, backed by sqlite.
+
+    Transcripts are found by the telegram file_unique_id of the voice message, so a voice message that is
+    forwarded again doesn't even have to be downloaded. The hash of the audio is stored along with the transcript.
+    At most "max_entries" transcripts are kept, the least recently used ones are evicted.
+    """
+
+    def __init__(self, path: str, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max(1, max_entries)
+        self.file_hits = 0
+        self.misses = 0
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS transcripts (file_unique_id TEXT PRIMARY KEY, content_hash TEXT NOT NULL, transcript TEXT NOT NULL, language TEXT NOT NULL, last_used REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS transcripts_last_used ON transcripts (last_used)')
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def get_by_file(self, file_unique_id: str) -> Optional[tuple[str, str]]:
+        """Returns the transcript and language of the voice message with the given file_unique_id if it is cached, counting a miss otherwise."""
+        with self._lock:
+            result = self._get(file_unique_id)
+            if result:
+                self.file_hits += 1
+            else:
+                self.misses += 1
+            return result
+
+    def put(self, file_unique_id: str, content_hash: str, transcript: str, language: str) -> None:
+        with self._lock:
+            connection = self._connect()
+            connection.execute('INSERT OR REPLACE INTO transcripts (file_unique_id, content_hash, transcript, language, last_used) VALUES (?, ?, ?, ?, ?)', (file_unique_id, content_hash, transcript, language, time.time()))
+            count = connection.execute('SELECT COUNT(*) FROM transcripts').fetchone()[0]
+            if count > self.max_entries:
+                connection.execute('DELETE FROM transcripts WHERE file_unique_id IN (SELECT file_unique_id FROM transcripts ORDER BY last_used LIMIT ?)', (count - self.max_entries,))
+            connection.commit()
+
+    def stats(self) -> dict[str, int]:
+        return {'file_hits': self.file_hits, 'misses': self.misses}
+
+    def _get(self, file_unique_id: str) -> Optional[tuple[str, str]]:
+        connection = self._connect()
+        row = connection.execute('SELECT transcript, language FROM transcripts WHERE file_unique_id = ?', (file_unique_id,)).fetchone()
+        if row is None:
+            return None
+        connection.execute('UPDATE transcripts SET last_used = ? WHERE file_unique_id = ?', (time.time(), file_unique_id))
+        connection.commit()
+        return row[0], row[1]
@@ -0,0 +1,54 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from deepl import Translator
+
+DEFAULT_CACHE_SIZE = 1000
+
+
+def same_language(source_lang: Optional[str], target_lang: str) -> bool:
+    """Returns whether the languages are the same, ignoring variants like EN-US and EN-GB."""
+    return bool(source_lang) and source_lang.upper().split('-')[0] == target_lang.upper().split('-')[0]
+
+
+class SharedTranslator:
+    """A DeepL translator that is shared by all users.
+
+    Translations are kept in a bounded LRU cache keyed by a hash of the text and the target language.
+    Nothing is sent to DeepL if the source language is known to be the target language already.
+    """
+
+    def __init__(self, api_token: str, cache_size: int = DEFAULT_CACHE_SIZE):
+        self.translator = Translator(api_token)
+        self.cache_size = max(0, cache_size)
+        self.hits = 0
+        self.misses = 0
+        self._cache: OrderedDict[tuple[bytes, str], tuple[str, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def translate_text(self, text: str, target_lang: str, source_lang: Optional[str] = None) -> tuple[str, str]:
+        """Returns the translated text and the detected source language."""
+        if same_language(source_lang, target_lang):
+            return text, source_lang or target_lang
+        key = (hashlib.sha256(text.encode('utf-8')).digest(), target_lang)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+        result = self.translator.translate_text(text, target_lang=target_lang)
+        value = (result.text, result.detected_source_lang)
+        with self._lock:
+            if self.cache_size:
+                self._cache[key] = value
+                self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return value
+
+    def stats(self) -> dict[str, int]:
+        return {'size': len(self._cache), 'hits': self.hits, 'misses': self.misses}
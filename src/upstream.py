@@ -0,0 +1,237 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional, TypeVar
+
+from hugchat import hugchat
+
+import loader
+import retry
+from metrics import registry as metrics
+from user_data import UserData
+
+DEFAULT_WORKERS = 8
+# local I/O like the user store and the transcript cache is quick, a few threads are enough
+LOCAL_WORKERS = 4
+
+# names of the upstream services, each has its own circuit breaker
+HUGCHAT = 'HuggingChat'
+DEEPL = 'DeepL'
+SPEECH_TO_TEXT = 'Speech to text'
+
+T = TypeVar('T')
+
+_executor: Optional[ThreadPoolExecutor] = None
+_local_executor: Optional[ThreadPoolExecutor] = None
+# calls that are running on the worker pool per chatbot (by id) and what to do once a chatbot has none left,
+# a cancelled request stops waiting for its call but the call itself keeps running until hugchat returns
+_chatbot_calls: dict[int, set[Future]] = {}
+_on_chatbot_idle: dict[int, list[Callable[[], None]]] = {}
+_chatbot_calls_lock = threading.Lock()
+
+
+def executor() -> ThreadPoolExecutor:
+    """Returns the worker pool for blocking upstream calls, creating it on first use.
+
+    The pool size is read from "upstream_workers" in the config and bounds how many
+    blocking upstream calls (HuggingChat, DeepL, ...) can run at the same time.
+    """
+    global _executor
+    if _executor is None:
+        workers = int(loader.load_config().get('upstream_workers') or DEFAULT_WORKERS)
+        _executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='upstream')
+    return _executor
+
+
+def local_executor() -> ThreadPoolExecutor:
+    """Returns the pool for blocking local I/O, which is kept apart from the worker pool so it never waits behind upstream calls."""
+    global _local_executor
+    if _local_executor is None:
+        _local_executor = ThreadPoolExecutor(max_workers=LOCAL_WORKERS, thread_name_prefix='local')
+    return _local_executor
+
+
+def shutdown(wait: bool = True) -> None:
+    global _executor, _local_executor
+    if _executor is not None:
+        _executor.shutdown(wait=wait)
+        _executor = None
+    if _local_executor is not None:
+        _local_executor.shutdown(wait=wait)
+        _local_executor = None
+
+
+async def run(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Runs a blocking upstream call on the worker pool without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor(), functools.partial(func, *args, **kwargs))
+
+
+async def run_local(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Runs blocking local I/O, e.g. of the user store or the transcript cache, without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(local_executor(), functools.partial(func, *args, **kwargs))
+
+
+def _call_done(chatbot_id: int, future: Future) -> None:
+    with _chatbot_calls_lock:
+        calls = _chatbot_calls.get(chatbot_id)
+        if calls is not None:
+            calls.discard(future)
+            if calls:
+                return
+            del _chatbot_calls[chatbot_id]
+        callbacks = _on_chatbot_idle.pop(chatbot_id, [])
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as e:
+            print(f'callback of idle chatbot failed: {e}')
+
+
+def when_idle(chatbot: hugchat.ChatBot, callback: Callable[[], None]) -> None:
+    """Calls callback once no call of the chatbot runs on the worker pool anymore, right away if none does."""
+    with _chatbot_calls_lock:
+        if _chatbot_calls.get(id(chatbot)):
+            _on_chatbot_idle.setdefault(id(chatbot), []).append(callback)
+            return
+    callback()
+
+
+async def run_on(chatbot: hugchat.ChatBot, func: Callable[..., T], *args: Any) -> T:
+    """Runs a blocking call of the chatbot on the worker pool like run, keeping track of it until it returns.
+
+    Calls that a cancelled request left running on the chatbot are waited for first, so a session is never used by two calls at once.
+    """
+    while True:
+        with _chatbot_calls_lock:
+            running = list(_chatbot_calls.get(id(chatbot), ()))
+        if not running:
+            break
+        await asyncio.wait([asyncio.wrap_future(future) for future in running])
+    future = executor().submit(functools.partial(func, *args))
+    with _chatbot_calls_lock:
+        _chatbot_calls.setdefault(id(chatbot), set()).add(future)
+    future.add_done_callback(functools.partial(_call_done, id(chatbot)))
+    return await asyncio.wrap_future(future)
+
+
+async def retrying(service: str, func: Callable[[], Awaitable[T]]) -> T:
+    """Awaits func() with the retry policy from the config, through the circuit breaker of the service.
+
+    Raises retry.CircuitOpen right away while the service is down.
+    Every attempt is timed and the retries and results are counted in the metrics.
+    """
+    async def attempt() -> T:
+        with metrics.timer('upstream_seconds', service=service):
+            return await func()
+    try:
+        result = await retry.call(attempt, loader.retry_policy(), loader.circuit_breaker(service), lambda e: metrics.inc('upstream_retries_total', service=service))
+    except retry.CircuitOpen:
+        metrics.inc('upstream_calls_total', service=service, result='circuit_open')
+        raise
+    except Exception:
+        metrics.inc('upstream_calls_total', service=service, result='error')
+        raise
+    metrics.inc('upstream_calls_total', service=service, result='ok')
+    return result
+
+
+async def chat(chatbot: hugchat.ChatBot, text: str, temperature: float) -> str:
+    return await run_on(chatbot, lambda: str(chatbot.chat(text, temperature=temperature)))
+
+
+def _token_text(item: Any) -> str:
+    """Extracts the text of one item of the hugchat token stream, which differs between hugchat versions."""
+    if isinstance(item, str):
+        return item
+    if isinstance(item, dict):
+        token = item.get('token')
+        if isinstance(token, dict):
+            return '' if token.get('special') else str(token.get('text') or '')
+        if isinstance(token, str):
+            return token
+    return ''
+
+
+async def stream_chat(chatbot: hugchat.ChatBot, text: str, temperature: float) -> AsyncIterator[str]:
+    """Yields the response of the chatbot token by token.
+
+    The blocking hugchat stream is consumed on the worker pool and handed over to the event loop through a queue.
+    If the caller stops early, e.g. because the request was cancelled, the stream is abandoned at its next token
+    so the worker thread and the chatbot are free again.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    done = object()
+    stopped = threading.Event()
+
+    def produce() -> None:
+        try:
+            for item in chatbot.chat(text, temperature=temperature, stream=True):
+                if stopped.is_set():
+                    break
+                token = _token_text(item)
+                if token:
+                    loop.call_soon_threadsafe(queue.put_nowait, token)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+    future = asyncio.ensure_future(run_on(chatbot, produce))
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+        await future
+    finally:
+        stopped.set()
+        if not future.done():
+            # nobody waits for the producer anymore, run_on still tracks it until it returns
+            future.cancel()
+
+
+# the calls below go to HuggingChat as well, so they are retried and go through its circuit breaker like chat
+
+async def new_conversation(chatbot: hugchat.ChatBot) -> hugchat.Conversation:
+    return await retrying(HUGCHAT, lambda: run_on(chatbot, chatbot.new_conversation))
+
+
+async def change_conversation(chatbot: hugchat.ChatBot, conversation: hugchat.Conversation) -> None:
+    await retrying(HUGCHAT, lambda: run_on(chatbot, chatbot.change_conversation, conversation))
+
+
+async def chatbot(user_data: UserData) -> hugchat.ChatBot:
+    """Returns the chatbot of the user, creating it on the worker pool if it doesn't exist yet."""
+    if user_data.has_chatbot:
+        return user_data.chatbot
+    return await retrying(HUGCHAT, lambda: run(lambda: user_data.chatbot))
+
+
+async def lease_chatbot() -> hugchat.ChatBot:
+    """Leases a pre-warmed chatbot with a fresh conversation, hand it back with release_chatbot when done.
+
+    Only if no pre-warmed chatbot is left, one is created on the worker pool.
+    """
+    pool = loader.chatbot_pool()
+    chatbot = pool.take()
+    if chatbot is not None:
+        return chatbot
+    return await retrying(HUGCHAT, lambda: run(pool.create))
+
+
+def release_chatbot(chatbot: hugchat.ChatBot) -> None:
+    """Queues the conversation of a leased chatbot for deletion and hands the chatbot back to the pool.
+
+    If a call of a cancelled request still runs on the chatbot, this happens once the call returned.
+    """
+    def release():
+        loader.delete_conversation_later(chatbot, chatbot.current_conversation)
+        loader.chatbot_pool().release(chatbot)
+    when_idle(chatbot, release)
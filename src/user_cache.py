@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from user_data import UserData
+
+
+class UserCache:
+    """Bounded in-memory cache of user data.
+
+    Holds at most "max_entries" users and evicts the least recently used one when it is full.
+    Users that weren't used for "idle_ttl" seconds are evicted as well.
+    Evicted users are handed to "on_evict" (outside of the cache lock) to be flushed and closed.
+    Users for which "in_use" is true, e.g. because a request of theirs is running, are never evicted and count as used,
+    if all users are in use the cache holds more than "max_entries" users until they are done.
+    """
+
+    def __init__(self, max_entries: int, idle_ttl: float, on_evict: Callable[[int, UserData], None], in_use: Callable[[int], bool] = lambda user_id: False):
+        self.max_entries = max(1, max_entries)
+        self.idle_ttl = idle_ttl
+        self.on_evict = on_evict
+        self.in_use = in_use
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # ordered from least to most recently used
+        self._entries: OrderedDict[int, tuple[UserData, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._entries
+
+    def get(self, user_id: int) -> Optional[UserData]:
+        evicted = self._evict_idle()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries[user_id] = (entry[0], time.monotonic())
+                self._entries.move_to_end(user_id)
+        self._notify(evicted)
+        return entry[0] if entry else None
+
+    def peek(self, user_id: int) -> Optional[UserData]:
+        """Returns the user data if it is cached, without counting it as a use."""
+        entry = self._entries.get(user_id)
+        return entry[0] if entry else None
+
+    def put(self, user_id: int, user_data: UserData) -> None:
+        evicted = []
+        with self._lock:
+            self._entries[user_id] = (user_data, time.monotonic())
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                victim = next((cached_id for cached_id in self._entries if cached_id != user_id and not self.in_use(cached_id)), None)
+                if victim is None:
+                    break
+                evicted.append(self._pop(victim))
+        self._notify(evicted)
+
+    def clear(self) -> None:
+        """Evicts all users, in use or not, e.g. on shutdown."""
+        with self._lock:
+            evicted = [self._pop(user_id) for user_id in list(self._entries)]
+        self._notify(evicted)
+
+    def stats(self) -> dict[str, int]:
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def _evict_idle(self) -> list[tuple[int, UserData]]:
+        evicted = []
+        now = time.monotonic()
+        deadline = now - self.idle_ttl
+        with self._lock:
+            while self._entries:
+                user_id, (user_data, used) = next(iter(self._entries.items()))
+                if used >= deadline:
+                    break
+                if self.in_use(user_id):
+                    self._entries[user_id] = (user_data, now)
+                    self._entries.move_to_end(user_id)
+                else:
+                    evicted.append(self._pop(user_id))
+        return evicted
+
+    def _pop(self, user_id: int) -> tuple[int, UserData]:
+        user_data, _ = self._entries.pop(user_id)
+        self.evictions += 1
+        return user_id, user_data
+
+    def _notify(self, evicted: list[tuple[int, UserData]]) -> None:
+        for user_id, user_data in evicted:
+            try:
+                self.on_evict(user_id, user_data)
+            except Exception as e:
+                print(f'could not evict user {user_id}: {e}')
@@ -1,11 +1,167 @@
-from typing import Optional
+import threading
+from typing import Any, Callable, Optional
 from hugchat.hugchat import ChatBot
-from deepl import Translator
 
-class UserData:
-    def __init__(self, chatbot: ChatBot, filename: str, temperature: float = 0.9):
-        self.chatbot: ChatBot = chatbot
+from chatbot_pool import conversation_of
+from translation import SharedTranslator
+
+
+class UserState:
+    """The persisted state of a user, kept small so it is cheap to hold in memory and to serialize."""
+
+    __slots__ = ('user_id', 'filename', 'temperature', 'language', 'conversation_id', 'account', 'coalesce_window', 'rotate_turns', 'rotate_chars', 'turns', 'context_chars', 'rotations')
+
+    def __init__(self, user_id: int, filename: str, temperature: float = 0.9, language: Optional[str] = None, conversation_id: Optional[str] = None, account: Optional[str] = None, coalesce_window: int = 0,
+                 rotate_turns: int = 0, rotate_chars: int = 0, turns: int = 0, context_chars: int = 0, rotations: int = 0):
+        self.user_id: int = user_id
         self.filename: str = filename
         self.temperature: float = temperature
-        self.language: Optional[str] = None
-        self.translator: Optional[Translator] = None
+        self.language: Optional[str] = language
+        self.conversation_id: Optional[str] = conversation_id
+        # the HuggingChat account the conversation belongs to
+        self.account: Optional[str] = account
+        # messages sent within this many milliseconds are answered together, 0 answers every message on its own
+        self.coalesce_window: int = coalesce_window
+        # the conversation is rotated after this many turns or about this many characters, 0 doesn't rotate
+        self.rotate_turns: int = rotate_turns
+        self.rotate_chars: int = rotate_chars
+        # size of the current conversation and how often the conversation was rotated so far
+        self.turns: int = turns
+        self.context_chars: int = context_chars
+        self.rotations: int = rotations
+
+    def to_dict(self) -> dict[str, Any]:
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+
+class UserData:
+    """The runtime handle of a user around its UserState.
+
+    The chatbot is only created when it is used for the first time, the translator is shared by all users.
+    A new chatbot is created for the HuggingChat account stored in the state and continues the stored conversation.
+    The blank conversation the new chatbot starts with is then handed to "delete_conversation", so it isn't left behind.
+    """
+
+    def __init__(self, state: UserState, chatbot_factory: Callable[[Optional[str]], ChatBot], translator_factory: Callable[[], Optional[SharedTranslator]], account_of: Callable[[ChatBot], Optional[str]],
+                 delete_conversation: Callable[[ChatBot, str], None]):
+        self.state: UserState = state
+        self._chatbot_factory = chatbot_factory
+        self._translator_factory = translator_factory
+        self._account_of = account_of
+        self._delete_conversation = delete_conversation
+        self._chatbot: Optional[ChatBot] = None
+        self._lock = threading.Lock()
+
+    @property
+    def chatbot(self) -> ChatBot:
+        """The chatbot of the user, creating it is blocking so don't access this on the event loop the first time."""
+        with self._lock:
+            if self._chatbot is None:
+                chatbot = self._chatbot_factory(self.state.account)
+                conversation_id = self.state.conversation_id
+                account = self._account_of(chatbot)
+                # the conversation can't be continued if its account isn't available anymore (users of older versions have no account)
+                same_account = not self.state.account or self.state.account == account
+                if same_account and conversation_id and conversation_id != str(chatbot.current_conversation):
+                    blank_conversation_id = str(chatbot.current_conversation)
+                    try:
+                        chatbot.change_conversation(conversation_of(chatbot, conversation_id))
+                    except Exception as e:
+                        print(f'could not continue conversation {conversation_id} of user {self.state.user_id}: {e}')
+                    else:
+                        self._delete_conversation(chatbot, blank_conversation_id)
+                self.state.account = account
+                self._chatbot = chatbot
+            return self._chatbot
+
+    @property
+    def has_chatbot(self) -> bool:
+        return self._chatbot is not None
+
+    @property
+    def translator(self) -> Optional[SharedTranslator]:
+        return self._translator_factory()
+
+    @property
+    def conversation_id(self) -> Optional[str]:
+        """The current conversation id without creating the chatbot."""
+        if self._chatbot is None:
+            return self.state.conversation_id
+        # hugchat holds the current conversation as a Conversation object, or None once it was deleted
+        conversation = self._chatbot.current_conversation
+        return str(conversation) if conversation is not None else None
+
+    @property
+    def filename(self) -> str:
+        return self.state.filename
+
+    @property
+    def temperature(self) -> float:
+        return self.state.temperature
+
+    @temperature.setter
+    def temperature(self, temperature: float) -> None:
+        self.state.temperature = temperature
+
+    @property
+    def coalesce_window(self) -> int:
+        return self.state.coalesce_window
+
+    @coalesce_window.setter
+    def coalesce_window(self, coalesce_window: int) -> None:
+        self.state.coalesce_window = coalesce_window
+
+    @property
+    def rotate_turns(self) -> int:
+        return self.state.rotate_turns
+
+    @rotate_turns.setter
+    def rotate_turns(self, rotate_turns: int) -> None:
+        self.state.rotate_turns = rotate_turns
+
+    @property
+    def rotate_chars(self) -> int:
+        return self.state.rotate_chars
+
+    @rotate_chars.setter
+    def rotate_chars(self, rotate_chars: int) -> None:
+        self.state.rotate_chars = rotate_chars
+
+    @property
+    def turns(self) -> int:
+        return self.state.turns
+
+    @property
+    def context_chars(self) -> int:
+        return self.state.context_chars
+
+    @property
+    def rotations(self) -> int:
+        return self.state.rotations
+
+    @rotations.setter
+    def rotations(self, rotations: int) -> None:
+        self.state.rotations = rotations
+
+    def record_turn(self, chars: int) -> None:
+        """Counts a message and its answer towards the size of the current conversation."""
+        self.state.turns += 1
+        self.state.context_chars += chars
+
+    def reset_turns(self) -> None:
+        """Starts counting again for a new conversation."""
+        self.state.turns = 0
+        self.state.context_chars = 0
+
+    @property
+    def language(self) -> Optional[str]:
+        return self.state.language
+
+    @language.setter
+    def language(self, language: Optional[str]) -> None:
+        self.state.language = language
+
+    def sync_state(self) -> UserState:
+        """Copies the runtime state that can change behind our back (the current conversation) into the state and returns it."""
+        self.state.conversation_id = self.conversation_id
+        return self.state
@@ -0,0 +1,127 @@
+import os
+import pickle
+import sqlite3
+import threading
+from typing import Any, Optional
+
+FIELDS = ('filename', 'temperature', 'language', 'conversation_id', 'account', 'coalesce_window', 'rotate_turns', 'rotate_chars', 'turns', 'context_chars', 'rotations')
+PICKLE_MIGRATION_KEY = 'pickles_migrated'
+# columns that were added after the users table was introduced
+COLUMN_TYPES = {
+    'account': 'TEXT',
+    'coalesce_window': 'INTEGER NOT NULL DEFAULT 0',
+    'rotate_turns': 'INTEGER NOT NULL DEFAULT 0',
+    'rotate_chars': 'INTEGER NOT NULL DEFAULT 0',
+    'turns': 'INTEGER NOT NULL DEFAULT 0',
+    'context_chars': 'INTEGER NOT NULL DEFAULT 0',
+    'rotations': 'INTEGER NOT NULL DEFAULT 0',
+}
+
+
+class UserStore:
+    """Persistent user data indexed by user id, backed by sqlite.
+
+    The store remembers what was last written for every user,
+    so saving only writes the fields that actually changed and is free if nothing changed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection: Optional[sqlite3.Connection] = None
+        self._saved: dict[int, dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, filename TEXT NOT NULL, temperature REAL NOT NULL, language TEXT, conversation_id TEXT)')
+            # add the columns of newer versions to existing stores
+            columns = {row[1] for row in connection.execute('PRAGMA table_info(users)')}
+            for column, column_type in COLUMN_TYPES.items():
+                if column not in columns:
+                    connection.execute(f'ALTER TABLE users ADD COLUMN {column} {column_type}')
+            connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def load(self, user_id: int) -> Optional[dict[str, Any]]:
+        """Returns the stored fields of the given user or None if the user is unknown."""
+        with self._lock:
+            row = self._connect().execute(f'SELECT {", ".join(FIELDS)} FROM users WHERE id = ?', (user_id,)).fetchone()
+            if row is None:
+                return None
+            fields = dict(zip(FIELDS, row))
+            self._saved[user_id] = dict(fields)
+            return fields
+
+    def save(self, user_id: int, fields: dict[str, Any]) -> bool:
+        """Writes the fields of the given user that changed since the last load or save and returns whether anything was written."""
+        fields = {key: fields.get(key) for key in FIELDS}
+        with self._lock:
+            saved = self._saved.get(user_id)
+            connection = self._connect()
+            if saved is None:
+                connection.execute(f'INSERT OR REPLACE INTO users (id, {", ".join(FIELDS)}) VALUES (?, {", ".join("?" for _ in FIELDS)})', (user_id, *fields.values()))
+            else:
+                changed = {key: value for key, value in fields.items() if saved.get(key) != value}
+                if not changed:
+                    return False
+                assignments = ', '.join(f'{key} = ?' for key in changed)
+                connection.execute(f'UPDATE users SET {assignments} WHERE id = ?', (*changed.values(), user_id))
+            connection.commit()
+            self._saved[user_id] = fields
+            return True
+
+    def forget(self, user_id: int) -> None:
+        """Drops what is remembered about the last save of the user, e.g. when it is no longer held in memory."""
+        with self._lock:
+            self._saved.pop(user_id, None)
+
+    def migrate_pickles(self, users_dir: str) -> int:
+        """Imports the "<user id>_<name>.pickle" files of older versions once and returns how many users were imported.
+
+        Users that are already in the store are not overwritten. The pickle files are left untouched.
+        """
+        with self._lock:
+            connection = self._connect()
+            if connection.execute('SELECT value FROM meta WHERE key = ?', (PICKLE_MIGRATION_KEY,)).fetchone():
+                return 0
+        imported = 0
+        if os.path.isdir(users_dir):
+            for file in os.listdir(users_dir):
+                path = os.path.join(users_dir, file)
+                user_id = file.split('_', 1)[0]
+                if not os.path.isfile(path) or not file.endswith('.pickle') or not user_id.isdigit():
+                    continue
+                try:
+                    with open(path, 'rb') as f:
+                        # read the attributes of the old UserData directly, the class looks different now
+                        pickled = vars(pickle.load(f))
+                    fields = {
+                        'filename': pickled['filename'],
+                        'temperature': pickled['temperature'],
+                        'language': pickled.get('language'),
+                        'conversation_id': pickled['chatbot'].current_conversation,
+                        'account': None,
+                        'coalesce_window': 0,
+                        'rotate_turns': 0,
+                        'rotate_chars': 0,
+                        'turns': 0,
+                        'context_chars': 0,
+                        'rotations': 0,
+                    }
+                except Exception as e:
+                    print(f'could not migrate user data from {path}: {e}')
+                    continue
+                with self._lock:
+                    cursor = connection.execute(f'INSERT OR IGNORE INTO users (id, {", ".join(FIELDS)}) VALUES (?, {", ".join("?" for _ in FIELDS)})', (int(user_id), *(fields[key] for key in FIELDS)))
+                    imported += cursor.rowcount
+        with self._lock:
+            connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (PICKLE_MIGRATION_KEY, str(imported)))
+            connection.commit()
+        return imported
@@ -0,0 +1,68 @@
+import itertools
+import time
+
+from hugchat.hugchat import Conversation
+
+from chatbot_pool import ChatbotPool
+
+
+class FakeChatBot:
+    _ids = itertools.count(1)
+
+    def __init__(self, fail_change: bool = False):
+        # like hugchat, a new chatbot starts with a blank conversation
+        self.current_conversation = self.new_conversation()
+        self.fail_change = fail_change
+
+    def new_conversation(self) -> Conversation:
+        return Conversation(id=f'conversation-{next(self._ids)}')
+
+    def change_conversation(self, conversation: Conversation) -> None:
+        if self.fail_change:
+            raise ConnectionError('unreachable')
+        self.current_conversation = conversation
+
+
+def wait_for(condition, timeout: float = 5.0) -> bool:
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def pool(size: int, deleted: list, chatbot_factory=FakeChatBot) -> ChatbotPool:
+    chatbot_pool = ChatbotPool('cookies', size, lambda chatbot, conversation: deleted.append(conversation.id))
+    chatbot_pool.create = lambda account=None, strict=False: chatbot_factory()
+    return chatbot_pool
+
+
+def test_closing_deletes_the_blank_conversations_of_idle_chatbots():
+    deleted = []
+    chatbot_pool = pool(2, deleted)
+    chatbot_pool.warm()
+    assert wait_for(lambda: len(chatbot_pool._idle) == 2)
+    idle = [chatbot.current_conversation.id for chatbot in chatbot_pool._idle]
+    chatbot_pool.close()
+    assert sorted(deleted) == sorted(idle)
+    assert chatbot_pool.take() is None
+
+
+def test_released_chatbots_are_discarded_without_deleting_the_leased_conversation():
+    deleted = []
+    chatbot_pool = pool(0, deleted)
+    chatbot = chatbot_pool.lease()
+    chatbot_pool.release(chatbot)
+    time.sleep(0.05)
+    # whoever leased the chatbot queues its conversation
+    assert deleted == []
+
+
+def test_the_new_conversation_of_a_chatbot_that_failed_to_recycle_is_deleted():
+    deleted = []
+    chatbot_pool = pool(1, deleted, lambda: FakeChatBot(fail_change=True))
+    chatbot = chatbot_pool.create()
+    leased = chatbot.current_conversation.id
+    chatbot_pool._recycle(chatbot)
+    assert len(deleted) == 1 and deleted[0] != leased
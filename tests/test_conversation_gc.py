@@ -0,0 +1,114 @@
+import json
+import time
+
+from hugchat.hugchat import Conversation
+
+import conversation_gc
+from conversation_gc import ConversationCollector
+
+
+class FakeChatBot:
+    """Behaves like a hugchat 0.5 chatbot, which only deletes Conversation objects of its conversation list."""
+
+    def __init__(self, deleted: list, failures: int = 0):
+        self.deleted = deleted
+        self.failures = failures
+        # like hugchat, a new chatbot starts with a blank conversation
+        self.current_conversation = Conversation(id='blank')
+        self.conversation_list = [self.current_conversation]
+
+    def get_conversation_from_id(self, conversation_id: str):
+        return next((conversation for conversation in self.conversation_list if conversation.id == conversation_id), None)
+
+    def delete_conversation(self, conversation: Conversation):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('unreachable')
+        self.conversation_list.remove(self.get_conversation_from_id(conversation.id))
+        if conversation is self.current_conversation:
+            self.current_conversation = None
+        self.deleted.append(conversation.id)
+
+
+def wait_for(condition, timeout: float = 5.0) -> bool:
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_adding_does_not_write_the_file(tmp_path, monkeypatch):
+    path = tmp_path / 'users' / 'pending_deletions.json'
+    collector = ConversationCollector(str(path), lambda account: FakeChatBot([]))
+    # keep the worker thread from running
+    monkeypatch.setattr(collector, 'start', lambda: None)
+    collector.add('conversation', 'account')
+    assert not path.exists()
+    collector.flush()
+    assert [entry['conversation_id'] for entry in json.loads(path.read_text())] == ['conversation']
+
+
+def test_pending_conversations_survive_a_restart(tmp_path, monkeypatch):
+    path = tmp_path / 'pending_deletions.json'
+    collector = ConversationCollector(str(path), lambda account: FakeChatBot([]))
+    monkeypatch.setattr(collector, 'start', lambda: None)
+    collector.add('a', 'account')
+    collector.add('b', None)
+    collector.flush()
+    restarted = ConversationCollector(str(path), lambda account: FakeChatBot([]))
+    assert [entry['conversation_id'] for entry in restarted.pending()] == ['a', 'b']
+
+
+def test_conversations_are_deleted_in_the_background_and_retried(tmp_path, monkeypatch):
+    monkeypatch.setattr(conversation_gc, 'RETRY_DELAY', 0.01)
+    path = tmp_path / 'pending_deletions.json'
+    deleted = []
+    chatbot = FakeChatBot(deleted, failures=1)
+    collector = ConversationCollector(str(path), lambda account: chatbot)
+    collector.add('a', 'account')
+    collector.add('b', 'account')
+    # deleting the blank conversation of the new chatbot fails first and is retried as well
+    assert wait_for(lambda: sorted(deleted) == ['a', 'b', 'blank'] and not collector.pending())
+    # the worker saves the empty list once it is done
+    assert wait_for(lambda: path.exists() and json.loads(path.read_text()) == [])
+    assert collector.deleted == 3
+
+
+def test_conversations_are_saved_by_id(tmp_path, monkeypatch):
+    path = tmp_path / 'pending_deletions.json'
+    collector = ConversationCollector(str(path), lambda account: FakeChatBot([]))
+    monkeypatch.setattr(collector, 'start', lambda: None)
+    collector.add(Conversation(id='conversation'), 'account')
+    collector.flush()
+    assert [entry['conversation_id'] for entry in json.loads(path.read_text())] == ['conversation']
+
+
+def test_the_worker_keeps_running_when_saving_fails(tmp_path, monkeypatch):
+    path = tmp_path / 'pending_deletions.json'
+    deleted = []
+    collector = ConversationCollector(str(path), lambda account: FakeChatBot(deleted))
+    save = collector._save
+    failures = [OSError('disk full')]
+
+    def failing_save(pending):
+        if failures:
+            raise failures.pop()
+        save(pending)
+    monkeypatch.setattr(collector, '_save', failing_save)
+    collector.add('a', 'account')
+    assert wait_for(lambda: deleted == ['blank', 'a'])
+    collector.add('b', 'account')
+    assert wait_for(lambda: deleted == ['blank', 'a', 'b'])
+    assert wait_for(lambda: path.exists() and json.loads(path.read_text()) == [])
+
+
+def test_the_blank_conversation_of_the_collector_chatbot_is_deleted(tmp_path):
+    deleted = []
+    created = []
+    collector = ConversationCollector(str(tmp_path / 'pending_deletions.json'), lambda account: created.append(account) or FakeChatBot(deleted))
+    collector.add('a', 'account')
+    collector.add('b', 'account')
+    assert wait_for(lambda: deleted == ['blank', 'a', 'b'])
+    assert created == ['account']
@@ -0,0 +1,26 @@
+import threading
+
+from log_writer import LogWriter
+
+
+def test_records_after_stop_do_not_reopen_files(tmp_path):
+    writer = LogWriter(str(tmp_path))
+    path = str(tmp_path / 'user' / 'a.log')
+    stopped = threading.Event()
+    flushed = threading.Event()
+    # queued before the writer runs, so it takes them as one batch
+    for record in [('write', path, 'before\n'), ('stop', stopped), ('write', path, 'after\n'), ('flush', flushed)]:
+        writer._queue.put(record)
+    writer._run()
+    assert stopped.is_set() and flushed.is_set()
+    assert not writer._files
+    assert (tmp_path / 'user' / 'a.log').read_text() == 'before\n'
+
+
+def test_close_writes_queued_records_first(tmp_path):
+    writer = LogWriter(str(tmp_path))
+    writer.write('user', 'a.log', 'record\n')
+    writer.close('user', 'a.log')
+    assert (tmp_path / 'user' / 'a.log').read_text() == 'record\n'
+    assert not writer._files
+    writer.shutdown()
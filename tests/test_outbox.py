@@ -0,0 +1,82 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip('telegram')
+
+from telegram.error import RetryAfter
+
+from outbox import Outbox, TokenBucket
+
+
+def test_token_bucket_allows_bursts_then_limits_the_rate():
+    async def main():
+        bucket = TokenBucket(rate=20, capacity=2)
+        waits = [await bucket.acquire() for _ in range(4)]
+        # the burst goes through at once, then every request waits for a new token
+        assert waits[0] < 0.01 and waits[1] < 0.01
+        assert 0.03 < waits[2] < 0.1 and 0.03 < waits[3] < 0.1
+    asyncio.run(main())
+
+
+def test_token_bucket_pause():
+    async def main():
+        bucket = TokenBucket(rate=100, capacity=10)
+        bucket.pause(0.1)
+        assert await bucket.acquire() >= 0.09
+    asyncio.run(main())
+
+
+def test_shards_share_the_global_and_group_rates():
+    outbox = Outbox(global_rate=30, chat_rate=1, group_rate=20 / 60, shards=3)
+    assert outbox.global_rate == pytest.approx(10)
+    assert outbox.group_rate == pytest.approx(20 / 60 / 3)
+    # a private chat only gets messages from the shard of its user
+    assert outbox.chat_rate == 1
+
+
+def test_requests_of_a_chat_are_throttled_and_ordered():
+    async def main():
+        outbox = Outbox(global_rate=100, chat_rate=20)
+        sent = []
+
+        async def send(index):
+            sent.append((index, time.monotonic()))
+        start = time.monotonic()
+        await asyncio.gather(*(outbox.process_request(send, (index,), {}, 'sendMessage', {'chat_id': 1}, None) for index in range(5)))
+        assert [index for index, _ in sent] == list(range(5))
+        # 3 messages burst through, the other 2 wait for a token each
+        assert sent[-1][1] - start >= 0.09
+    asyncio.run(main())
+
+
+def test_retry_after_pauses_the_chat_and_retries():
+    async def main():
+        outbox = Outbox(global_rate=100, chat_rate=100, max_retries=1)
+        attempts = []
+
+        async def send():
+            attempts.append(time.monotonic())
+            if len(attempts) == 1:
+                raise RetryAfter(1)
+            return 'sent'
+        # retry after a second is too slow for a test, shorten the pause telegram asked for
+        bucket = outbox._bucket(1)
+        pause = bucket.pause
+        bucket.pause = lambda seconds: pause(seconds / 20)
+        assert await outbox.process_request(send, (), {}, 'sendMessage', {'chat_id': 1}, None) == 'sent'
+        assert len(attempts) == 2
+        assert attempts[1] - attempts[0] >= 0.04
+    asyncio.run(main())
+
+
+def test_retry_after_gives_up_after_max_retries():
+    async def main():
+        outbox = Outbox(global_rate=100, chat_rate=100, max_retries=0)
+
+        async def send():
+            raise RetryAfter(1)
+        with pytest.raises(RetryAfter):
+            await outbox.process_request(send, (), {}, 'sendMessage', {'chat_id': 1}, None)
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+from retry import CircuitBreaker, CircuitOpen, RetryableError, RetryPolicy, call, is_retryable
+
+
+class ModelOverloadedError(Exception):
+    pass
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f'status {status_code}')
+        self.http_status_code = status_code
+
+
+def failing(errors: list, result='ok'):
+    """Returns a call that raises the given errors one after another and then returns result."""
+    calls = []
+
+    async def func():
+        calls.append(True)
+        if errors:
+            raise errors.pop(0)
+        return result
+    return func, calls
+
+
+FAST = RetryPolicy(max_attempts=3, base_delay=0.001, max_delay=0.001, deadline=5)
+
+
+def test_retryable_errors():
+    assert is_retryable(RetryableError())
+    assert is_retryable(ModelOverloadedError())
+    assert is_retryable(ConnectionError())
+    assert is_retryable(StatusError(503))
+    assert not is_retryable(StatusError(400))
+    assert not is_retryable(ValueError())
+
+
+def test_delay_is_capped():
+    policy = RetryPolicy(base_delay=1, max_delay=3)
+    assert all(0 <= policy.delay(attempt) <= 3 for attempt in range(1, 10))
+
+
+def test_temporary_errors_are_retried():
+    func, calls = failing([ModelOverloadedError(), RetryableError('empty')])
+    assert asyncio.run(call(func, FAST)) == 'ok'
+    assert len(calls) == 3
+
+
+def test_gives_up_after_max_attempts():
+    func, calls = failing([ModelOverloadedError() for _ in range(5)])
+    with pytest.raises(ModelOverloadedError):
+        asyncio.run(call(func, FAST))
+    assert len(calls) == 3
+
+
+def test_fatal_errors_are_not_retried():
+    func, calls = failing([ValueError('bad request')])
+    with pytest.raises(ValueError):
+        asyncio.run(call(func, FAST))
+    assert len(calls) == 1
+
+
+def test_on_retry_is_called_before_every_retry():
+    retried = []
+    func, _ = failing([ModelOverloadedError(), ModelOverloadedError()])
+    asyncio.run(call(func, FAST, on_retry=retried.append))
+    assert len(retried) == 2
+
+
+def test_circuit_opens_and_recovers_through_a_probe():
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=0.05)
+    func, calls = failing([ModelOverloadedError(), ModelOverloadedError()])
+    with pytest.raises(CircuitOpen):
+        asyncio.run(call(func, FAST, breaker))
+    assert breaker.state == 'open'
+    assert len(calls) == 2
+    # fails fast while open
+    with pytest.raises(CircuitOpen):
+        asyncio.run(call(func, FAST, breaker))
+    assert len(calls) == 2
+
+    async def later():
+        await asyncio.sleep(0.06)
+        assert breaker.state == 'half-open'
+        return await call(func, FAST, breaker)
+    assert asyncio.run(later()) == 'ok'
+    assert breaker.state == 'closed'
+
+
+def test_fatal_errors_do_not_open_the_circuit():
+    breaker = CircuitBreaker('test', failure_threshold=1)
+    func, _ = failing([ValueError('bad request')])
+    with pytest.raises(ValueError):
+        asyncio.run(call(func, FAST, breaker))
+    assert breaker.state == 'closed'
@@ -0,0 +1,37 @@
+import rotation
+from user_data import UserData, UserState
+
+
+def user_data(**state) -> UserData:
+    return UserData(UserState(1, 'file', **state), lambda account: None, lambda: None, lambda chatbot: 'account', lambda chatbot, conversation_id: None)
+
+
+def test_rotation_is_due_after_enough_turns_or_context():
+    assert rotation.due(user_data(rotate_turns=10, turns=9, context_chars=10 ** 6)) is None
+    assert rotation.due(user_data(rotate_turns=10, turns=10)) == 'turns'
+    assert rotation.due(user_data(rotate_chars=4000, context_chars=4000)) == 'context'
+    assert rotation.due(user_data(rotate_turns=10, rotate_chars=4000, turns=10, context_chars=4000)) == 'turns'
+
+
+def test_rotation_is_off_without_thresholds():
+    assert rotation.due(user_data(turns=1000, context_chars=10 ** 6)) is None
+
+
+def test_thresholds_are_described():
+    assert rotation.describe(20, 20000) == '20 turns or about 20000 characters'
+    assert rotation.describe(0, 20000) == 'about 20000 characters'
+    assert rotation.describe(20, 0) == '20 turns'
+    assert rotation.describe(0, 0) == 'off'
+
+
+def test_short_summaries_are_kept():
+    assert rotation.shorten('  Short summary.  ', 100) == 'Short summary.'
+
+
+def test_long_summaries_are_cut_at_a_sentence():
+    summary = 'The user likes tea. They live in Berlin. They asked about trains to Hamburg and prices.'
+    assert rotation.shorten(summary, 60) == 'The user likes tea. They live in Berlin.'
+
+
+def test_long_summaries_without_sentences_are_cut_at_a_word():
+    assert rotation.shorten('one two three four five six', 15) == 'one two three'
@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+
+from scheduler import QueueFull, RequestCancelled, Scheduler
+
+
+async def result(value):
+    return value
+
+
+async def blocked(event: asyncio.Event, value):
+    await event.wait()
+    return value
+
+
+def test_requests_of_a_user_run_in_order():
+    async def main():
+        scheduler = Scheduler(max_concurrent=4, max_queued=5)
+        order = []
+
+        async def job(value):
+            await asyncio.sleep(0.01)
+            order.append(value)
+            return value
+        results = await asyncio.gather(*(scheduler.submit(1, lambda value=value: job(value)) for value in range(4)))
+        assert results == [0, 1, 2, 3]
+        assert order == [0, 1, 2, 3]
+    asyncio.run(main())
+
+
+def test_queue_full():
+    async def main():
+        scheduler = Scheduler(max_concurrent=1, max_queued=1)
+        release = asyncio.Event()
+        running = asyncio.ensure_future(scheduler.submit(1, lambda: blocked(release, 'a')))
+        await asyncio.sleep(0)
+        queued = asyncio.ensure_future(scheduler.submit(1, lambda: result('b')))
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFull):
+            await scheduler.submit(1, lambda: result('c'))
+        release.set()
+        assert await running == 'a'
+        assert await queued == 'b'
+    asyncio.run(main())
+
+
+def test_supersede_only_replaces_superseding_requests():
+    async def main():
+        scheduler = Scheduler(max_concurrent=1, max_queued=3)
+        release = asyncio.Event()
+        prompt_a = asyncio.ensure_future(scheduler.submit(1, lambda: blocked(release, 'prompt a'), supersede=True))
+        await asyncio.sleep(0)
+        delete = asyncio.ensure_future(scheduler.submit(1, lambda: result('delete')))
+        prompt_b = asyncio.ensure_future(scheduler.submit(1, lambda: result('prompt b'), supersede=True))
+        await asyncio.sleep(0)
+        prompt_c = asyncio.ensure_future(scheduler.submit(1, lambda: result('prompt c'), supersede=True))
+        await asyncio.sleep(0)
+        release.set()
+        assert await prompt_a == 'prompt a'
+        assert await delete == 'delete'
+        with pytest.raises(RequestCancelled):
+            await prompt_b
+        assert await prompt_c == 'prompt c'
+        assert scheduler.cancelled == 1
+    asyncio.run(main())
+
+
+def test_supersede_leaves_other_users_alone():
+    async def main():
+        scheduler = Scheduler(max_concurrent=1, max_queued=3)
+        release = asyncio.Event()
+        running = asyncio.ensure_future(scheduler.submit(1, lambda: blocked(release, 'a'), supersede=True))
+        await asyncio.sleep(0)
+        other = asyncio.ensure_future(scheduler.submit(2, lambda: result('other'), supersede=True))
+        await asyncio.sleep(0)
+        newer = asyncio.ensure_future(scheduler.submit(1, lambda: result('b'), supersede=True))
+        await asyncio.sleep(0)
+        release.set()
+        assert await asyncio.gather(running, other, newer) == ['a', 'other', 'b']
+    asyncio.run(main())
+
+
+def test_cancel_stops_running_and_queued_requests():
+    async def main():
+        scheduler = Scheduler(max_concurrent=1, max_queued=3)
+        never = asyncio.Event()
+        running = asyncio.ensure_future(scheduler.submit(1, lambda: blocked(never, 'a')))
+        await asyncio.sleep(0)
+        queued = asyncio.ensure_future(scheduler.submit(1, lambda: result('b')))
+        await asyncio.sleep(0)
+        assert scheduler.cancel(1) == 2
+        for future in (running, queued):
+            with pytest.raises(RequestCancelled):
+                await future
+        # the slot is free again right away
+        assert scheduler.running == 0 and scheduler.queued == 0
+        assert await scheduler.submit(1, lambda: result('c')) == 'c'
+        assert scheduler.cancel(1) == 0
+    asyncio.run(main())
+
+
+def test_users_with_running_or_queued_requests_are_busy():
+    async def main():
+        scheduler = Scheduler(max_concurrent=1, max_queued=5)
+        event = asyncio.Event()
+        first = asyncio.ensure_future(scheduler.submit(1, lambda: blocked(event, 1)))
+        second = asyncio.ensure_future(scheduler.submit(2, lambda: result(2)))
+        await asyncio.sleep(0.01)
+        assert scheduler.busy(1) and scheduler.busy(2) and not scheduler.busy(3)
+        event.set()
+        assert await asyncio.gather(first, second) == [1, 2]
+        assert not scheduler.busy(1) and not scheduler.busy(2)
+    asyncio.run(main())
+
+
+def test_failing_queued_notice_does_not_orphan_the_request():
+    async def main():
+        scheduler = Scheduler(max_concurrent=1, max_queued=5)
+        event = asyncio.Event()
+
+        async def on_queued(position):
+            raise ConnectionError('telegram is unreachable')
+        first = asyncio.ensure_future(scheduler.submit(1, lambda: blocked(event, 1)))
+        second = asyncio.ensure_future(scheduler.submit(1, lambda: result(2), on_queued))
+        await asyncio.sleep(0.01)
+        assert not second.done()
+        event.set()
+        assert await asyncio.gather(first, second) == [1, 2]
+    asyncio.run(main())
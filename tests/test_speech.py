@@ -0,0 +1,57 @@
+import asyncio
+
+import httpx
+import pytest
+
+from retry import is_retryable
+from speech import AudioTooLarge, DownloadError, SttBackend, Transcriber
+
+FILE_URL = 'https://api.telegram.org/file/bot123456:SECRET-TOKEN/voice/file_0.oga'
+
+
+class CountingBackend(SttBackend):
+    async def transcribe(self, chunks, mimetype):
+        size = 0
+        async for chunk in chunks:
+            size += len(chunk)
+        return f'{size} bytes', 'EN-US'
+
+
+def transcriber(handler, max_bytes: int = 1024) -> Transcriber:
+    transcriber = Transcriber(CountingBackend(), max_bytes=max_bytes)
+    transcriber._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return transcriber
+
+
+def test_backends_have_to_implement_transcribe():
+    with pytest.raises(TypeError):
+        SttBackend()
+
+
+def test_audio_is_streamed_into_the_backend():
+    transcription = asyncio.run(transcriber(lambda request: httpx.Response(200, content=bytes(100))).transcribe_url(FILE_URL))
+    assert transcription.transcript == '100 bytes'
+    assert transcription.content_hash
+
+
+def test_too_large_audio_is_rejected():
+    with pytest.raises(AudioTooLarge):
+        asyncio.run(transcriber(lambda request: httpx.Response(200, content=bytes(2048))).transcribe_url(FILE_URL))
+    with pytest.raises(AudioTooLarge):
+        asyncio.run(transcriber(lambda request: httpx.Response(200)).transcribe_url(FILE_URL, duration=3600))
+
+
+def test_download_errors_do_not_contain_the_bot_token():
+    with pytest.raises(DownloadError) as not_found:
+        asyncio.run(transcriber(lambda request: httpx.Response(404)).transcribe_url(FILE_URL))
+    assert 'SECRET' not in str(not_found.value)
+    assert not is_retryable(not_found.value)
+
+    def unreachable(request):
+        raise httpx.ConnectError(f'could not connect to {request.url}')
+    with pytest.raises(DownloadError) as failed:
+        asyncio.run(transcriber(unreachable).transcribe_url(FILE_URL))
+    assert 'SECRET' not in str(failed.value)
+    # tracebacks don't show the httpx error with the url either
+    assert failed.value.__suppress_context__
+    assert is_retryable(failed.value)
@@ -0,0 +1,168 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('telegram')
+
+from telegram import Chat, Message, Update, User
+from telegram.constants import UpdateType
+
+import telechat
+from retry import CircuitOpen
+from user_cache import UserCache
+from user_data import UserData, UserState
+
+
+def text_update(kind: str, text: str = 'hello') -> Update:
+    user = User(id=1, first_name='user', is_bot=False)
+    message = Message(message_id=1, date=datetime.now(timezone.utc), chat=Chat(id=1, type=Chat.PRIVATE), from_user=user, text=text)
+    return Update(update_id=1, **{kind: message})
+
+
+def test_subscribes_to_the_update_types_of_the_handlers():
+    assert telechat.allowed_update_types(telechat.create_handlers()) == sorted([UpdateType.MESSAGE, UpdateType.EDITED_MESSAGE])
+
+
+def test_edited_messages_are_answered():
+    update = text_update('edited_message')
+    handlers = [handler for handler in telechat.create_handlers() if handler.check_update(update)]
+    assert handlers and handlers[0].callback is telechat.prompt
+    assert update.to_dict().keys() - {'update_id'} <= set(telechat.allowed_update_types(telechat.create_handlers()))
+
+
+def test_bottalk_releases_the_first_chatbot_when_leasing_the_second_fails(monkeypatch):
+    first = object()
+    leases = iter([first])
+    released = []
+
+    async def lease_chatbot():
+        try:
+            return next(leases)
+        except StopIteration:
+            raise ConnectionError('no chatbot') from None
+    monkeypatch.setattr(telechat, 'auth', lambda update, warning=True: True)
+    monkeypatch.setattr(telechat.upstream, 'lease_chatbot', lease_chatbot)
+    monkeypatch.setattr(telechat.upstream, 'release_chatbot', released.append)
+    context = SimpleNamespace(args=['2', 'hi'], bot=None)
+    with pytest.raises(ConnectionError):
+        asyncio.run(telechat.bottalk(text_update('message', '/bottalk 2 hi'), context))
+    assert released == [first]
+
+
+class RotatingChatBot:
+    def __init__(self):
+        self.current_conversation = 'old'
+        self.prompts = []
+
+
+@pytest.fixture
+def rotation_setup(monkeypatch):
+    chatbot = RotatingChatBot()
+    data = UserData(UserState(1, 'file', conversation_id='old', account='account', rotate_turns=2, turns=2, context_chars=500),
+                    lambda account: chatbot, lambda: None, lambda chatbot: 'account', lambda chatbot, conversation_id: None)
+    deleted = []
+
+    async def chat(chatbot, text, temperature):
+        chatbot.prompts.append(text)
+        return 'OK' if text.startswith('This conversation continues') else 'The user likes tea.'
+
+    async def new_conversation(chatbot):
+        return 'new'
+
+    async def change_conversation(chatbot, conversation_id):
+        chatbot.current_conversation = conversation_id
+
+    async def get_chatbot(user_data):
+        return chatbot
+    monkeypatch.setattr(telechat.loader, 'update_user_data', lambda update: data)
+    monkeypatch.setattr(telechat.loader, 'delete_conversation_later', lambda chatbot, conversation_id: deleted.append(conversation_id))
+    monkeypatch.setattr(telechat.loader, 'log', lambda *args, **kwargs: None)
+    monkeypatch.setattr(telechat.loader, 'log_context', lambda *args, **kwargs: None)
+    monkeypatch.setattr(telechat.upstream, 'retrying', lambda service, call: call())
+    monkeypatch.setattr(telechat.upstream, 'chat', chat)
+    monkeypatch.setattr(telechat.upstream, 'chatbot', get_chatbot)
+    monkeypatch.setattr(telechat.upstream, 'new_conversation', new_conversation)
+    monkeypatch.setattr(telechat.upstream, 'change_conversation', change_conversation)
+    monkeypatch.setattr(telechat, 'rotation_summary_chars', lambda: 100)
+    yield data, chatbot, deleted
+    telechat.upstream.shutdown()
+
+
+def test_rotation_seeds_a_new_conversation_with_a_summary(rotation_setup):
+    data, chatbot, deleted = rotation_setup
+    asyncio.run(telechat.rotate_conversation(text_update('message'), 'turns'))
+    assert chatbot.current_conversation == 'new' and deleted == ['old']
+    assert 'The user likes tea.' in chatbot.prompts[1]
+    # the seed counts as the first turn of the new conversation
+    assert data.turns == 1 and data.rotations == 1
+
+
+def test_rotation_keeps_the_conversation_while_the_circuit_is_open(rotation_setup, monkeypatch):
+    data, chatbot, deleted = rotation_setup
+
+    async def chat(chatbot, text, temperature):
+        raise CircuitOpen('HuggingChat', 30)
+    monkeypatch.setattr(telechat.upstream, 'chat', chat)
+    asyncio.run(telechat.rotate_conversation(text_update('message'), 'turns'))
+    assert chatbot.current_conversation == 'old' and deleted == []
+    assert (data.turns, data.context_chars, data.rotations) == (2, 500, 0)
+
+
+def test_rotation_is_skipped_if_it_is_no_longer_due(rotation_setup):
+    data, chatbot, deleted = rotation_setup
+    data.reset_turns()
+    asyncio.run(telechat.rotate_conversation(text_update('message'), 'turns'))
+    assert chatbot.prompts == [] and data.rotations == 0
+
+
+def test_messages_of_a_user_are_handled_in_the_order_they_arrived(monkeypatch):
+    cache = UserCache(10, 60, lambda user_id, user_data: None)
+    delays = iter([0.2, 0.0, 0.0])
+
+    def update_user_data(update):
+        # the first load takes longest, so the next ones would overtake it on the local pool
+        time.sleep(next(delays))
+        user_data = UserData(UserState(update.effective_user.id, 'file'), lambda account: None, lambda: None, lambda chatbot: None, lambda chatbot, conversation_id: None)
+        cache.put(update.effective_user.id, user_data)
+        return user_data
+    handled = []
+
+    async def handler(update, context, text=None):
+        handled.append(update.effective_message.text)
+    monkeypatch.setattr(telechat, 'auth', lambda update, warning=True: True)
+    monkeypatch.setattr(telechat.loader, 'user_cache', lambda: cache)
+    monkeypatch.setattr(telechat.loader, 'update_user_data', update_user_data)
+
+    async def main():
+        wrapper = telechat.coalesced(handler)
+        first = asyncio.ensure_future(wrapper(text_update('message', 'first'), None))
+        await asyncio.sleep(0.05)
+        second = asyncio.ensure_future(wrapper(text_update('message', 'second'), None))
+        await asyncio.gather(first, second)
+        # cached by now
+        await wrapper(text_update('message', 'third'), None)
+    asyncio.run(main())
+    telechat.upstream.shutdown()
+    assert handled == ['first', 'second', 'third']
+    assert not telechat._user_loads and not telechat._user_load_waiters
+
+
+def test_only_answers_of_the_chatbot_are_counted_as_turns():
+    data = UserData(UserState(1, 'file'), lambda account: None, lambda: None, lambda chatbot: None, lambda chatbot, conversation_id: None)
+    update = text_update('message')
+    telechat.count_turn(update, data, 'hello', telechat.FallbackReply(telechat.GIBBERISH_MESSAGE))
+    telechat.count_turn(update, data, 'hello', telechat.unavailable_message(CircuitOpen('HuggingChat', 30)))
+    assert (data.turns, data.context_chars) == (0, 0)
+    telechat.count_turn(update, data, 'hello', 'hi there')
+    assert (data.turns, data.context_chars) == (1, 13)
+
+
+def test_failed_responses_are_fallback_replies(monkeypatch):
+    async def retrying(service, call):
+        raise ConnectionError('overloaded')
+    monkeypatch.setattr(telechat.upstream, 'retrying', retrying)
+    message = asyncio.run(telechat.get_response(None, 0.9, 'hello'))
+    assert message == telechat.GIBBERISH_MESSAGE and isinstance(message, telechat.FallbackReply)
@@ -0,0 +1,20 @@
+from transcript_cache import TranscriptCache
+
+
+def test_transcripts_are_cached_by_file(tmp_path):
+    cache = TranscriptCache(str(tmp_path / 'transcripts.sqlite'))
+    assert cache.get_by_file('file') is None
+    cache.put('file', 'hash', 'hello', 'EN-US')
+    assert cache.get_by_file('file') == ('hello', 'EN-US')
+    assert cache.stats() == {'file_hits': 1, 'misses': 1}
+
+
+def test_least_recently_used_transcripts_are_evicted(tmp_path):
+    cache = TranscriptCache(str(tmp_path / 'transcripts.sqlite'), max_entries=2)
+    cache.put('a', 'hash a', 'a', 'EN-US')
+    cache.put('b', 'hash b', 'b', 'EN-US')
+    cache.get_by_file('a')
+    cache.put('c', 'hash c', 'c', 'EN-US')
+    assert cache.get_by_file('b') is None
+    assert cache.get_by_file('a') == ('a', 'EN-US')
+    assert cache.get_by_file('c') == ('c', 'EN-US')
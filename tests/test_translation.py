@@ -0,0 +1,41 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('deepl')
+
+import translation
+
+
+class FakeTranslator:
+    def __init__(self, api_token: str):
+        self.texts = []
+
+    def translate_text(self, text: str, *, target_lang: str):
+        self.texts.append(text)
+        return SimpleNamespace(text=f'[{target_lang}] {text}', detected_source_lang='DE')
+
+
+@pytest.fixture
+def translator(monkeypatch) -> translation.SharedTranslator:
+    monkeypatch.setattr(translation, 'Translator', FakeTranslator)
+    return translation.SharedTranslator('token', cache_size=2)
+
+
+def test_translations_are_cached(translator):
+    assert translator.translate_text('hallo', 'EN-US') == ('[EN-US] hallo', 'DE')
+    assert translator.translate_text('hallo', 'EN-US') == ('[EN-US] hallo', 'DE')
+    assert translator.translator.texts == ['hallo']
+    assert translator.stats() == {'size': 1, 'hits': 1, 'misses': 1}
+
+
+def test_least_recently_used_translations_are_evicted(translator):
+    for text in ['a', 'b', 'c', 'a']:
+        translator.translate_text(text, 'EN-US')
+    assert translator.translator.texts == ['a', 'b', 'c', 'a']
+    assert translator.stats()['size'] == 2
+
+
+def test_text_in_the_target_language_is_not_sent(translator):
+    assert translator.translate_text('hello', 'EN-US', 'EN-GB') == ('hello', 'EN-GB')
+    assert translator.translator.texts == []
@@ -0,0 +1,123 @@
+import asyncio
+import threading
+
+import pytest
+
+import upstream
+from retry import CircuitBreaker, RetryPolicy
+
+
+class SlowChatBot:
+    """Blocks in chat until it is released, like a long HuggingChat answer."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.active = 0
+        self.overlapped = False
+        self.current_conversation = 'conversation'
+
+    def chat(self, text, temperature=0.9, stream=False):
+        self.active += 1
+        self.overlapped |= self.active > 1
+        self.release.wait(5)
+        self.active -= 1
+        return f'answer to {text}'
+
+
+@pytest.fixture(autouse=True)
+def scratch_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    yield
+    upstream.shutdown()
+
+
+def test_idle_chatbot_is_released_right_away():
+    released = []
+    upstream.when_idle(SlowChatBot(), lambda: released.append(True))
+    assert released == [True]
+
+
+def test_cancelled_call_keeps_the_chatbot_busy_until_it_returns():
+    async def main():
+        chatbot = SlowChatBot()
+        released = threading.Event()
+        task = asyncio.ensure_future(upstream.chat(chatbot, 'hi', 0.9))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        upstream.when_idle(chatbot, released.set)
+        # the call is still running on the worker pool
+        assert not released.is_set()
+        chatbot.release.set()
+        assert await asyncio.get_running_loop().run_in_executor(None, released.wait, 5)
+    asyncio.run(main())
+
+
+def test_calls_wait_for_calls_left_running_by_cancelled_requests():
+    async def main():
+        chatbot = SlowChatBot()
+        first = asyncio.ensure_future(upstream.chat(chatbot, 'first', 0.9))
+        await asyncio.sleep(0.05)
+        first.cancel()
+        second = asyncio.ensure_future(upstream.chat(chatbot, 'second', 0.9))
+        await asyncio.sleep(0.05)
+        assert not second.done()
+        chatbot.release.set()
+        assert await second == 'answer to second'
+        assert not chatbot.overlapped
+    asyncio.run(main())
+
+
+class ModelOverloadedError(Exception):
+    pass
+
+
+class FlakyPool:
+    def __init__(self, failures: int):
+        self.failures = failures
+
+    def take(self):
+        return None
+
+    def create(self):
+        if self.failures:
+            self.failures -= 1
+            raise ModelOverloadedError('model is overloaded')
+        return SlowChatBot()
+
+
+def test_creating_and_switching_conversations_are_retried(monkeypatch):
+    pool = FlakyPool(failures=2)
+    monkeypatch.setattr(upstream.loader, 'chatbot_pool', lambda: pool)
+    monkeypatch.setattr(upstream.loader, 'retry_policy', lambda: RetryPolicy(max_attempts=3, base_delay=0.001, max_delay=0.001))
+    monkeypatch.setattr(upstream.loader, 'circuit_breaker', lambda service: CircuitBreaker(service))
+
+    async def main():
+        chatbot = await upstream.lease_chatbot()
+        changes = []
+
+        def change_conversation(conversation_id):
+            changes.append(conversation_id)
+            if len(changes) == 1:
+                raise ModelOverloadedError('model is overloaded')
+            chatbot.current_conversation = conversation_id
+        chatbot.change_conversation = change_conversation
+        await upstream.change_conversation(chatbot, 'new')
+        assert chatbot.current_conversation == 'new'
+        assert changes == ['new', 'new']
+    asyncio.run(main())
+    assert pool.failures == 0
+
+
+def test_local_io_does_not_wait_behind_upstream_calls():
+    async def main():
+        chatbots = [SlowChatBot() for _ in range(upstream.DEFAULT_WORKERS)]
+        # every worker of the upstream pool is busy with a long answer
+        answers = [asyncio.ensure_future(upstream.chat(chatbot, 'hi', 0.9)) for chatbot in chatbots]
+        await asyncio.sleep(0.05)
+        assert await asyncio.wait_for(upstream.run_local(lambda: 'user data'), 1) == 'user data'
+        for chatbot in chatbots:
+            chatbot.release.set()
+        await asyncio.gather(*answers)
+    asyncio.run(main())
@@ -0,0 +1,49 @@
+import time
+
+from user_cache import UserCache
+
+
+def test_least_recently_used_users_are_evicted():
+    evicted = []
+    cache = UserCache(2, 60, lambda user_id, user_data: evicted.append(user_id))
+    for user_id in range(3):
+        cache.put(user_id, object())
+    assert evicted == [0]
+    assert 0 not in cache and len(cache) == 2
+
+
+def test_busy_users_are_not_evicted_when_full():
+    evicted = []
+    busy = {0}
+    cache = UserCache(2, 60, lambda user_id, user_data: evicted.append(user_id), lambda user_id: user_id in busy)
+    for user_id in range(3):
+        cache.put(user_id, object())
+    assert evicted == [1]
+    busy.add(2)
+    cache.put(3, object())
+    assert evicted == [1]
+    assert len(cache) == 3
+
+
+def test_busy_users_are_not_evicted_when_idle():
+    evicted = []
+    busy = {0}
+    cache = UserCache(5, 0.05, lambda user_id, user_data: evicted.append(user_id), lambda user_id: user_id in busy)
+    cache.put(0, object())
+    cache.put(1, object())
+    time.sleep(0.1)
+    cache.get(2)
+    assert evicted == [1]
+    busy.clear()
+    time.sleep(0.1)
+    cache.get(2)
+    assert evicted == [1, 0]
+
+
+def test_clear_evicts_busy_users():
+    evicted = []
+    cache = UserCache(2, 60, lambda user_id, user_data: evicted.append(user_id), lambda user_id: True)
+    cache.put(0, object())
+    cache.put(1, object())
+    cache.clear()
+    assert evicted == [0, 1] and len(cache) == 0
@@ -0,0 +1,83 @@
+import itertools
+
+from hugchat.hugchat import Conversation
+
+from user_data import UserData, UserState
+from user_store import UserStore
+
+
+class FakeChatBot:
+    """Behaves like a hugchat 0.5 chatbot: conversations are Conversation objects from its conversation list."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, fail_change: bool = False):
+        # like hugchat, a new chatbot starts with a blank conversation
+        self.current_conversation = Conversation(id=f'blank-{next(self._ids)}')
+        self.conversation_list = [self.current_conversation]
+        self.fail_change = fail_change
+
+    def get_conversation_from_id(self, conversation_id: str):
+        return next((conversation for conversation in self.conversation_list if conversation.id == conversation_id), None)
+
+    def change_conversation(self, conversation: Conversation) -> None:
+        local_conversation = self.get_conversation_from_id(conversation.id)
+        if self.fail_change or local_conversation is None:
+            raise RuntimeError('conversation not found')
+        self.current_conversation = local_conversation
+
+
+def user_data(state: UserState, chatbot: FakeChatBot, deleted: list) -> UserData:
+    return UserData(state, lambda account: chatbot, lambda: None, lambda chatbot: 'account', lambda chatbot, conversation_id: deleted.append(conversation_id))
+
+
+def test_continuing_a_conversation_deletes_the_blank_one():
+    deleted = []
+    chatbot = FakeChatBot()
+    blank = chatbot.current_conversation.id
+    data = user_data(UserState(1, 'file', conversation_id='saved', account='account'), chatbot, deleted)
+    assert data.chatbot.current_conversation.id == 'saved'
+    assert data.conversation_id == 'saved'
+    assert deleted == [blank]
+    # the chatbot is only created once
+    assert data.chatbot is chatbot
+    assert deleted == [blank]
+
+
+def test_new_user_keeps_the_blank_conversation():
+    deleted = []
+    chatbot = FakeChatBot()
+    data = user_data(UserState(1, 'file'), chatbot, deleted)
+    assert data.chatbot.current_conversation.id.startswith('blank-')
+    assert deleted == []
+
+
+def test_blank_conversation_is_kept_if_the_saved_one_is_gone():
+    deleted = []
+    chatbot = FakeChatBot(fail_change=True)
+    data = user_data(UserState(1, 'file', conversation_id='saved', account='account'), chatbot, deleted)
+    assert data.chatbot.current_conversation.id.startswith('blank-')
+    assert deleted == []
+
+
+def test_turns_are_counted_and_reset():
+    data = user_data(UserState(1, 'file'), FakeChatBot(), [])
+    data.record_turn(100)
+    data.record_turn(50)
+    assert (data.turns, data.context_chars) == (2, 150)
+    data.reset_turns()
+    assert (data.turns, data.context_chars) == (0, 0)
+
+
+def test_conversation_ids_are_persisted_as_strings(tmp_path):
+    store = UserStore(str(tmp_path / 'users.sqlite'))
+    chatbot = FakeChatBot()
+    data = user_data(UserState(1, 'file'), chatbot, [])
+    data.chatbot
+    fields = data.sync_state().to_dict()
+    del fields['user_id']
+    assert store.save(1, fields)
+    assert store.load(1)['conversation_id'] == chatbot.current_conversation.id
+    # hugchat drops the current conversation once it was deleted
+    chatbot.current_conversation = None
+    assert data.sync_state().conversation_id is None